@@ -65,6 +65,20 @@ MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
 ]
 
+# Query counts and timings per request in a Server-Timing header and the log,
+# see apiApp/instrumentation.py. Off unless QUERY_INSTRUMENTATION is set.
+if os.getenv('QUERY_INSTRUMENTATION'):
+    MIDDLEWARE.insert(0, 'apiApp.instrumentation.QueryInstrumentationMiddleware')
+
+# Most queries a request to each URL name should run before it is logged as over budget
+QUERY_BUDGETS = {
+    'get_cart_stat': 1,
+    'product_membership': 2,
+    'get_cart': 3,
+    'get_orders': 4,
+}
+QUERY_BUDGET_DEFAULT = None
+
 ROOT_URLCONF = 'EcommerceWebsite.urls'
 
 TEMPLATES = [
@@ -99,6 +113,26 @@ DATABASES = {
     }
 }
 
+# DATABASE_URL overrides the PG_* variables, e.g. sqlite:///db.sqlite3 for local test runs
+if os.getenv('DATABASE_URL'):
+    DATABASES['default'] = dj_database_url.parse(os.getenv('DATABASE_URL'))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+# The catalog response cache and the membership cache are invalidated by
+# writes in any process (web workers, import_catalog, seed), which only works
+# when they all share the cache. Without REDIS_URL every process has its own
+# local-memory cache, and apiApp keeps its entries briefly (see apiApp/cache.py).
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EcommerceWebsite.settings')
 
 application = get_wsgi_application()
+
+# Load the search suggestions index while the worker starts taking requests
+from apiApp.autocomplete import autocomplete_index  # noqa: E402
+
+autocomplete_index.update_in_background()
@@ -16,6 +16,9 @@ admin.site.register(ProductCategory,category_admin)
 
 class cart_admin(admin.ModelAdmin):
     list_display = ['cart_code', 'created_at', 'get_cart_items']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('cartitems__product')
     
     def get_cart_items(self, obj):
         return ", ".join([f"{item.product.name} (x{item.quantity})" for item in obj.cartitems.all()])
@@ -6,4 +6,5 @@ class ApiappConfig(AppConfig):
     name = 'apiApp' 
 
     def ready(self):
-        import apiApp.signals
\ No newline at end of file
+        import apiApp.signals
+        import apiApp.tasks
\ No newline at end of file
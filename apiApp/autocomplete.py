@@ -0,0 +1,474 @@
+"""
+Search-as-you-type suggestions over product and category names.
+
+Each worker keeps every word position of every name in one sorted list of
+strings searched with bisect, so "cot" finds "Blue Cotton Shirt". Typos are
+handled by walking the distinct prefixes of that list with a bounded edit
+distance (adjacent transpositions count as one edit), so "shrit" still finds
+"Shirt". The best matches of the shortest prefixes are computed with the
+index, longer ones on first use, and both are kept current as names change.
+
+The index is built in a background thread when the worker starts (see
+wsgi.py) or on first use; until it is ready, suggestions are name prefix
+matches from the database. Writes reach it as incremental updates: the
+signals and the catalog importer record every product or category they
+change in AutocompleteChange, and every AUTOCOMPLETE_SYNC_SECONDS each
+worker reloads the ones recorded since its last sync, in the background.
+The signals also apply their writes to the index of their own process
+straight away. Only a recorded "all" (seeding), a burst of changes or a
+worker that fell behind the pruned log rebuild the whole index.
+"""
+import bisect
+import gc
+import heapq
+import logging
+import re
+import threading
+import time
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from .models import AutocompleteChange, Product, ProductCategory
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'[^\W_]+')
+
+# Largest number of suggestions a caller can ask for; prefixes cache this many
+MAX_SUGGESTIONS = 20
+
+# Names are indexed this deep; longer prefixes are checked against the name itself
+MAX_DEPTH = 16
+
+# The best matches of prefixes this short are computed with the index, their
+# ranges are too long to scan during a request
+PRECOMPUTED_DEPTH = 3
+
+# Longer prefixes whose best matches are cached; past that the cache starts over
+MAX_CACHED_PREFIXES = 100_000
+
+# Sorts after every character a label can hold
+_END = '\U0010ffff'
+
+# Recorded changes are kept this long; a worker that did not sync for longer rebuilds
+CHANGE_RETENTION = timedelta(days=1)
+
+# Changes are read again this far back: a transaction can commit its change
+# after a later one was read, and hosts' clocks differ
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# More changes than this in one sync are applied by rebuilding instead
+SYNC_REBUILD_THRESHOLD = 5000
+
+
+def normalize(text):
+    return ' '.join(WORD_RE.findall((text or '').lower()))
+
+
+def max_edits(prefix):
+    """Typos allowed for a prefix: none for very short input, two for long words."""
+    if len(prefix) < 4:
+        return 0
+    return 1 if len(prefix) < 8 else 2
+
+
+def _key(kind, pk):
+    # Products are keyed by id and categories by minus their id, so keys are plain ints
+    return -pk if kind == 'category' else pk
+
+
+def _key_of(item):
+    return int(item[item.index('\0') + 1:])
+
+
+def _suffixes(label):
+    """Every word position of the label, cut to the indexed depth."""
+    words = label.split(' ')
+    return {' '.join(words[start:])[:MAX_DEPTH] for start in range(len(words))}
+
+
+class _Index:
+    """One generation of the index; rebuilds fill a new one and swap it in."""
+
+    def __init__(self):
+        # key -> (type, name, slug, order)
+        self.entries = {}
+        # "<suffix>\0<key>" for every suffix of every label, sorted
+        self.suffixes = []
+        # prefix -> best keys of the suffixes starting with it
+        self.top = {}
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        # Pausing the cyclic collector while allocating the entries makes the build much faster
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            suffixes = []
+            for pk, name, slug in ProductCategory.objects.values_list('id', 'name', 'slug').iterator():
+                suffixes += index._add_entry(-pk, 'category', name, slug)
+            products = Product.objects.values_list('id', 'name', 'slug', 'featured')
+            for pk, name, slug, featured in products.iterator(chunk_size=2000):
+                suffixes += index._add_entry(pk, 'product', name, slug, featured)
+            suffixes.sort()
+            index.suffixes = suffixes
+            index.precompute()
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return index
+
+    @staticmethod
+    def _entry(key, kind, name, slug, featured):
+        label = normalize(name)
+        # Categories first, then featured products, then shorter names, packed in one int
+        rank = (kind != 'category') * 2 + (not featured)
+        order = (rank * 1000 + min(len(label), 999)) * 10 ** 12 + abs(key)
+        return label, (kind, name, slug, order)
+
+    def _add_entry(self, key, kind, name, slug, featured=False):
+        """Store the entry; returns its suffix items, for the caller to insert."""
+        label, entry = self._entry(key, kind, name, slug, featured)
+        if not label:
+            return []
+        self.entries[key] = entry
+        return [f'{suffix}\0{key}' for suffix in _suffixes(label)]
+
+    def order(self, key):
+        return self.entries[key][3]
+
+    def precompute(self):
+        """Best keys of every prefix up to PRECOMPUTED_DEPTH long, in one pass over the suffixes."""
+        under = {}
+        runs = groupby(self.suffixes, key=lambda item: item[:item.index('\0')][:PRECOMPUTED_DEPTH])
+        for run, items in runs:
+            keys = heapq.nsmallest(MAX_SUGGESTIONS, {_key_of(item) for item in items}, key=self.order)
+            # The best of a prefix are among the best of the runs it starts
+            for end in range(1, len(run) + 1):
+                under.setdefault(run[:end], []).extend(keys)
+        for prefix, keys in under.items():
+            self.top[prefix] = heapq.nsmallest(MAX_SUGGESTIONS, set(keys), key=self.order)
+
+    def add(self, key, kind, name, slug, featured=False):
+        items = self._add_entry(key, kind, name, slug, featured)
+        if not items:
+            return
+        order = self.order(key)
+        for item in items:
+            bisect.insort(self.suffixes, item)
+            suffix = item[:item.index('\0')]
+            for end in range(1, len(suffix) + 1):
+                top = self.top.get(suffix[:end])
+                if top is None or key in top:
+                    continue
+                if len(top) < MAX_SUGGESTIONS or order < self.order(top[-1]):
+                    bisect.insort(top, key, key=self.order)
+                    del top[MAX_SUGGESTIONS:]
+
+    def upsert(self, key, kind, name, slug, featured=False):
+        if self.entries.get(key) == self._entry(key, kind, name, slug, featured)[1]:
+            # Most saves change neither the name nor the rank, keep the cached matches
+            return
+        self.remove(key)
+        self.add(key, kind, name, slug, featured)
+
+    def remove(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        for suffix in _suffixes(normalize(entry[1])):
+            item = f'{suffix}\0{key}'
+            position = bisect.bisect_left(self.suffixes, item)
+            if position < len(self.suffixes) and self.suffixes[position] == item:
+                del self.suffixes[position]
+            for end in range(1, len(suffix) + 1):
+                top = self.top.get(suffix[:end])
+                if top is not None and key in top:
+                    # Recomputed on the next lookup
+                    del self.top[suffix[:end]]
+        del self.entries[key]
+
+    def suggestion(self, key):
+        kind, name, slug, _ = self.entries[key]
+        return {'type': kind, 'name': name, 'slug': slug}
+
+    def _range(self, prefix, lo=0, hi=None):
+        hi = len(self.suffixes) if hi is None else hi
+        lo = bisect.bisect_left(self.suffixes, prefix, lo, hi)
+        return lo, bisect.bisect_left(self.suffixes, prefix + _END, lo, hi)
+
+    def _keys_between(self, lo, hi):
+        return {_key_of(self.suffixes[position]) for position in range(lo, hi)}
+
+    def best_keys(self, prefix):
+        """Best ranked keys with a suffix starting with ``prefix`` (at most MAX_DEPTH long), cached."""
+        top = self.top.get(prefix)
+        if top is None:
+            top = heapq.nsmallest(MAX_SUGGESTIONS, self._keys_between(*self._range(prefix)), key=self.order)
+            if len(self.top) >= MAX_CACHED_PREFIXES:
+                self.top = {cached: keys for cached, keys in self.top.items() if len(cached) <= PRECOMPUTED_DEPTH}
+            self.top[prefix] = top
+        return top
+
+    def prefix_keys(self, prefix):
+        if len(prefix) <= MAX_DEPTH:
+            return self.best_keys(prefix)
+        # The index stops short of the prefix, finish the match on the labels
+        needle = ' ' + prefix
+        keys = [
+            key for key in self._keys_between(*self._range(prefix[:MAX_DEPTH]))
+            if needle in ' ' + normalize(self.entries[key][1])
+        ]
+        return heapq.nsmallest(MAX_SUGGESTIONS, keys, key=self.order)
+
+    def children(self, prefix):
+        """The distinct characters following ``prefix`` in the suffixes."""
+        lo, hi = self._range(prefix)
+        depth = len(prefix)
+        # Suffixes ending at the prefix sort first
+        position = bisect.bisect_left(self.suffixes, prefix + '\1', lo, hi)
+        while position < hi:
+            char = self.suffixes[position][depth]
+            yield char
+            position = bisect.bisect_left(self.suffixes, prefix + chr(ord(char) + 1), position, hi)
+
+    def fuzzy_prefixes(self, prefix, edits):
+        """
+        Indexed prefixes within ``edits`` of ``prefix`` (optimal string
+        alignment distance), as (distance, prefix) pairs. Branches are pruned
+        as soon as every alignment needs more edits than allowed. The first
+        character has to match, which keeps the walk to one range.
+        """
+        prefix = prefix[:MAX_DEPTH]
+        size = len(prefix)
+        matches = []
+        over = edits + 1
+        first_row = list(range(size + 1))
+        lo, hi = self._range(prefix[0])
+        stack = [(prefix[0], None, None, first_row)] if lo < hi else []
+        while stack:
+            path, prev_char, prev_prev_row, prev_row = stack.pop()
+            char = path[-1]
+            depth = len(path)
+            # Cells further than ``edits`` off the diagonal can't come back under the limit
+            row = [depth] + [over] * size
+            for i in range(max(1, depth - edits), min(size, depth + edits) + 1):
+                cost = prefix[i - 1] != char
+                distance = min(row[i - 1] + 1, prev_row[i] + 1, prev_row[i - 1] + cost)
+                if (
+                    i > 1 and prev_prev_row is not None
+                    and prefix[i - 1] == prev_char and prefix[i - 2] == char
+                ):
+                    distance = min(distance, prev_prev_row[i - 2] + 1)
+                row[i] = distance
+            if row[size] <= edits:
+                # Everything below this prefix matches at the same distance or worse
+                matches.append((row[size], path))
+            elif min(row) <= edits:
+                stack.extend((path + next_char, char, prev_row, row) for next_char in self.children(path))
+        return matches
+
+    def fuzzy_keys(self, prefix, limit, exclude):
+        edits = max_edits(prefix)
+        if not edits:
+            return []
+        best = {}
+        for distance, path in self.fuzzy_prefixes(prefix, edits):
+            for key in self.best_keys(path):
+                if key not in exclude and distance < best.get(key, edits + 1):
+                    best[key] = distance
+        # Closest first, then in the usual order
+        return heapq.nsmallest(limit, best, key=lambda k: (best[k], self.order(k)))
+
+
+def database_suggestions(query, limit):
+    """Names starting with the query, straight from the database, while the index is built."""
+    query = query.strip()
+    categories = list(
+        ProductCategory.objects.filter(name__istartswith=query)
+        .order_by(Length('name'), 'id').values_list('name', 'slug')[:limit]
+    )
+    products = (
+        Product.objects.filter(name__istartswith=query)
+        .order_by('-featured', Length('name'), 'id').values_list('name', 'slug')
+    )
+    return [
+        {'type': 'category', 'name': name, 'slug': slug} for name, slug in categories
+    ] + [
+        {'type': 'product', 'name': name, 'slug': slug} for name, slug in products[:limit - len(categories)]
+    ]
+
+
+def record_changes(kind, ids):
+    """Have every process's index reload these products or categories."""
+    AutocompleteChange.objects.bulk_create([AutocompleteChange(kind=kind, object_id=pk) for pk in ids])
+
+
+def record_rebuild():
+    """Have every process rebuild its index, after writes too many to list."""
+    AutocompleteChange.objects.create(kind='all')
+
+
+def prune_changes():
+    """Drop the changes every process has had time to apply. Returns how many."""
+    return AutocompleteChange.objects.filter(created_at__lt=timezone.now() - CHANGE_RETENTION).delete()[0]
+
+
+class AutocompleteIndex:
+    def __init__(self):
+        # Guards the current index; never held while a new one is loaded
+        self._lock = threading.RLock()
+        # Serializes builds and syncs
+        self._build_lock = threading.Lock()
+        self._index = None
+        # Changes recorded from then on (less SYNC_OVERLAP) are still to be read
+        self._synced_at = None
+        # Ids of the changes read within the overlap, so each is applied once
+        self._applied = {}
+        self._checked = None
+        # Signal updates made while a build runs, replayed on the new index
+        self._pending = None
+        self._updating = False
+
+    # Building and syncing
+
+    def _sync_due(self):
+        interval = getattr(settings, 'AUTOCOMPLETE_SYNC_SECONDS', 5)
+        return self._checked is None or time.monotonic() - self._checked > interval
+
+    def ensure_current(self):
+        """Start the first build, or a sync that is due, in the background."""
+        if self._sync_due():
+            self.update_in_background()
+
+    def update_in_background(self):
+        with self._lock:
+            if self._updating:
+                return
+            self._updating = True
+            self._checked = time.monotonic()
+        threading.Thread(target=self._update, name='autocomplete-update', daemon=True).start()
+
+    def _update(self):
+        try:
+            with self._build_lock:
+                if self._index is None:
+                    self._build()
+                else:
+                    self._sync()
+        except Exception:
+            logger.exception("Autocomplete update failed, serving the previous index")
+        finally:
+            self._updating = False
+            connections.close_all()
+
+    def rebuild(self):
+        with self._build_lock:
+            self._build()
+
+    def sync(self):
+        with self._build_lock:
+            if self._index is None:
+                self._build()
+            else:
+                self._sync()
+
+    def _build(self):
+        started = timezone.now()
+        # Lookups keep using the current index while the new one loads
+        with self._lock:
+            self._pending = []
+        try:
+            index = _Index.load()
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for method, args in self._pending:
+                getattr(index, method)(*args)
+            self._pending = None
+            self._index = index
+            self._synced_at = started
+            self._applied = {}
+            self._checked = time.monotonic()
+
+    def _sync(self):
+        """Apply the changes recorded by every process since the last sync."""
+        started = timezone.now()
+        if started - self._synced_at > CHANGE_RETENTION:
+            # Some of them may have been pruned already
+            return self._build()
+        since = self._synced_at - SYNC_OVERLAP
+        changes = AutocompleteChange.objects.filter(created_at__gte=since).values_list(
+            'id', 'kind', 'object_id', 'created_at')
+        ids = {'product': set(), 'category': set()}
+        applied = {pk: at for pk, at in self._applied.items() if at >= since}
+        for pk, kind, object_id, created_at in changes.iterator():
+            if pk in applied:
+                continue
+            if kind == 'all':
+                return self._build()
+            ids[kind].add(object_id)
+            applied[pk] = created_at
+        if len(ids['product']) + len(ids['category']) > SYNC_REBUILD_THRESHOLD:
+            return self._build()
+
+        rows = {
+            'category': {pk: (name, slug, False) for pk, name, slug in
+                         ProductCategory.objects.filter(pk__in=ids['category']).values_list('id', 'name', 'slug')},
+            'product': {pk: (name, slug, featured) for pk, name, slug, featured in
+                        Product.objects.filter(pk__in=ids['product']).values_list('id', 'name', 'slug', 'featured')},
+        }
+        with self._lock:
+            for kind, pks in ids.items():
+                for pk in pks:
+                    if pk in rows[kind]:
+                        self.upsert(kind, pk, *rows[kind][pk])
+                    else:
+                        self.remove(kind, pk)
+            self._synced_at = started
+            self._applied = applied
+            self._checked = time.monotonic()
+
+    # Incremental updates, ignored until the index has been built
+
+    def _apply(self, method, *args):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((method, args))
+            if self._index is not None:
+                getattr(self._index, method)(*args)
+
+    def upsert(self, kind, pk, name, slug, featured=False):
+        self._apply('upsert', _key(kind, pk), kind, name, slug, featured)
+
+    def remove(self, kind, pk):
+        self._apply('remove', _key(kind, pk))
+
+    # Lookups
+
+    def suggest(self, query, limit=10):
+        """Up to ``limit`` suggestions: prefix matches first, then typo matches."""
+        self.ensure_current()
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+        with self._lock:
+            index = self._index
+            if index is not None:
+                keys = list(index.prefix_keys(prefix)[:limit])
+                if len(keys) < limit:
+                    keys += index.fuzzy_keys(prefix, limit - len(keys), set(keys))
+                return [index.suggestion(key) for key in keys]
+        return database_suggestions(query, limit)
+
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,274 @@
+"""
+End-to-end API benchmark, run by `manage.py benchmark`.
+
+The run seeds a throwaway test database (apiApp.seeding), so it never
+touches real data. It then drives the URL patterns of urls.py in-process
+through the Django test client, down to the database, the response cache
+and a local Stripe stub for checkout.
+
+Each endpoint gets `warmup` untimed requests, then `requests` timed ones.
+Their parameters (which product, cart or customer) are drawn from a seeded
+stream with the same popularity skew as the data, so a run is repeatable.
+For each endpoint the results hold throughput, latency percentiles, queries
+and DB time per request, and errors. They are saved as JSON; compare() checks
+a run against a saved baseline.
+"""
+import json
+import platform
+import random
+import time
+from dataclasses import dataclass, field
+
+import django
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from . import instrumentation, payments
+from .models import Cart, CartItem, CustomUser, Order, Product, ProductCategory
+from .payments import LatencyMetrics
+from .seeding import ADJECTIVES, NOUNS, Zipf
+from .stripe_stub import StripeStub
+
+# url name -> (function(dataset, rng) returning (method, path, data), ok statuses, signed in)
+ENDPOINTS = {}
+
+OK_STATUSES = {200, 201, 304}
+
+
+def endpoint(name, ok=OK_STATUSES, signed_in=False):
+    def register(build):
+        ENDPOINTS[name] = (build, ok, signed_in)
+        return build
+    return register
+
+
+@dataclass
+class Dataset:
+    """Keys of the seeded rows, to build requests from."""
+    products: Zipf
+    categories: list
+    carts: Zipf
+    cart_items: list
+    customers: Zipf
+    shopper: CustomUser
+
+    @classmethod
+    def load(cls, seed):
+        rng = random.Random(f'{seed}:benchmark')
+        products = list(Product.objects.order_by('id').values_list('id', 'slug'))
+        rng.shuffle(products)
+        emails = list(Order.objects.order_by('customer_email').values_list('customer_email', flat=True).distinct())
+        emails = emails or list(CustomUser.objects.order_by('id').values_list('email', flat=True))
+        return cls(
+            products=Zipf(products),
+            categories=list(ProductCategory.objects.order_by('id').values_list('slug', flat=True)),
+            carts=Zipf(list(Cart.objects.order_by('id').values_list('cart_code', flat=True))),
+            cart_items=list(CartItem.objects.order_by('id').values_list('id', flat=True)),
+            customers=Zipf(emails),
+            shopper=CustomUser.objects.order_by('id').first(),
+        )
+
+
+@endpoint('product-list')
+def product_list(data, rng):
+    return 'get', reverse('product-list'), None
+
+
+@endpoint('product_details')
+def product_details(data, rng):
+    return 'get', reverse('product_details', kwargs={'slug': data.products.draw(rng)[1]}), None
+
+
+@endpoint('category_list')
+def category_list(data, rng):
+    return 'get', reverse('category_list'), None
+
+
+@endpoint('category_details')
+def category_details(data, rng):
+    return 'get', reverse('category_details', kwargs={'slug': rng.choice(data.categories)}), None
+
+
+@endpoint('search-product')
+def search_product(data, rng):
+    return 'get', reverse('search-product'), {'query': f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}'.lower()}
+
+
+@endpoint('search-suggest')
+def search_suggest(data, rng):
+    word = rng.choice(ADJECTIVES + NOUNS).lower()
+    return 'get', reverse('search-suggest'), {'query': word[:rng.randint(2, len(word))]}
+
+
+@endpoint('cart-add')
+def cart_add(data, rng):
+    return 'post', reverse('cart-add'), {'cart_code': data.carts.draw(rng), 'product_id': data.products.draw(rng)[0]}
+
+
+@endpoint('cart-item-update')
+def cart_item_update(data, rng):
+    return 'patch', reverse('cart-item-update', kwargs={'pk': rng.choice(data.cart_items)}), {'quantity': 1}
+
+
+@endpoint('get_cart')
+def get_cart(data, rng):
+    return 'get', reverse('get_cart', kwargs={'cart_code': data.carts.draw(rng)}), None
+
+
+@endpoint('get_cart_stat')
+def get_cart_stat(data, rng):
+    return 'get', reverse('get_cart_stat'), {'cart_code': data.carts.draw(rng)}
+
+
+@endpoint('product_membership')
+def product_membership(data, rng):
+    ids = ','.join(str(pk) for pk, _ in data.products.sample(rng, 24))
+    return 'get', reverse('product_membership'), {
+        'product_ids': ids, 'cart_code': data.carts.draw(rng), 'email': data.customers.draw(rng),
+    }
+
+
+# Adding a product already in the wishlist removes it and answers 400
+@endpoint('whishlist-add', ok={201, 400}, signed_in=True)
+def wishlist_add(data, rng):
+    return 'post', reverse('whishlist-add'), {'product': data.products.draw(rng)[0]}
+
+
+@endpoint('my_wishlists')
+def my_wishlists(data, rng):
+    return 'get', reverse('my_wishlists'), {'email': data.shopper.email}
+
+
+@endpoint('get_orders')
+def get_orders(data, rng):
+    return 'get', reverse('get_orders'), {'email': data.customers.draw(rng)}
+
+
+@endpoint('create_checkout_session')
+def create_checkout_session(data, rng):
+    return 'post', reverse('create_checkout_session'), {
+        'cart_code': data.carts.draw(rng), 'email': data.customers.draw(rng),
+    }
+
+
+@dataclass
+class EndpointResult:
+    requests: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    queries: int = 0
+    db_time: float = 0.0
+    statuses: dict = field(default_factory=dict)
+
+
+class Benchmark:
+    def __init__(self, endpoints=None, requests=200, warmup=20, seed=42):
+        unknown = set(endpoints or ()) - set(ENDPOINTS)
+        if unknown:
+            raise ValueError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+        self.endpoints = list(endpoints or ENDPOINTS)
+        self.requests = requests
+        self.warmup = warmup
+        self.seed = seed
+
+    def run(self, log=None):
+        """Benchmark every endpoint against the current database; returns the results dict."""
+        log = log or (lambda message: None)
+        cache.clear()
+        data = Dataset.load(self.seed)
+        # Only the endpoints that need a user pay for the session and user lookups
+        clients = {False: Client(), True: Client()}
+        if data.shopper is not None:
+            clients[True].force_login(data.shopper)
+        stripe = StripeStub()
+        latency = LatencyMetrics(window=self.requests)
+        results = {}
+        try:
+            with override_settings(STRIPE_API_BASE=stripe.url, STRIPE_SECRET_KEY='sk_test_benchmark'):
+                payments.reset()
+                for name in self.endpoints:
+                    results[name] = self.drive(clients, name, data, latency)
+                    log(f"{name}: {self.requests} requests in {results[name].seconds:.2f}s")
+        finally:
+            payments.reset()
+            stripe.close()
+        return self.report(results, latency)
+
+    def drive(self, clients, name, data, latency):
+        build, ok, signed_in = ENDPOINTS[name]
+        client = clients[signed_in]
+        rng = random.Random(f'{self.seed}:{name}')
+        result = EndpointResult()
+        for number in range(self.warmup + self.requests):
+            method, path, payload = build(data, rng)
+            started = time.perf_counter()
+            with instrumentation.measure() as stats:
+                if method == 'get':
+                    response = client.get(path, payload)
+                else:
+                    response = getattr(client, method)(path, json.dumps(payload), content_type='application/json')
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                response.close()
+            elapsed = time.perf_counter() - started
+            if number < self.warmup:
+                continue
+            success = response.status_code in ok
+            latency.observe(name, elapsed, success)
+            result.requests += 1
+            result.errors += not success
+            result.seconds += elapsed
+            result.queries += stats.queries
+            result.db_time += stats.db_time
+            result.statuses[response.status_code] = result.statuses.get(response.status_code, 0) + 1
+        return result
+
+    def report(self, results, latency):
+        percentiles = latency.snapshot()
+        endpoints = {}
+        for name, result in results.items():
+            endpoints[name] = {
+                'requests': result.requests,
+                'errors': result.errors,
+                'rps': round(result.requests / result.seconds, 1) if result.seconds else 0.0,
+                **{key: value for key, value in percentiles.get(name, {}).items() if key.endswith('_ms')},
+                'queries': round(result.queries / max(result.requests, 1), 2),
+                'db_ms': round(result.db_time * 1000 / max(result.requests, 1), 2),
+                'statuses': {str(status): count for status, count in sorted(result.statuses.items())},
+            }
+        return {
+            'meta': {
+                'seed': self.seed,
+                'requests': self.requests,
+                'warmup': self.warmup,
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'endpoints': endpoints,
+        }
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Endpoints that got worse than the baseline: p95 latency up, or throughput
+    down, by more than `threshold` (a fraction), or more than half a query
+    more per request. Returns a list of (endpoint, message).
+    """
+    regressions = []
+    for name, current in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if before is None:
+            continue
+        if before['p95_ms'] and current['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append((name, f"p95 {before['p95_ms']}ms -> {current['p95_ms']}ms"))
+        if before['rps'] and current['rps'] < before['rps'] * (1 - threshold):
+            regressions.append((name, f"throughput {before['rps']} -> {current['rps']} req/s"))
+        if current['queries'] > before['queries'] + 0.5:
+            regressions.append((name, f"queries per request {before['queries']} -> {current['queries']}"))
+        if current['errors'] > before['errors']:
+            regressions.append((name, f"errors {before['errors']} -> {current['errors']}"))
+    return regressions
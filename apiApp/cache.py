@@ -0,0 +1,240 @@
+"""
+Response cache for the catalog endpoints.
+
+Serialized payloads are stored under versioned keys: a key embeds the current
+version of every namespace the payload depends on ("catalog", "featured",
+"product:<slug>", ...). Writes bump the namespaces they affect once they
+commit (see signals.py), so outdated entries are never read again and
+simply expire.
+
+The versions only reach every process through a shared cache backend (Redis
+with REDIS_URL, see settings.py). With the default local-memory cache each
+process keeps its own versions, and a bump made by another worker or by a
+management command (import_catalog, seed) is never seen; entries then default
+to a short timeout so they can't stay stale for long.
+
+Reads go through get_or_compute(), which keeps a hot key from stampeding the
+database when it expires:
+
+* single flight: concurrent misses in a worker share one computation, and a
+  lock in the cache keeps other workers from recomputing at the same time;
+* probabilistic early refresh (XFetch): the closer an entry is to expiry,
+  and the longer it took to compute, the likelier a read refreshes it early;
+* stale-while-revalidate: entries are kept for a grace period after expiry
+  and served to everyone except the one caller refreshing them.
+"""
+import hashlib
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from rest_framework.response import Response
+
+from .pagination import wants_stream
+
+# Bumped for bulk changes that touch everything (imports, seeding)
+GLOBAL_NAMESPACE = 'catalog'
+
+
+def is_shared(alias='default'):
+    """Whether every process sees the same cache, i.e. it is not kept in process memory."""
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+def cache_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300 if is_shared() else 15)
+
+
+def stale_timeout():
+    """How long an expired entry may still be served while it is recomputed."""
+    return getattr(settings, 'CATALOG_CACHE_STALE_TIMEOUT', 60 if is_shared() else 5)
+
+
+# How long a worker may hold the recompute lock of a key, and how often
+# others check whether it finished
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+_MISSING = object()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _single_flight(key, compute, fallback=_MISSING):
+    """
+    Run ``compute`` once per key at a time in this process. Other callers wait
+    for its result, or return ``fallback`` straight away when one is given.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        if fallback is not _MISSING:
+            return fallback
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+    try:
+        flight.value = compute()
+        return flight.value
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _store(key, compute, timeout, stale):
+    started = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - started
+    cache.set(key, (value, delta, time.time() + timeout), timeout + stale)
+    return value
+
+
+def _refresh(key, compute, timeout, stale, fallback):
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            return _store(key, compute, timeout, stale)
+        finally:
+            cache.delete(lock_key)
+    if fallback is not _MISSING:
+        # Another worker is refreshing it
+        return fallback
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        found = cache.get_many([key, lock_key])
+        if key in found:
+            return found[key][0]
+        if lock_key not in found:
+            # Released without storing anything: the compute failed or its
+            # result can't be cached, so there is nothing to wait for
+            break
+    # Or the other worker died or is too slow, don't wait any longer
+    return _store(key, compute, timeout, stale)
+
+
+def get_or_compute(key, compute, timeout=None, stale=None, beta=1.0):
+    """
+    Return the cached value of ``key``, computing it with ``compute()`` when it
+    is missing, expired or picked for early refresh. ``beta`` above 1 favours
+    earlier refreshes.
+    """
+    timeout = cache_timeout() if timeout is None else timeout
+    stale = stale_timeout() if stale is None else stale
+    entry = cache.get(key)
+    fallback = _MISSING
+    if entry is not None:
+        value, delta, expires_at = entry
+        # log(random()) is negative: each read moves "now" forward by a random
+        # multiple of the compute time, so slow entries get refreshed sooner
+        if time.time() - delta * beta * math.log(1.0 - random.random()) < expires_at:
+            return value
+        fallback = value
+    return _single_flight(
+        key, lambda: _refresh(key, compute, timeout, stale, fallback), fallback
+    )
+
+
+def _version_key(namespace):
+    return f'catalog:version:{namespace}'
+
+
+def _fresh_version():
+    # Time based, so a version key lost to eviction can't come back at an old value
+    return time.time_ns()
+
+
+def get_versions(namespaces):
+    keys = [_version_key(ns) for ns in namespaces]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _fresh_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(*namespaces):
+    """Invalidate every cached payload that depends on one of ``namespaces``."""
+    for namespace in namespaces:
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), timeout=None)
+
+
+def bump_on_commit(*namespaces):
+    """
+    bump() once the surrounding transaction commits. Bumping earlier lets a
+    concurrent read cache the pre-commit data under the new version.
+    """
+    transaction.on_commit(lambda: bump(*namespaces))
+
+
+def invalidate_catalog():
+    bump(GLOBAL_NAMESPACE)
+
+
+def response_cache_key(name, namespaces, request):
+    namespaces = (GLOBAL_NAMESPACE, *namespaces)
+    versions = '.'.join(str(v) for v in get_versions(namespaces))
+    # Scheme and host too: the payloads hold absolute image URLs built from them
+    url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'catalog:response:{name}:{versions}:{url}'
+
+
+class _Uncacheable(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class CachedResponseMixin:
+    """
+    Caches the data of successful GET responses through get_or_compute().
+    Views list the namespaces they depend on in get_cache_namespaces().
+    """
+
+    def get_cache_namespaces(self):
+        return ()
+
+    def get(self, request, *args, **kwargs):
+        if wants_stream(request):
+            return super().get(request, *args, **kwargs)
+
+        def compute():
+            response = super(CachedResponseMixin, self).get(request, *args, **kwargs)
+            if response.status_code != 200:
+                raise _Uncacheable(response)
+            return response.data
+
+        key = response_cache_key(type(self).__name__, self.get_cache_namespaces(), request)
+        try:
+            data = get_or_compute(key, compute)
+        except _Uncacheable as error:
+            # Callers that waited on the same flight share the response, give each its own copy
+            return Response(error.response.data, status=error.response.status_code)
+        return Response(data)
@@ -0,0 +1,286 @@
+"""
+Cart mutations.
+
+Quantities are only ever changed inside the database (``UPDATE ... SET
+quantity = quantity + n`` or ``INSERT ... ON CONFLICT DO UPDATE``), so
+concurrent add-to-cart clicks can't overwrite each other's increments.
+
+Every mutation also adjusts the cart's num_of_items and cart_total counters
+in the same transaction, the same way, so the cart badge never has to look
+at the items. reconcile_counters() recomputes them from the items.
+
+Carts left alone for CART_RETENTION_DAYS are deleted by purge_abandoned().
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .membership import MAX_PRODUCTS, forget_carts
+from .models import Cart, CartItem, Product
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+# Most operations one apply_operations() call may take, as many as a product grid has
+MAX_OPERATIONS = MAX_PRODUCTS
+
+
+def upsert_cart(cart_code):
+    """
+    Create the cart for ``cart_code`` or touch its ``updated_at``.
+    Returns the cart id. One statement, which also locks the cart row
+    until the surrounding transaction ends. Callers go on to change the
+    items, so the cart's cached product ids are dropped.
+    """
+    forget_carts(cart_code)
+    cart = Cart(cart_code=cart_code, updated_at=timezone.now())
+    Cart.objects.bulk_create(
+        [cart],
+        update_conflicts=True,
+        unique_fields=['cart_code'],
+        update_fields=['updated_at'],
+    )
+    return cart.pk
+
+
+def add_item(cart_id, product_id, quantity=1):
+    """
+    Add ``quantity`` of a product to a cart in a single statement, then
+    count it on the cart. Call inside a transaction.
+
+    The row is inserted if the product is not in the cart yet, otherwise its
+    quantity is incremented. Returns ``(item_id, quantity, created)``, or
+    ``None`` when the product does not exist.
+    """
+    item_table = connection.ops.quote_name(CartItem._meta.db_table)
+    product_table = connection.ops.quote_name(Product._meta.db_table)
+    postgres = connection.vendor == 'postgresql'
+    existed = None
+    if not postgres:
+        # No xmax to tell an insert from an update; the write lock taken by
+        # upsert_cart() keeps this answer true until the INSERT below
+        existed = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).exists()
+    sql = (
+        f"INSERT INTO {item_table} (cart_id, product_id, quantity) "
+        f"SELECT %s, id, %s FROM {product_table} WHERE id = %s "
+        f"ON CONFLICT (cart_id, product_id) "
+        f"DO UPDATE SET quantity = {item_table}.quantity + EXCLUDED.quantity "
+        f"RETURNING id, quantity{', (xmax = 0)' if postgres else ''}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [cart_id, quantity, product_id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    item_id, new_quantity = row[:2]
+    # xmax is 0 on a row version written by an INSERT
+    created = row[2] if postgres else not existed
+    adjust_counters(Cart.objects.filter(pk=cart_id), quantity, _price_of(product_id) * quantity)
+    return item_id, new_quantity, created
+
+
+def adjust_counters(carts, quantity, amount):
+    """
+    Add ``quantity`` items worth ``amount`` to the counters of ``carts`` and
+    bump updated_at, which the cart ETags are derived from. ``amount`` may be
+    an expression, e.g. a price subquery times the quantity.
+    """
+    carts.update(
+        num_of_items=F('num_of_items') + quantity,
+        cart_total=F('cart_total') + amount,
+        updated_at=timezone.now(),
+    )
+
+
+def _price_of(product_id):
+    return Subquery(Product.objects.filter(pk=product_id).values('price')[:1], output_field=MONEY)
+
+
+def increment_item(item_id, delta):
+    """
+    Atomically add ``delta`` (may be negative) to a cart item's quantity.
+    An item that reaches zero or less is deleted, as in apply_operations().
+    Returns the new quantity (0 once deleted), or None when the item does
+    not exist.
+    """
+    with transaction.atomic():
+        # Locked so the deletion decision and the counters see the same quantity
+        row = (
+            CartItem.objects.select_for_update(of=('self',)).filter(pk=item_id)
+            .values_list('cart_id', 'quantity', 'product__price', 'cart__cart_code').first()
+        )
+        if row is None:
+            return None
+        cart_id, quantity, price, cart_code = row
+        if quantity + delta > 0:
+            CartItem.objects.filter(pk=item_id).update(quantity=F('quantity') + delta)
+            change = delta
+        else:
+            forget_carts(cart_code)
+            CartItem.objects.filter(pk=item_id).delete()
+            # A deleted item gives back what it held
+            change = -quantity
+        adjust_counters(Cart.objects.filter(pk=cart_id), change, price * change)
+    return quantity + change
+
+
+def remove_item(item):
+    with transaction.atomic():
+        # Locked so a concurrent increment is either counted here or not at all
+        row = (
+            CartItem.objects.select_for_update(of=('self',)).filter(pk=item.pk)
+            .values_list('cart_id', 'quantity', 'product__price', 'cart__cart_code').first()
+        )
+        if row is None:
+            return
+        cart_id, quantity, price, cart_code = row
+        forget_carts(cart_code)
+        adjust_counters(Cart.objects.filter(pk=cart_id), -quantity, -(price * quantity))
+        CartItem.objects.filter(pk=item.pk).delete()
+
+
+def apply_operations(cart_code, deltas):
+    """
+    Apply several quantity changes to one cart in a single transaction.
+
+    ``deltas`` maps product ids to the quantity to add (negative to remove).
+    Items that reach zero or less are deleted. The products must already have
+    been validated by the caller. Returns the cart id.
+    """
+    with transaction.atomic():
+        cart_id = upsert_cart(cart_code)
+        existing = {
+            item.product_id: item
+            for item in CartItem.objects.select_for_update().filter(cart_id=cart_id, product_id__in=deltas)
+        }
+        to_create, to_update, to_delete = [], [], []
+        for product_id, delta in deltas.items():
+            item = existing.get(product_id)
+            if item is None:
+                if delta > 0:
+                    to_create.append(CartItem(cart_id=cart_id, product_id=product_id, quantity=delta))
+                continue
+            item.quantity += delta
+            if item.quantity > 0:
+                to_update.append(item)
+            else:
+                to_delete.append(item.pk)
+
+        CartItem.objects.bulk_create(to_create)
+        CartItem.objects.bulk_update(to_update, ['quantity'])
+        if to_delete:
+            CartItem.objects.filter(pk__in=to_delete).delete()
+
+        # Net quantity change per product; a deleted item gives back what it held
+        changes = {item.product_id: item.quantity for item in to_create}
+        for product_id, item in existing.items():
+            changes[product_id] = deltas[product_id] if item.quantity > 0 else deltas[product_id] - item.quantity
+        if changes:
+            prices = dict(Product.objects.filter(pk__in=changes).values_list('id', 'price'))
+            adjust_counters(
+                Cart.objects.filter(pk=cart_id),
+                sum(changes.values()),
+                sum(prices[product_id] * change for product_id, change in changes.items()),
+            )
+    return cart_id
+
+
+def _counter_expressions():
+    """The counters of the outer cart, computed from its items."""
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    quantity = items.annotate(quantity=Sum('quantity')).values('quantity')
+    total = items.annotate(total=Sum(F('quantity') * F('product__price'), output_field=MONEY)).values('total')
+    return {
+        'num_of_items': Coalesce(Subquery(quantity), 0),
+        'cart_total': Coalesce(Subquery(total, output_field=MONEY), Value(0, output_field=MONEY)),
+    }
+
+
+def reconcile_counters(carts=None, batch_size=1000, dry_run=False):
+    """
+    Recompute the counters of ``carts`` (default: every cart) from their
+    items, a batch of ids at a time. Returns (checked, drifted).
+    """
+    carts = Cart.objects.all() if carts is None else carts
+    expressions = _counter_expressions()
+    checked = drifted = 0
+    last_id = 0
+    while True:
+        ids = list(carts.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        checked += len(ids)
+        with transaction.atomic():
+            wrong = list(
+                Cart.objects.filter(pk__in=ids)
+                .annotate(actual_items=expressions['num_of_items'], actual_total=expressions['cart_total'])
+                .exclude(num_of_items=F('actual_items'), cart_total=F('actual_total'))
+                .values_list('pk', flat=True)
+            )
+            drifted += len(wrong)
+            if wrong and not dry_run:
+                # Recomputed in the UPDATE itself, so changes since the check are included.
+                # updated_at moves too: the cart ETags are derived from it
+                Cart.objects.filter(pk__in=wrong).update(**expressions, updated_at=timezone.now())
+    return checked, drifted
+
+
+def retention_days():
+    return getattr(settings, 'CART_RETENTION_DAYS', 30)
+
+
+def purge_abandoned(days=None, batch_size=500, pause=0.1, max_batches=None, dry_run=False):
+    """
+    Delete carts nobody has touched for ``days`` (CART_RETENTION_DAYS) with
+    their items, ``batch_size`` carts per short transaction and ``pause``
+    seconds between transactions, oldest first along the updated_at index.
+
+    Each batch re-checks updated_at under the row locks and skips carts locked
+    by a running add-to-cart, so a cart touched since it was picked survives.
+    Returns {'carts', 'items', 'batches', 'seconds'}.
+    """
+    days = retention_days() if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    abandoned = Cart.objects.filter(updated_at__lt=cutoff)
+    started = time.monotonic()
+    stats = {'carts': 0, 'items': 0, 'batches': 0}
+
+    if dry_run:
+        stats['carts'] = abandoned.count()
+        stats['items'] = CartItem.objects.filter(cart__updated_at__lt=cutoff).count()
+    last = None
+    while not dry_run and (max_batches is None or stats['batches'] < max_batches):
+        candidates = abandoned.order_by('updated_at', 'id')
+        if last is not None:
+            # Keyset pagination: never rescan the rows already handled or skipped
+            candidates = candidates.filter(
+                Q(updated_at__gt=last[0]) | Q(updated_at=last[0], id__gt=last[1])
+            )
+        rows = list(candidates.values_list('updated_at', 'id', 'cart_code')[:batch_size])
+        if not rows:
+            break
+        last = rows[-1][:2]
+        with transaction.atomic():
+            ids = list(
+                Cart.objects.select_for_update(skip_locked=True)
+                .filter(pk__in=[row[1] for row in rows], updated_at__lt=cutoff)
+                .values_list('id', flat=True)
+            )
+            if ids:
+                locked = set(ids)
+                forget_carts(*[code for _, pk, code in rows if pk in locked])
+                # Items first, as one plain DELETE; then the carts have nothing left to cascade to
+                stats['items'] += CartItem.objects.filter(cart_id__in=ids).delete()[0]
+                stats['carts'] += Cart.objects.filter(pk__in=ids).delete()[1].get(Cart._meta.label, 0)
+        stats['batches'] += 1
+        if len(rows) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return stats
@@ -0,0 +1,309 @@
+"""
+Catalog import and export, CSV or JSON lines (`manage.py import_catalog`,
+`manage.py export_catalog`).
+
+A catalog row is: slug, name, description, category, price, featured, image.
+The category is a category slug or name; on import unknown ones are created.
+
+Import streams its input in chunks of `batch_size` rows. Each chunk is
+upserted on slug with one bulk INSERT ... ON CONFLICT for the products it
+changes, against a map of the categories preloaded once. Rows identical to
+the stored product are skipped, so a nightly sync of an unchanged catalog
+writes nothing. Rows without a slug are new products and get one from
+slugs.allocate_many(). Bad rows, including the ones whose description
+(unique) another product already has, are reported and skipped.
+
+bulk_create skips save() and the model signals, so after each chunk the
+importer does their work for the changed products in bulk. It refreshes
+their search vectors, records them for the autocomplete indexes, queues the
+cart reprice, Stripe price and image jobs the signals would have queued, and
+invalidates the response cache once at the end.
+
+Export walks the products with .iterator(), so memory stays flat whatever
+the catalog size.
+"""
+import csv
+import json
+import time
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+from .autocomplete import record_changes
+from .cache import invalidate_catalog
+from .jobs import enqueue_on_commit
+from .models import CartItem, Product, ProductCategory, StripePrice
+from .search import refresh_search_vectors
+from .slugs import allocate_many
+from .tasks import warm_cache_soon
+
+FIELDS = ['slug', 'name', 'description', 'category', 'price', 'featured', 'image']
+
+FORMATS = ('csv', 'jsonl')
+
+# Product columns an import writes, in the order rows are compared
+PRODUCT_FIELDS = ['name', 'description', 'category_id', 'price', 'featured', 'image']
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Rows of a CSV (with a header line) or JSON lines stream, as dicts, one at a time."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_rows(stream, fmt, rows):
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        return
+    for row in rows:
+        stream.write(json.dumps(row) + '\n')
+
+
+def export_rows(batch_size=2000):
+    """Every product as a catalog row, ordered by id, read `batch_size` rows at a time."""
+    products = Product.objects.order_by('id').values_list(
+        'slug', 'name', 'description', 'category__slug', 'price', 'featured', 'image',
+    )
+    for slug, name, description, category, price, featured, image in products.iterator(chunk_size=batch_size):
+        yield {
+            'slug': slug,
+            'name': name,
+            'description': description,
+            'category': category or '',
+            'price': str(price),
+            'featured': featured,
+            'image': image or '',
+        }
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportFailed(Exception):
+    """A chunk was rolled back; the chunks before it are imported."""
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'y', 't')
+
+
+def parse_row(row):
+    """(slug, {product field: value}, category key) of one input row, or RowError."""
+    name = (row.get('name') or '').strip()
+    if not name:
+        raise RowError("name is required")
+    try:
+        price = Decimal(str(row.get('price', '')).strip()).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise RowError(f"invalid price {row.get('price')!r}")
+    if price < 0:
+        raise RowError(f"invalid price {row.get('price')!r}")
+    values = {
+        'name': name[:Product._meta.get_field('name').max_length],
+        'description': (row.get('description') or '').strip(),
+        'price': price,
+        'featured': _parse_bool(row.get('featured')),
+        'image': (row.get('image') or '').strip(),
+    }
+    return (row.get('slug') or '').strip(), values, (row.get('category') or '').strip()
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    rejected: int = 0
+    categories: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class CatalogImporter:
+    def __init__(self, batch_size=1000, dry_run=False, log=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.log = log or (lambda message: None)
+        self.stats = ImportStats()
+        # Category slug and lower-cased name -> id, loaded once
+        self.categories = {}
+        # Lower-cased names of the categories a dry run would create
+        self.planned_categories = set()
+        for pk, slug, name in ProductCategory.objects.values_list('id', 'slug', 'name'):
+            self.categories.setdefault(slug, pk)
+            self.categories.setdefault(name.lower(), pk)
+
+    def run(self, rows):
+        started = time.monotonic()
+        rows = iter(rows)
+        line = 1
+        while True:
+            chunk = list(islice(rows, self.batch_size))
+            if not chunk:
+                break
+            self.import_chunk(chunk, first_line=line)
+            line += len(chunk)
+        if not self.dry_run and (self.stats.created or self.stats.updated or self.stats.categories):
+            invalidate_catalog()
+            warm_cache_soon()
+        self.stats.seconds = time.monotonic() - started
+        return self.stats
+
+    def import_chunk(self, chunk, first_line):
+        self.stats.rows += len(chunk)
+        parsed = {}
+        lines = {}
+        unslugged = []
+        for number, row in enumerate(chunk, first_line):
+            try:
+                slug, values, category = parse_row(row)
+            except RowError as e:
+                self.reject(number, e)
+                continue
+            values['category'] = category
+            if slug:
+                # The last row wins when a slug repeats within the chunk
+                parsed[slug] = values
+                lines[slug] = number
+            else:
+                unslugged.append((number, values))
+        names = [values['name'] for _, values in unslugged]
+        for slug, (number, values) in zip(allocate_many(Product, names), unslugged):
+            parsed[slug] = values
+            lines[slug] = number
+        self.reject_duplicate_descriptions(parsed, lines)
+
+        try:
+            with transaction.atomic():
+                self.upsert_chunk(parsed)
+        except IntegrityError as e:
+            raise ImportFailed(f"Rows {first_line}-{first_line + len(chunk) - 1}: {e}") from e
+
+    def reject(self, number, error):
+        self.stats.rejected += 1
+        self.log(f"Row {number}: {error}")
+
+    def reject_duplicate_descriptions(self, parsed, lines):
+        """
+        Drop the rows whose description (unique, blank included) another row
+        of the chunk or another product already has, so one such row does not
+        roll back the whole chunk.
+        """
+        owners = {}
+        for slug in sorted(parsed, key=lines.get):
+            description = parsed[slug]['description']
+            if description in owners:
+                self.reject(lines[slug], f"description is the same as row {lines[owners[description]]}")
+                del parsed[slug]
+            else:
+                owners[description] = slug
+        # Held by another product, even one this chunk moves off it: the upsert checks row by row
+        taken = Product.objects.filter(description__in=owners).values_list('description', 'slug')
+        for description, other in taken:
+            slug = owners[description]
+            if other != slug:
+                self.reject(lines[slug], f"description is already used by product {other!r}")
+                del parsed[slug]
+
+    def upsert_chunk(self, parsed):
+        self.resolve_categories(parsed.values())
+        existing = {}
+        for slug, *row in Product.objects.filter(slug__in=parsed).values_list('slug', 'id', *PRODUCT_FIELDS):
+            existing[slug] = dict(zip(['id', *PRODUCT_FIELDS], row))
+            existing[slug]['image'] = existing[slug]['image'] or ''
+        changed = {}
+        for slug, values in parsed.items():
+            current = existing.get(slug)
+            if current is not None and all(current[field] == values[field] for field in PRODUCT_FIELDS):
+                self.stats.unchanged += 1
+                continue
+            if current is None:
+                self.stats.created += 1
+            else:
+                self.stats.updated += 1
+            changed[slug] = values
+        if changed and not self.dry_run:
+            self.upsert(changed, existing)
+
+    def _category_id(self, key):
+        if not key:
+            return None
+        return self.categories.get(key) or self.categories.get(key.lower())
+
+    def resolve_categories(self, rows):
+        """Set each row's category_id, creating the categories not seen yet."""
+        pending, missing = [], {}
+        for values in rows:
+            key = values.pop('category')
+            values['category_id'] = self._category_id(key)
+            if key and values['category_id'] is None:
+                pending.append((values, key))
+                if key.lower() not in self.planned_categories:
+                    missing.setdefault(key.lower(), key)
+        if not missing:
+            return
+        self.stats.categories += len(missing)
+        if self.dry_run:
+            self.planned_categories.update(missing)
+            return
+        names = list(missing.values())
+        created = ProductCategory.objects.bulk_create(
+            [ProductCategory(name=name, slug=slug) for name, slug in zip(names, allocate_many(ProductCategory, names))],
+            update_conflicts=True, unique_fields=['slug'], update_fields=['name'],
+        )
+        created = ProductCategory.objects.filter(slug__in=[category.slug for category in created])
+        for category in created:
+            self.categories[category.slug] = category.pk
+            self.categories[category.name.lower()] = category.pk
+        record_changes('category', [category.pk for category in created])
+        for values, key in pending:
+            values['category_id'] = self._category_id(key)
+
+    def upsert(self, changed, existing):
+        Product.objects.bulk_create(
+            [Product(slug=slug, **values) for slug, values in changed.items()],
+            update_conflicts=True,
+            unique_fields=['slug'],
+            update_fields=[*PRODUCT_FIELDS, 'updated_at'],
+        )
+        ids = dict(Product.objects.filter(slug__in=changed).values_list('slug', 'id'))
+        refresh_search_vectors(Product.objects.filter(pk__in=ids.values()))
+        record_changes('product', ids.values())
+
+        # The jobs the post_save signals queue for a changed price or a new image
+        repriced = [ids[slug] for slug, values in changed.items()
+                    if slug in existing and existing[slug]['price'] != values['price']]
+        in_carts = set(CartItem.objects.filter(product_id__in=repriced).values_list('product_id', flat=True).distinct())
+        mapped = set(StripePrice.objects.filter(product_id__in=repriced).values_list('product_id', flat=True))
+        for product_id in repriced:
+            if product_id in in_carts:
+                enqueue_on_commit('carts.reprice', {'product_id': product_id},
+                                  unique_key=f'carts.reprice:{product_id}')
+            if product_id in mapped:
+                enqueue_on_commit('stripe.sync_price', {'product_id': product_id},
+                                  unique_key=f'stripe.sync_price:{product_id}')
+        for slug, values in changed.items():
+            if values['image'] and values['image'] != existing.get(slug, {}).get('image'):
+                enqueue_on_commit('images.optimize', {'product_id': ids[slug]},
+                                  unique_key=f"images.optimize:{ids[slug]}")
@@ -0,0 +1,112 @@
+"""
+Stripe Checkout pricing.
+
+The cart's items, products and Stripe price mappings are loaded in one
+query, and every line references a Stripe Price by id with the quantity in
+the cart, instead of sending inline price_data for each product. A Price is
+created the first time a product is sold and again once its price changes
+(the mapping's unit_amount no longer matches). Stripe calls carry
+idempotency keys so two checkouts racing on a new price create it once.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+
+from . import payments
+from .models import Cart, CartItem, StripePrice
+
+CURRENCY = 'usd'
+
+# Flat fee added to every order, in cents
+VAT_FEE = 500
+
+
+class CheckoutError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def to_cents(amount):
+    return int((Decimal(amount) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def cart_items(cart_code):
+    """The cart's items with their products and price mappings, in one query."""
+    items = list(
+        CartItem.objects.filter(cart__cart_code=cart_code)
+        .select_related('product__stripe_price')
+        .order_by('id')
+    )
+    if not items:
+        if Cart.objects.filter(cart_code=cart_code).exists():
+            raise CheckoutError("Cart is empty")
+        raise CheckoutError("Cart not found", status=404)
+    return items
+
+
+def _mapping(product):
+    try:
+        return product.stripe_price
+    except StripePrice.DoesNotExist:
+        return None
+
+
+def sync_price(product, client):
+    """The Stripe price mapping for the product's current price, created in Stripe if needed."""
+    mapping = _mapping(product)
+    cents = to_cents(product.price)
+    if mapping is not None and mapping.unit_amount == cents and mapping.currency == CURRENCY:
+        return mapping
+    if mapping is not None:
+        stripe_product_id = mapping.stripe_product_id
+    else:
+        stripe_product_id = client.products.create(
+            params={'name': product.name, 'metadata': {'product_id': str(product.pk)}},
+            options={'idempotency_key': f'product-{product.pk}'},
+        ).id
+    price = client.prices.create(
+        params={'product': stripe_product_id, 'unit_amount': cents, 'currency': CURRENCY},
+        options={'idempotency_key': f'price-{product.pk}-{cents}-{CURRENCY}'},
+    )
+    mapping, _ = StripePrice.objects.update_or_create(
+        product=product,
+        defaults={
+            'stripe_product_id': stripe_product_id,
+            'stripe_price_id': price.id,
+            'unit_amount': cents,
+            'currency': CURRENCY,
+        },
+    )
+    product.stripe_price = mapping
+    return mapping
+
+
+def build_line_items(items, client):
+    lines = [
+        {'price': sync_price(item.product, client).stripe_price_id, 'quantity': item.quantity}
+        for item in items
+    ]
+    lines.append({
+        'price_data': {
+            'currency': CURRENCY,
+            'product_data': {'name': 'VAT Fee'},
+            'unit_amount': VAT_FEE,
+        },
+        'quantity': 1,
+    })
+    return lines
+
+
+def create_session(cart_code, email, client=None):
+    client = client or payments.client()
+    line_items = build_line_items(cart_items(cart_code), client)
+    return client.checkout.sessions.create(params={
+        'customer_email': email,
+        'payment_method_types': ['card'],
+        'line_items': line_items,
+        'mode': 'payment',
+        'success_url': getattr(settings, 'CHECKOUT_SUCCESS_URL', 'http://localhost:3000/profile'),
+        'cancel_url': getattr(settings, 'CHECKOUT_CANCEL_URL', 'http://localhost:3000/'),
+        'metadata': {'cart_code': cart_code},
+    })
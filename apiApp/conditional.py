@@ -0,0 +1,109 @@
+"""
+Validators for conditional GETs (used with django.views.decorators.http.condition).
+
+Each endpoint's ETag and Last-Modified come from one indexed lookup, so a
+client polling with If-None-Match / If-Modified-Since gets a 304 without the
+serializers or the item queries running. The lookup is memoized on the
+request because condition() asks for the ETag and Last-Modified separately.
+
+The ETag is the primary validator: it carries updated_at to the microsecond,
+and condition() ignores If-Modified-Since when If-None-Match is sent.
+Last-Modified only has one-second resolution, so it is left out while the
+record changed within the last second. A second write in that same second
+would otherwise get a 304 from a client sending only If-Modified-Since.
+"""
+from datetime import timedelta
+
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Cart, Product
+
+
+def _memoized(request, name, lookup):
+    cache = request.__dict__.setdefault('_validators', {})
+    if name not in cache:
+        cache[name] = lookup()
+    return cache[name]
+
+
+def _cart_code(request, kwargs):
+    return kwargs.get('cart_code') or request.GET.get('cart_code')
+
+
+def _cart_state(request, **kwargs):
+    """(cart id, updated_at, newest product change) of the cart with its items."""
+    cart_code = _cart_code(request, kwargs)
+    return _memoized(request, 'cart', lambda: (
+        Cart.objects.filter(cart_code=cart_code)
+        .annotate(products_updated_at=Max('cartitems__product__updated_at'))
+        .values_list('id', 'updated_at', 'products_updated_at')
+        .first()
+    ))
+
+
+def cart_stat(request, **kwargs):
+    """
+    The cart row with its counters, for the cart badge. The view serializes
+    the same row the validators looked at, so a 200 is one query too.
+    """
+    cart_code = _cart_code(request, kwargs)
+    return _memoized(request, 'cart_stat', lambda: (
+        Cart.objects.only('id', 'cart_code', 'updated_at', 'num_of_items', 'cart_total')
+        .filter(cart_code=cart_code).first()
+    ))
+
+
+def _cart_stat_state(request, **kwargs):
+    """(cart id, updated_at) without touching the items."""
+    cart = cart_stat(request, **kwargs)
+    return None if cart is None else (cart.id, cart.updated_at)
+
+
+def _product_state(request, slug=None, **kwargs):
+    return _memoized(request, 'product', lambda: (
+        Product.objects.filter(slug=slug).values_list('id', 'updated_at').first()
+    ))
+
+
+def _etag(prefix, state):
+    if state is None:
+        return None
+    return '-'.join([prefix] + [str(value.timestamp() if hasattr(value, 'timestamp') else value) for value in state])
+
+
+# Resolution of the HTTP date in Last-Modified / If-Modified-Since
+HTTP_DATE_RESOLUTION = timedelta(seconds=1)
+
+
+def _last_modified(state):
+    if state is None:
+        return None
+    modified = max(value for value in state[1:] if value is not None)
+    if timezone.now() - modified < HTTP_DATE_RESOLUTION:
+        return None
+    return modified
+
+
+def cart_etag(request, *args, **kwargs):
+    return _etag('cart', _cart_state(request, **kwargs))
+
+
+def cart_last_modified(request, *args, **kwargs):
+    return _last_modified(_cart_state(request, **kwargs))
+
+
+def cart_stat_etag(request, *args, **kwargs):
+    return _etag('cart-stat', _cart_stat_state(request, **kwargs))
+
+
+def cart_stat_last_modified(request, *args, **kwargs):
+    return _last_modified(_cart_stat_state(request, **kwargs))
+
+
+def product_etag(request, *args, **kwargs):
+    return _etag('product', _product_state(request, **kwargs))
+
+
+def product_last_modified(request, *args, **kwargs):
+    return _last_modified(_product_state(request, **kwargs))
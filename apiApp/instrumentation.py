@@ -0,0 +1,183 @@
+"""
+Per-request SQL instrumentation, for finding N+1 queries on purpose.
+
+QueryInstrumentationMiddleware is opt-in (QUERY_INSTRUMENTATION=1 puts it in
+MIDDLEWARE). For every request it counts the queries and their total time,
+groups queries that differ only in their parameters to spot repeats, and
+times the serializers. The figures go out as a Server-Timing header, which
+browser dev tools show next to the request, and as one JSON log line on the
+"apiApp.instrumentation" logger.
+
+QUERY_BUDGETS maps URL names (see urls.py) to the most queries a request to
+that URL should run; QUERY_BUDGET_DEFAULT applies to the rest. A request
+over its budget is logged as a warning.
+
+Streamed responses run most of their queries while the body is sent, after
+the headers are out; their log line is written once the stream is closed.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('query_stats', default=None)
+
+# Literals and IN lists vary between otherwise identical queries
+_IN_LIST_RE = re.compile(r'\bIN \((?:%s(?:, )?)+\)')
+_NUMBER_RE = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    return _NUMBER_RE.sub('N', _IN_LIST_RE.sub('IN (...)', sql))
+
+
+class QueryStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+        self.patterns = Counter()
+
+    def record(self, sql, seconds):
+        self.queries += 1
+        self.db_time += seconds
+        self.patterns[fingerprint(sql)] += 1
+
+    def repeated(self):
+        """(pattern, count) of the queries run more than once, most repeated first."""
+        return [(sql, count) for sql, count in self.patterns.most_common() if count > 1]
+
+    def server_timing(self, total):
+        repeats = sum(count - 1 for _, count in self.repeated())
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries, {repeats} repeated"',
+            f'serializer;dur={self.serializer_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record(sql, time.perf_counter() - started)
+
+
+def _wrap_connection(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _timed(data):
+    def timed_data(self):
+        stats = _current.get()
+        # Only the outermost serializer counts, nested ones are part of its time
+        if stats is None or stats.serializing:
+            return data.fget(self)
+        stats.serializing = True
+        started = time.perf_counter()
+        try:
+            return data.fget(self)
+        finally:
+            stats.serializing = False
+            stats.serializer_time += time.perf_counter() - started
+    timed_data.instrumented = True
+    return property(timed_data)
+
+
+_installed = False
+
+
+def install():
+    """Hook the query counter into every connection and the timer into serializer.data, once."""
+    global _installed
+    if _installed:
+        return
+    connection_created.connect(_wrap_connection, dispatch_uid='apiApp.instrumentation')
+    for connection in connections.all(initialized_only=True):
+        _wrap_connection(connection)
+    for cls in (serializers.BaseSerializer, serializers.Serializer, serializers.ListSerializer):
+        if not getattr(cls.data.fget, 'instrumented', False):
+            cls.data = _timed(cls.data)
+    _installed = True
+
+
+@contextmanager
+def measure():
+    """QueryStats of the code run in the block, outside the middleware (see benchmark.py)."""
+    install()
+    stats = QueryStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def query_budget(url_name):
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    return budgets.get(url_name, getattr(settings, 'QUERY_BUDGET_DEFAULT', None))
+
+
+class QueryInstrumentationMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install()
+
+    def __call__(self, request):
+        stats = QueryStats()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+            response['Server-Timing'] = stats.server_timing(time.perf_counter() - stats.started)
+        except BaseException:
+            _current.reset(token)
+            raise
+        if response.streaming:
+            # Keep counting while the body is generated; log when the server closes it
+            response._resource_closers.append(lambda: self.finish(request, response, stats, token))
+        else:
+            self.finish(request, response, stats, token)
+        return response
+
+    def finish(self, request, response, stats, token):
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Closed from another context than the one the request ran in
+            _current.set(None)
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match else None
+        budget = query_budget(url_name)
+        over_budget = budget is not None and stats.queries > budget
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'url_name': url_name,
+            'status': response.status_code,
+            'queries': stats.queries,
+            'db_ms': round(stats.db_time * 1000, 1),
+            'serializer_ms': round(stats.serializer_time * 1000, 1),
+            'total_ms': round((time.perf_counter() - stats.started) * 1000, 1),
+            'repeated': [{'sql': sql[:200], 'count': count} for sql, count in stats.repeated()[:5]],
+            'budget': budget,
+            'over_budget': over_budget,
+        }
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps(fields),
+                   extra={'query_stats': fields})
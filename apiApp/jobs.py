@@ -0,0 +1,204 @@
+"""
+Database-backed background jobs.
+
+Work that should not hold up a request is queued with enqueue() and run by
+`manage.py runworkers`, which forks worker processes that claim jobs with
+``SELECT ... FOR UPDATE SKIP LOCKED``. Higher priority jobs are claimed first,
+jobs with a future run_at wait until then, failures are retried with backoff
+and jobs that keep failing are parked as "Dead". Finished jobs are deleted so
+the table only holds outstanding work.
+
+Tasks are plain functions registered with @task (see apiApp/tasks.py) and
+called with the JSON kwargs they were queued with. Tasks registered with
+``every`` are recurring: runworkers queues them with schedule(), and each run,
+once finished or dead, queues the next one.
+"""
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+from .webhooks import retry_delay
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(name, max_attempts=5, every=None):
+    """
+    Register a function as a job task under ``name``. With ``every`` (seconds)
+    it also runs on its own at that interval, see schedule().
+    """
+    def register(func):
+        func.task_name = name
+        func.max_attempts = max_attempts
+        func.every = every
+        registry[name] = func
+        return func
+    return register
+
+
+def interval(name):
+    """Seconds between runs of a recurring task; JOB_INTERVALS overrides them, 0 turns one off."""
+    return getattr(settings, 'JOB_INTERVALS', {}).get(name, registry[name].every)
+
+
+def schedule():
+    """
+    Queue the next run of every recurring task, one interval out, unless one
+    is already pending. Returns the names of the tasks queued.
+    """
+    return [name for name in registry if _schedule_next(name)]
+
+
+def _schedule_next(name):
+    every = interval(name) if name in registry else None
+    # Keyed on the task, so restarts and concurrent runs keep a single pending run
+    return bool(every) and enqueue(name, delay=every, unique_key=name)
+
+
+def lease():
+    """A claimed job is handed to another worker if it is not finished by then."""
+    return timedelta(seconds=getattr(settings, 'JOB_LEASE_SECONDS', 600))
+
+
+def enqueue(name, kwargs=None, priority=0, delay=None, run_at=None, unique_key=None):
+    """
+    Queue ``name`` to run with ``kwargs``, after ``delay`` (a timedelta or
+    seconds) or at ``run_at``. With a ``unique_key`` the job is dropped while
+    another pending job has the same key; returns False in that case.
+    """
+    if name not in registry:
+        raise KeyError(f"Unknown task {name!r}")
+    if run_at is None:
+        run_at = timezone.now()
+        if delay:
+            run_at += delay if isinstance(delay, timedelta) else timedelta(seconds=delay)
+    job = Job(task=name, kwargs=kwargs or {}, priority=priority, run_at=run_at,
+              max_attempts=registry[name].max_attempts, unique_key=unique_key)
+    try:
+        # The partial unique index on pending keys rejects duplicates
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        if unique_key is None:
+            raise
+        return False
+    return True
+
+
+def enqueue_on_commit(name, kwargs=None, **options):
+    """enqueue() once the surrounding transaction commits, so workers see its writes."""
+    transaction.on_commit(lambda: enqueue(name, kwargs, **options))
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim(limit=1, worker=''):
+    """Lease up to ``limit`` due jobs to this worker, highest priority first."""
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status="Pending", run_at__lte=now)
+                # Leases of workers that died mid-job
+                | Q(status="Running", locked_until__lt=now)
+            )
+            .order_by('-priority', 'run_at', 'id')[:limit]
+        )
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status="Running", locked_by=worker, locked_until=now + lease(), attempts=F('attempts') + 1
+        )
+    for job in jobs:
+        job.attempts += 1
+    return jobs
+
+
+@dataclass
+class Result:
+    task: str
+    status: str
+    seconds: float  # time spent running the task
+    waited: float  # time between run_at and the job being picked up
+
+
+def execute(job, started=None):
+    """Run one claimed job and record the outcome."""
+    started = started or timezone.now()
+    clock = time.monotonic()
+    try:
+        func = registry.get(job.task)
+        if func is None:
+            raise KeyError(f"Unknown task {job.task!r}")
+        func(**job.kwargs)
+    except Exception as error:
+        logger.exception("Job %s #%s failed (attempt %s)", job.task, job.pk, job.attempts)
+        if job.attempts >= job.max_attempts:
+            status, run_at = "Dead", job.run_at
+        else:
+            status, run_at = "Pending", timezone.now() + retry_delay(job.attempts)
+        try:
+            with transaction.atomic():
+                Job.objects.filter(pk=job.pk).update(
+                    status=status, run_at=run_at, locked_by='', locked_until=None, last_error=repr(error)
+                )
+        except IntegrityError:
+            # The same key was queued again while this ran; that pending job does the retry
+            Job.objects.filter(pk=job.pk).delete()
+    else:
+        status = "Done"
+        Job.objects.filter(pk=job.pk).delete()
+    if status != "Pending":
+        _schedule_next(job.task)
+    return Result(job.task, status, time.monotonic() - clock, (started - job.run_at).total_seconds())
+
+
+def work(limit=10, worker=''):
+    """Claim and run one batch. Returns a Result per job; empty when nothing was due."""
+    started = timezone.now()
+    return [execute(job, started) for job in claim(limit, worker)]
+
+
+@dataclass
+class Metrics:
+    """Throughput counters, per task, since the metrics were created."""
+    started: float = field(default_factory=time.monotonic)
+    counts: dict = field(default_factory=dict)  # (task, status) -> jobs
+    busy: dict = field(default_factory=dict)  # task -> seconds spent running
+    waited: float = 0.0
+
+    def record(self, result):
+        key = (result.task, result.status)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.busy[result.task] = self.busy.get(result.task, 0.0) + result.seconds
+        self.waited += max(result.waited, 0.0)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        total = self.total
+        lines = [
+            f"{total} jobs in {elapsed:.1f}s ({total / elapsed:.1f}/s), "
+            f"mean queue wait {self.waited / total if total else 0:.2f}s"
+        ]
+        for name in sorted(self.busy):
+            done = {status: count for (task_name, status), count in self.counts.items() if task_name == name}
+            runs = sum(done.values())
+            outcome = ', '.join(f"{count} {status.lower()}" for status, count in sorted(done.items()))
+            lines.append(f"  {name}: {outcome}, {self.busy[name] / runs * 1000:.1f}ms avg")
+        return '\n'.join(lines)
@@ -0,0 +1,71 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from apiApp.benchmark import ENDPOINTS, Benchmark, compare
+from apiApp.seeding import Seeder
+
+
+class Command(BaseCommand):
+    help = ("Seed a throwaway test database and benchmark the API endpoints in-process, "
+            "reporting throughput, latency percentiles and queries per request")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000, help="Products to seed (default 2000)")
+        parser.add_argument('--users', type=int, default=500, help="Customers to seed (default 500)")
+        parser.add_argument('--reviews', type=int, default=5000, help="Reviews to seed (default 5000)")
+        parser.add_argument('--carts', type=int, default=500, help="Carts to seed (default 500)")
+        parser.add_argument('--orders', type=int, default=1000, help="Orders to seed (default 1000)")
+        parser.add_argument('--seed', type=int, default=42, help="Seed of the data and the requests (default 42)")
+        parser.add_argument('--requests', type=int, default=200, help="Timed requests per endpoint (default 200)")
+        parser.add_argument('--warmup', type=int, default=20, help="Untimed requests per endpoint first (default 20)")
+        parser.add_argument('--endpoints', help=f"Comma separated URL names, default all: {', '.join(ENDPOINTS)}")
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help="Slowdown that counts as a regression, as a fraction (default 0.2)")
+
+    def handle(self, *args, seed, requests, warmup, endpoints, output, baseline, threshold, verbosity, **options):
+        try:
+            benchmark = Benchmark(endpoints.split(',') if endpoints else None, requests, warmup, seed)
+        except ValueError as e:
+            raise CommandError(e)
+        baseline_results = None
+        if baseline:
+            with open(baseline) as f:
+                baseline_results = json.load(f)
+
+        log = self.stdout.write if verbosity >= 2 else None
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            Seeder(seed=seed, log=log).run(
+                categories=16, products=options['products'], users=options['users'], reviews=options['reviews'],
+                carts=options['carts'], orders=options['orders'],
+            )
+            results = benchmark.run(log=log)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{'endpoint':<26}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+                          f"{'max ms':>9}{'queries':>9}{'errors':>8}")
+        for name, row in results['endpoints'].items():
+            self.stdout.write(f"{name:<26}{row['rps']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}"
+                              f"{row['max_ms']:>9}{row['queries']:>9}{row['errors']:>8}")
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Saved results to {output}")
+
+        if baseline_results is not None:
+            regressions = compare(results, baseline_results, threshold)
+            for name, message in regressions:
+                self.stderr.write(f"{name}: {message}")
+            if regressions:
+                raise CommandError(f"{len({name for name, _ in regressions})} endpoints regressed "
+                                   f"by more than {threshold:.0%}")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Benchmarked {len(results['endpoints'])} endpoints"))
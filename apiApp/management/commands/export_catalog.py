@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apiApp.catalog import FORMATS, detect_format, export_rows, write_rows
+
+
+class Command(BaseCommand):
+    help = "Write every product to a CSV or JSON lines catalog, streaming from the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Output file, or - for stdout")
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help="Output format (default from the file extension, csv for stdout)")
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows fetched per database round trip (default 2000)")
+
+    def handle(self, *args, path, format, batch_size, **options):
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+        fmt = detect_format(path, format)
+        exported = 0
+
+        def counted(rows):
+            nonlocal exported
+            for row in rows:
+                exported += 1
+                yield row
+
+        started = time.monotonic()
+        if path == '-':
+            write_rows(self.stdout, fmt, counted(export_rows(batch_size)))
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                write_rows(f, fmt, counted(export_rows(batch_size)))
+        seconds = time.monotonic() - started
+        rate = exported / seconds if seconds else 0.0
+        # Keep stdout clean for the catalog itself
+        out = self.stderr if path == '-' else self.stdout
+        out.write(f"Exported {exported} products in {seconds:.1f}s, {rate:.0f} rows/s", style_func=self.style.SUCCESS)
@@ -0,0 +1,45 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apiApp.catalog import FORMATS, CatalogImporter, ImportFailed, detect_format, read_rows
+
+
+class Command(BaseCommand):
+    help = ("Create or update products from a CSV or JSON lines catalog, upserting on slug "
+            "in chunks; unknown categories are created")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Catalog file, or - for stdin")
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help="Input format (default from the file extension, csv for stdin)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Rows per upsert transaction (default 1000)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count what would change without writing")
+
+    def handle(self, *args, path, format, batch_size, dry_run, verbosity, **options):
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+        fmt = detect_format(path, format)
+        log = self.stdout.write if verbosity >= 2 else self.stderr.write
+        importer = CatalogImporter(batch_size=batch_size, dry_run=dry_run, log=log)
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            stats = importer.run(read_rows(stream, fmt))
+        except (csv.Error, json.JSONDecodeError) as e:
+            raise CommandError(f"Unreadable {fmt} input after {importer.stats.rows} rows: {e}")
+        except ImportFailed as e:
+            raise CommandError(e)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        verb = "Would import" if dry_run else "Imported"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {stats.rows} rows ({stats.created} created, {stats.updated} updated, "
+            f"{stats.unchanged} unchanged, {stats.rejected} rejected, {stats.categories} new categories) "
+            f"in {stats.seconds:.1f}s, {stats.rows_per_second:.0f} rows/s"
+        ))
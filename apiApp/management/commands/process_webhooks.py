@@ -0,0 +1,58 @@
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apiApp import webhooks
+
+
+class Command(BaseCommand):
+    help = "Process the Stripe events recorded by the webhook, with retries and dead-lettering"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Worker threads, each with its own database connection (default 4)")
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help="Events claimed per round trip (default 20)")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to sleep when nothing is due (default 1)")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once no event is due instead of polling forever")
+
+    def handle(self, *args, workers, batch_size, poll_interval, once, **options):
+        self.stop = threading.Event()
+        self.totals = {}
+        self.totals_lock = threading.Lock()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: self.stop.set())
+            signal.signal(signal.SIGINT, lambda *_: self.stop.set())
+
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self.work, args=(batch_size, poll_interval, once), name=f'webhook-worker-{i}')
+            for i in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        summary = ', '.join(f"{count} {status.lower()}" for status, count in sorted(self.totals.items())) or "nothing due"
+        self.stdout.write(self.style.SUCCESS(f"Processed webhook events: {summary} in {time.monotonic() - started:.1f}s"))
+
+    def work(self, batch_size, poll_interval, once):
+        try:
+            while not self.stop.is_set():
+                outcome = webhooks.drain(batch_size)
+                if outcome:
+                    with self.totals_lock:
+                        for status, count in outcome.items():
+                            self.totals[status] = self.totals.get(status, 0) + count
+                elif once:
+                    break
+                else:
+                    self.stop.wait(poll_interval)
+        finally:
+            connection.close()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from apiApp.carts import purge_abandoned, retention_days
+
+
+class Command(BaseCommand):
+    help = "Delete carts untouched for CART_RETENTION_DAYS, in small throttled batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Purge carts not updated for this many days (default CART_RETENTION_DAYS, 30)")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Carts deleted per transaction (default 500)")
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help="Seconds to pause between batches (default 0.1)")
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="Stop after this many batches, to bound one run")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count what would be purged without deleting")
+
+    def handle(self, *args, days, batch_size, sleep, max_batches, dry_run, **options):
+        days = retention_days() if days is None else days
+        stats = purge_abandoned(days, batch_size=batch_size, pause=sleep, max_batches=max_batches, dry_run=dry_run)
+        verb = "Would purge" if dry_run else "Purged"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {stats['carts']} carts and {stats['items']} items older than {days} days "
+            f"in {stats['batches']} batches, {stats['seconds']:.1f}s"
+        ))
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from apiApp.models import Product, ProductRating, Review
+
+
+class Command(BaseCommand):
+    help = "Recompute product ratings from their reviews and repair the ones that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Products checked per batch (default 2000)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report drifted ratings without writing them")
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        started = time.monotonic()
+        checked = fixed = created = 0
+        product_ids = Product.objects.order_by('id').values_list('id', flat=True)
+        batch = []
+        for product_id in product_ids.iterator(chunk_size=batch_size):
+            batch.append(product_id)
+            if len(batch) == batch_size:
+                result = self.repair(batch, dry_run)
+                checked, fixed, created = checked + len(batch), fixed + result[0], created + result[1]
+                batch = []
+        if batch:
+            result = self.repair(batch, dry_run)
+            checked, fixed, created = checked + len(batch), fixed + result[0], created + result[1]
+
+        verb = "Would fix" if dry_run else "Fixed"
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} products. {verb} {fixed} ratings ({created} missing) "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
+
+    def repair(self, product_ids, dry_run):
+        """Compare one batch of products against their reviews, returns (fixed, created)."""
+        actual = {
+            row['product_id']: (row['count'], row['total'])
+            for row in Review.objects.filter(product_id__in=product_ids)
+            .values('product_id').annotate(count=Count('id'), total=Sum('rating')).order_by()
+        }
+        stored = {r.product_id: r for r in ProductRating.objects.filter(product_id__in=product_ids)}
+
+        to_update, to_create = [], []
+        for product_id in product_ids:
+            count, total = actual.get(product_id, (0, 0))
+            average = total / count if count else 0.0
+            rating = stored.get(product_id)
+            if rating is None:
+                if count:
+                    to_create.append(ProductRating(product_id=product_id, total_reviews=count,
+                                                   rating_sum=total, average_rating=average))
+                continue
+            if (rating.total_reviews, rating.rating_sum) != (count, total) or abs(rating.average_rating - average) > 1e-9:
+                rating.total_reviews, rating.rating_sum, rating.average_rating = count, total, average
+                to_update.append(rating)
+
+        if not dry_run:
+            with transaction.atomic():
+                ProductRating.objects.bulk_update(to_update, ['total_reviews', 'rating_sum', 'average_rating'])
+                # A review landing meanwhile may have created the row; the next run picks that up
+                ProductRating.objects.bulk_create(to_create, ignore_conflicts=True)
+        return len(to_update) + len(to_create), len(to_create)
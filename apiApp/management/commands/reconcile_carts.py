@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apiApp.carts import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the cart item count and total columns from the cart items and repair the ones that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Carts checked per batch (default 1000)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report drifted carts without writing them")
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        started = time.monotonic()
+        checked, drifted = reconcile_counters(batch_size=batch_size, dry_run=dry_run)
+        verb = "Would fix" if dry_run else "Fixed"
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} carts. {verb} {drifted} in {time.monotonic() - started:.1f}s"
+        ))
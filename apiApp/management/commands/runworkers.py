@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+from apiApp import jobs
+
+logger = logging.getLogger(__name__)
+
+
+def work(stop, results, batch_size, poll_interval, burst):
+    """Worker loop: claim, run, report each result to the parent."""
+    worker = jobs.worker_name()
+    try:
+        while not stop.is_set():
+            try:
+                done = jobs.work(batch_size, worker)
+            except OperationalError:
+                # Lost connection or lock timeout: back off and claim again
+                logger.warning("Worker %s could not claim jobs", worker, exc_info=True)
+                connections.close_all()
+                stop.wait(poll_interval)
+                continue
+            for result in done:
+                results.put(result)
+            if not done:
+                if burst:
+                    break
+                stop.wait(poll_interval)
+    finally:
+        connections.close_all()
+
+
+def run_child(stop, results, batch_size, poll_interval, burst):
+    # Ctrl-C reaches the whole process group; let the parent decide when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    work(stop, results, batch_size, poll_interval, burst)
+
+
+class Command(BaseCommand):
+    help = "Run background jobs in forked worker processes, reporting throughput as they go"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                            help="Worker processes to fork (default one per CPU); 0 runs the jobs in this process")
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help="Jobs claimed per round trip (default 10)")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds a worker sleeps when nothing is due (default 1)")
+        parser.add_argument('--burst', action='store_true',
+                            help="Exit once no job is due instead of polling forever")
+        parser.add_argument('--stats-interval', type=float, default=60.0,
+                            help="Seconds between throughput reports, 0 to only report on exit (default 60)")
+
+    def handle(self, *args, processes, batch_size, poll_interval, burst, stats_interval, **options):
+        context = multiprocessing.get_context('fork')
+        self.stop = context.Event()
+        self.results = context.Queue()
+        self.metrics = jobs.Metrics()
+        handlers = {sig: signal.signal(sig, lambda *_: self.stop.set()) for sig in (signal.SIGTERM, signal.SIGINT)}
+        options = (self.stop, self.results, batch_size, poll_interval, burst)
+        scheduled = jobs.schedule()
+        if scheduled:
+            self.stdout.write(f"Scheduled {', '.join(scheduled)}")
+        try:
+            if processes <= 0:
+                work(self.stop, SimpleNamespace(put=self.metrics.record), *options[2:])
+            else:
+                # Forked children must open their own database connections
+                connections.close_all()
+                children = [self.spawn(context, options) for _ in range(processes)]
+                self.stdout.write(f"Started {processes} workers: {', '.join(str(child.pid) for child in children)}")
+                self.supervise(context, options, children, stats_interval)
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        self.stdout.write(self.style.SUCCESS(f"Ran {self.metrics.summary()}"))
+
+    def spawn(self, context, options):
+        child = context.Process(target=run_child, args=options, name='job-worker')
+        child.start()
+        return child
+
+    def supervise(self, context, options, children, stats_interval):
+        next_report = time.monotonic() + stats_interval
+        while children:
+            self.collect(timeout=0.5)
+            for child in list(children):
+                if child.is_alive():
+                    continue
+                child.join()
+                children.remove(child)
+                if child.exitcode != 0 and not self.stop.is_set() and not options[-1]:
+                    self.stderr.write(f"Worker {child.pid} exited with code {child.exitcode}, restarting it")
+                    children.append(self.spawn(context, options))
+            if stats_interval and time.monotonic() >= next_report:
+                self.stdout.write(self.metrics.summary())
+                next_report += stats_interval
+        self.collect(timeout=0.1)
+
+    def collect(self, timeout, limit=1000):
+        """Fold finished-job results into the metrics, waiting up to ``timeout`` for the first."""
+        for _ in range(limit):
+            try:
+                self.metrics.record(self.results.get(timeout=timeout))
+            except queue.Empty:
+                return
+            timeout = 0.01
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apiApp.models import CustomUser
+from apiApp.seeding import Seeder
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic catalog with customers, reviews, carts and orders, deterministic from --seed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=16, help="Categories (default 16)")
+        parser.add_argument('--products', type=int, default=1000, help="Products (default 1000)")
+        parser.add_argument('--users', type=int, default=1000, help="Customers (default 1000)")
+        parser.add_argument('--reviews', type=int, default=5000,
+                            help="Reviews, skewed towards popular products and prolific customers (default 5000)")
+        parser.add_argument('--carts', type=int, default=500, help="Carts (default 500)")
+        parser.add_argument('--orders', type=int, default=500, help="Paid orders (default 500)")
+        parser.add_argument('--seed', type=int, default=42,
+                            help="Random seed; the same seed and volumes give the same data (default 42)")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Rows per COPY or INSERT (default 5000)")
+        parser.add_argument('--password', default='password',
+                            help="Password of every generated customer (default 'password')")
+        parser.add_argument('--superuser', action='store_true',
+                            help="Also create the admin / admin123 superuser if it does not exist")
+
+    def handle(self, *args, seed, batch_size, password, superuser, verbosity, **volumes):
+        volumes = {name: volumes[name] for name in ('categories', 'products', 'users', 'reviews', 'carts', 'orders')}
+        if any(count < 0 for count in volumes.values()):
+            raise CommandError("Volumes can't be negative")
+        if not volumes['products'] and (volumes['reviews'] or volumes['carts'] or volumes['orders']):
+            raise CommandError("Reviews, carts and orders need --products")
+
+        if superuser and not CustomUser.objects.filter(username='admin').exists():
+            CustomUser.objects.create_superuser(username='admin', email='admin@example.com', password='admin123')
+            self.stdout.write("Created the admin superuser")
+
+        log = self.stdout.write if verbosity >= 1 else None
+        counts, seconds = Seeder(seed=seed, batch_size=batch_size, log=log).run(password=password, **volumes)
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {sum(counts.values())} rows with seed {seed} in {seconds:.1f}s"
+        ))
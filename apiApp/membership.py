@@ -0,0 +1,77 @@
+"""
+Which of a page's products are in the visitor's cart or wishlist.
+
+The product ids of a cart (by cart code) and of a wishlist (by email) are
+each one query, cached as a set for MEMBERSHIP_CACHE_TIMEOUT seconds. The
+cart mutations in carts.py and orders.py, and the Wishlist signals, drop
+the cached set once their transaction commits.
+
+That only reaches every worker through a shared cache, so the sets are not
+cached by default with the per-process local-memory cache: another worker
+would keep showing the old state until the entry expired.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .cache import is_shared
+from .models import CartItem, Wishlist
+
+# Most ids one membership request may ask about
+MAX_PRODUCTS = 100
+
+
+def cache_timeout():
+    return getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 60 if is_shared() else 0)
+
+
+def _key(source, owner):
+    return f'membership:{source}:{hashlib.md5(owner.encode()).hexdigest()}'
+
+
+def _product_ids(source, owner, queryset):
+    timeout = cache_timeout()
+    if not timeout:
+        return frozenset(queryset.values_list('product_id', flat=True))
+    key = _key(source, owner)
+    ids = cache.get(key)
+    if ids is None:
+        ids = frozenset(queryset.values_list('product_id', flat=True))
+        cache.set(key, ids, timeout)
+    return ids
+
+
+def cart_product_ids(cart_code):
+    return _product_ids('cart', cart_code, CartItem.objects.filter(cart__cart_code=cart_code))
+
+
+def wishlist_product_ids(email):
+    return _product_ids('wishlist', email, Wishlist.objects.filter(user__email=email))
+
+
+def _forget(source, owners):
+    keys = [_key(source, owner) for owner in owners if owner]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def forget_carts(*cart_codes):
+    _forget('cart', cart_codes)
+
+
+def forget_wishlist(email):
+    _forget('wishlist', [email])
+
+
+def membership(product_ids, cart_code=None, email=None):
+    """{source: {product id: bool}} for each source asked about."""
+    result = {}
+    if cart_code:
+        in_cart = cart_product_ids(cart_code)
+        result['product_in_cart'] = {pk: pk in in_cart for pk in product_ids}
+    if email:
+        in_wishlist = wishlist_product_ids(email)
+        result['product_in_wishlist'] = {pk: pk in in_wishlist for pk in product_ids}
+    return result
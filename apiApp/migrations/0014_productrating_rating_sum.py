@@ -0,0 +1,42 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:32
+
+from django.db import migrations, models
+from django.db.models import Case, Count, FloatField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+
+def fill_rating_counters(apps, schema_editor):
+    ProductRating = apps.get_model('apiApp', 'ProductRating')
+    Review = apps.get_model('apiApp', 'Review')
+    reviews = Review.objects.filter(product=OuterRef('product_id')).order_by().values('product')
+    count = Coalesce(Subquery(reviews.annotate(n=Count('id')).values('n')), 0)
+    total = Coalesce(Subquery(reviews.annotate(s=Sum('rating')).values('s')), 0)
+    # Products reviewed before ratings were kept for them
+    rated = ProductRating.objects.values('product_id')
+    ProductRating.objects.bulk_create(
+        [ProductRating(product_id=product_id) for product_id in
+         Review.objects.exclude(product_id__in=rated).values_list('product_id', flat=True).distinct()],
+        ignore_conflicts=True,
+    )
+    ProductRating.objects.update(total_reviews=count, rating_sum=total)
+    ProductRating.objects.update(average_rating=Case(
+        When(total_reviews=0, then=Value(0.0)),
+        default=Cast('rating_sum', FloatField()) / Cast('total_reviews', FloatField()),
+        output_field=FloatField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apiApp', '0013_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productrating',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+    ]
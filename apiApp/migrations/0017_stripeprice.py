@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apiApp', '0016_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripePrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_product_id', models.CharField(max_length=255)),
+                ('stripe_price_id', models.CharField(max_length=255)),
+                ('unit_amount', models.PositiveIntegerField()),
+                ('currency', models.CharField(default='usd', max_length=3)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stripe_price', to='apiApp.product')),
+            ],
+        ),
+    ]
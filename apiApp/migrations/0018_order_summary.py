@@ -0,0 +1,54 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:42
+
+from django.db import migrations, models
+from django.db.models import Prefetch
+
+
+def backfill_order_summaries(apps, schema_editor):
+    """Summaries for orders fulfilled before they were written at checkout."""
+    Order = apps.get_model('apiApp', 'Order')
+    OrderItem = apps.get_model('apiApp', 'OrderItem')
+    orders = Order.objects.prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('id'))
+    )
+    batch = []
+    for order in orders.iterator(chunk_size=500):
+        items = list(order.items.all())
+        order.item_count = sum(item.quantity for item in items)
+        order.summary = [
+            {
+                'product_id': item.product_id,
+                'name': item.product.name,
+                'slug': item.product.slug,
+                'image': item.product.image.name or '',
+                'price': str(item.product.price),
+                'quantity': item.quantity,
+            }
+            for item in items
+        ]
+        batch.append(order)
+        if len(batch) == 500:
+            Order.objects.bulk_update(batch, ['item_count', 'summary'])
+            batch = []
+    Order.objects.bulk_update(batch, ['item_count', 'summary'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apiApp', '0017_stripeprice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='summary',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(backfill_order_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.6 on 2026-10-18 18:44
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_counters(apps, schema_editor):
+    Cart = apps.get_model('apiApp', 'Cart')
+    CartItem = apps.get_model('apiApp', 'CartItem')
+    money = models.DecimalField(max_digits=12, decimal_places=2)
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        num_of_items=Coalesce(Subquery(items.annotate(n=Sum('quantity')).values('n')), 0),
+        cart_total=Coalesce(
+            Subquery(items.annotate(t=Sum(F('quantity') * F('product__price'), output_field=money)).values('t'),
+                     output_field=money),
+            Value(0, output_field=money),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apiApp', '0018_order_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='cart_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='num_of_items',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_cart_counters, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,28 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 from django.conf import settings
 
+from .slugs import save_with_slug
+
+class LoadedValuesMixin:
+    """
+    Keeps the field values an instance was loaded with in `_loaded_values`,
+    so signal handlers can tell what a save changed.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
 # Create your models here.
 class CustomUser(AbstractUser):
     """
@@ -16,26 +35,19 @@ class CustomUser(AbstractUser):
     def __str__(self):
         return self.email
     
-class ProductCategory(models.Model):
+class ProductCategory(LoadedValuesMixin, models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True, blank=True)
     image = models.ImageField(upload_to='category_img', blank=True,null=True)
 
     def save(self, *args, **kwargs):
-        from django.utils.text import slugify
-        if not self.slug:
-            self.slug = slugify(self.name)
-            # Handle duplicate slugs
-            counter = 1
-            while ProductCategory.objects.filter(slug=self.slug).exists():
-                self.slug = f"{slugify(self.name)}-{counter}"
-                counter += 1
-        super().save(*args, **kwargs)
+        # Without a slug, the name's slug with the lowest free "-N" suffix (see slugs.py)
+        save_with_slug(self, super().save, *args, **kwargs)
 
     def __str__(self):
         return self.name
     
-class Product(models.Model):
+class Product(LoadedValuesMixin, models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(unique=True,blank=True)
     category = models.ForeignKey(ProductCategory, on_delete=models.SET_NULL,related_name='products', blank=True, null=True)
@@ -43,25 +55,62 @@ class Product(models.Model):
     featured = models.BooleanField(default=False)
     slug = models.SlugField(unique=True, blank=True)
     image = models.ImageField(upload_to='products_img', blank=True,null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Maintained by apiApp.search, only populated on PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='product_search_vector_gin'),
+            # Keyset pagination of the featured list and of a category's products
+            models.Index(fields=['featured', 'id'], name='product_featured_id_idx'),
+            models.Index(fields=['category', 'id'], name='product_category_id_idx'),
+        ]
     
     def save(self, *args, **kwargs):
-        from django.utils.text import slugify
-        if not self.slug:
-            self.slug = slugify(self.name)
-            # Handle duplicate slugs
-            counter = 1
-            while Product.objects.filter(slug=self.slug).exists():
-                self.slug = f"{slugify(self.name)}-{counter}"
-                counter += 1
-        super().save(*args, **kwargs)
+        # Without a slug, the name's slug with the lowest free "-N" suffix (see slugs.py)
+        save_with_slug(self, super().save, *args, **kwargs)
 
     def __str__(self):
         return self.name
+
+class CartQuerySet(models.QuerySet):
+    def with_items(self):
+        """
+        Load carts together with their items and products in two queries.
+        Line sub totals and the cart total at current prices (items_total)
+        are computed by the database.
+        """
+        money = models.DecimalField(max_digits=12, decimal_places=2)
+        items = CartItem.objects.select_related('product').annotate(
+            sub_total=models.ExpressionWrapper(
+                models.F('product__price') * models.F('quantity'), output_field=money
+            )
+        )
+        return self.prefetch_related(models.Prefetch('cartitems', queryset=items)).annotate(
+            items_total=Coalesce(
+                models.Sum(models.F('cartitems__product__price') * models.F('cartitems__quantity'), output_field=money),
+                models.Value(0, output_field=money),
+            )
+        )
+
 class Cart (models.Model):
     cart_code_length_limit = 11
     cart_code = models.CharField(max_length=cart_code_length_limit, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Kept up to date by every mutation in apiApp/carts.py, so the cart badge
+    # is one row read; `manage.py reconcile_carts` repairs drift
+    num_of_items = models.IntegerField(default=0)
+    cart_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Abandoned cart purge walks this oldest first
+            models.Index(fields=['updated_at', 'id'], name='cart_updated_at_idx'),
+        ]
 
     def __str__(self):
         return self.cart_code
@@ -71,10 +120,15 @@ class CartItem (models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='item')
     quantity = models.IntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     def __str__(self):
         return f"{self.product} x {self.quantity} in cart {self.cart}"
 
-class Review(models.Model):
+class Review(LoadedValuesMixin, models.Model):
     RATING_CHOICES = [
         (1, '1 - Poor'),
         (2, '2 - Fair'),
@@ -101,6 +155,8 @@ class ProductRating(models.Model):
     product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='rating')
     average_rating = models.FloatField(default=0.0, validators=[MinValueValidator(0.0), MaxValueValidator(5.0)])
     total_reviews = models.PositiveIntegerField(default=0)
+    # Running sum of the ratings, so average_rating can be updated without re-aggregating
+    rating_sum = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.product.name} - {self.average_rating} ({self.total_reviews} reviews)"
@@ -115,6 +171,9 @@ class Wishlist(models.Model):
 
     class Meta:
         unique_together = ["user", "product"]
+        indexes = [
+            models.Index(fields=['user', '-created', '-id'], name='wishlist_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.product.name}"
@@ -129,6 +188,14 @@ class Order(models.Model):
     customer_email = models.EmailField()
     status = models.CharField(max_length=20, choices=[("Pending", "Pending"), ("Paid", "Paid")])
     created_at = models.DateTimeField(auto_now_add=True)
+    # Written at fulfilment so order lists need no joins, see orders.order_summary()
+    item_count = models.PositiveIntegerField(default=0)
+    summary = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer_email', '-created_at', '-id'], name='order_email_created_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.stripe_checkout_id} - {self.status}"
@@ -144,6 +211,116 @@ class OrderItem(models.Model):
     
 
 
+class StripePrice(models.Model):
+    """
+    The Stripe Product and Price a catalog product is sold with at checkout.
+    A new Price is created when the product's price no longer matches unit_amount.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name="stripe_price")
+    stripe_product_id = models.CharField(max_length=255)
+    stripe_price_id = models.CharField(max_length=255)
+    unit_amount = models.PositiveIntegerField()  # in cents
+    currency = models.CharField(max_length=3, default="usd")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.product.name} - {self.stripe_price_id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    Outbox of verified Stripe events. The webhook only records them,
+    `manage.py process_webhooks` does the work with retries.
+    """
+    STATUS_CHOICES = [
+        ("Pending", "Pending"),
+        ("Processing", "Processing"),
+        ("Done", "Done"),
+        ("Dead", "Dead"),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="Pending")
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhookevent_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} - {self.status}"
+
+
+class Job(models.Model):
+    """
+    Background job, claimed and run by `manage.py runworkers` (see apiApp/jobs.py).
+    Higher priority runs first; run_at delays a job until then.
+    """
+    STATUS_CHOICES = [
+        ("Pending", "Pending"),
+        ("Running", "Running"),
+        ("Dead", "Dead"),
+    ]
+
+    task = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="Pending")
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    # At most one pending job per key, later enqueues with the same key are dropped
+    unique_key = models.CharField(max_length=200, blank=True, null=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at'], name='job_due_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['unique_key'], condition=models.Q(status="Pending"),
+                                    name='job_unique_pending_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} - {self.status}"
+
+
+class AutocompleteChange(models.Model):
+    """
+    Products and categories written, for every process's autocomplete index
+    to pick up (see apiApp/autocomplete.py). kind "all" asks for a rebuild.
+    """
+    KIND_CHOICES = [
+        ("product", "product"),
+        ("category", "category"),
+        ("all", "all"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='autocompletechange_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id or ''}".strip()
+
+
 # Newly Added 
 
 class CustomerAddress(models.Model):
@@ -0,0 +1,63 @@
+"""
+Order fulfilment for completed Stripe checkout sessions.
+
+Each order carries a snapshot of what was bought (order_summary()), written
+once at fulfilment, so order history lists are served from the order rows
+alone and keep showing the name and price paid after the product changes.
+"""
+from django.db import transaction
+
+from .membership import forget_carts
+from .models import Cart, Order, OrderItem
+
+
+def order_summary(items):
+    """(item_count, summary) for order or cart items with their products loaded."""
+    summary = [
+        {
+            'product_id': item.product_id,
+            'name': item.product.name,
+            'slug': item.product.slug,
+            'image': item.product.image.name or '',
+            'price': str(item.product.price),
+            'quantity': item.quantity,
+        }
+        for item in items
+    ]
+    return sum(line['quantity'] for line in summary), summary
+
+
+def fulfill_checkout(session, cart_code):
+    """
+    Turn the cart of a paid checkout session into an order, in one transaction.
+
+    The order is keyed on the session id, so Stripe retries and duplicate
+    events find the existing order and change nothing.
+    """
+    with transaction.atomic():
+        order, created = Order.objects.get_or_create(
+            stripe_checkout_id=session["id"],
+            defaults={
+                "amount": session["amount_total"],
+                "currency": session["currency"],
+                "customer_email": session["customer_email"],
+                "status": "Paid",
+            },
+        )
+        if not created:
+            return order
+
+        # Locked so an add-to-cart racing with the webhook can't slip in between
+        cart = Cart.objects.select_for_update().filter(cart_code=cart_code).first()
+        if cart is None:
+            return order
+        cartitems = list(cart.cartitems.select_related('product').order_by('id'))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=item.product, quantity=item.quantity)
+            for item in cartitems
+        ])
+        order.item_count, order.summary = order_summary(cartitems)
+        order.save(update_fields=['item_count', 'summary'])
+        forget_carts(cart.cart_code)
+        cart.delete()
+    return order
@@ -0,0 +1,87 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Pages are fetched with ``WHERE <ordering field> < cursor ORDER BY ... LIMIT``
+so page N costs the same as page 1, each ordering is backed by an index, and
+the trailing ``id`` keeps the order stable. Clients that need the whole list
+can pass ``?stream=1`` and get it as one JSON array streamed in chunks.
+"""
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ProductCursorPagination(CursorPagination):
+    ordering = ('id',)
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class SearchCursorPagination(ProductCursorPagination):
+    # rank is annotated by apiApp.search.search_products
+    ordering = ('-rank', 'id')
+
+
+class OrderCursorPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class WishlistCursorPagination(CursorPagination):
+    ordering = ('-created', '-id')
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def wants_stream(request):
+    return request.query_params.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_json(queryset, serializer_class, context=None, chunk_size=500):
+    """
+    Stream every row of ``queryset`` as a JSON array. Rows are read with
+    ``iterator(chunk_size)`` and serialized one chunk at a time, so memory
+    stays flat however long the list is.
+    """
+    def chunks():
+        yield '['
+        batch, first = [], True
+        for obj in queryset.iterator(chunk_size=chunk_size):
+            batch.append(obj)
+            if len(batch) == chunk_size:
+                yield _encode(batch, serializer_class, context, first)
+                batch, first = [], False
+        if batch:
+            yield _encode(batch, serializer_class, context, first)
+        yield ']'
+
+    return StreamingHttpResponse(chunks(), content_type='application/json')
+
+
+def _encode(batch, serializer_class, context, first):
+    data = serializer_class(batch, many=True, context=context or {}).data
+    body = json.dumps(data, cls=JSONEncoder)[1:-1]
+    return body if first else ',' + body
+
+
+class StreamingListMixin:
+    """
+    For ListAPIView subclasses: ``?stream=1`` returns the full result,
+    in the paginator's order, instead of one page.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if wants_stream(request):
+            queryset = self.filter_queryset(self.get_queryset())
+            return stream_json(
+                queryset.order_by(*self.pagination_class.ordering),
+                self.get_serializer_class(),
+                context=self.get_serializer_context(),
+            )
+        return super().list(request, *args, **kwargs)
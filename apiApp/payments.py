@@ -0,0 +1,270 @@
+"""
+Payment gateway: the Stripe client every Stripe API call goes through.
+
+client() returns a process-wide stripe.StripeClient whose HTTP transport
+  * keeps connections to Stripe alive in a pooled requests.Session,
+  * gives every call a deadline (STRIPE_DEADLINE seconds) that bounds the
+    connect and read timeouts of each attempt and the retries together,
+  * retries connection errors, 409s, 429s and 5xxs a bounded number of times
+    (STRIPE_MAX_RETRIES) with full-jitter backoff; POSTs carry an
+    Idempotency-Key so a retried create is applied once,
+  * fails fast with PaymentsUnavailable while the circuit breaker is open,
+    after STRIPE_BREAKER_THRESHOLD consecutive failures, instead of tying up
+    a worker on a Stripe outage. After STRIPE_BREAKER_RESET seconds one trial
+    call is let through and closes the circuit again if it succeeds,
+  * records per-endpoint latency in `metrics`, served by the payment metrics view.
+"""
+import random
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class PaymentsUnavailable(stripe.APIConnectionError):
+    """Raised without calling Stripe while the circuit breaker is open."""
+
+    def __init__(self, retry_in):
+        super().__init__(f"Payments are temporarily unavailable, retry in {retry_in:.0f}s", should_retry=False)
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, reset_after=30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_after:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_call(self):
+        """Raise PaymentsUnavailable unless a call may go out now."""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial_running:
+                # One caller probes Stripe, the rest keep failing fast
+                self._trial_running = True
+                return
+            retry_in = max(self._opened_at + self.reset_after - time.monotonic(), 0)
+            raise PaymentsUnavailable(retry_in)
+
+    def record(self, ok):
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.threshold:
+                # A failed trial call opens the circuit for another period
+                self._opened_at = time.monotonic()
+
+
+# Object ids in paths are collapsed so metrics group by endpoint
+_ID_RE = re.compile(r'/(?:[a-z]+_)+[A-Za-z0-9]+')
+
+
+class LatencyMetrics:
+    """Call counts, errors and latency percentiles per Stripe endpoint, over the last `window` calls."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    @staticmethod
+    def endpoint(method, url):
+        return f"{method.upper()} {_ID_RE.sub('/:id', urlsplit(url).path)}"
+
+    def observe(self, endpoint, seconds, ok):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {'calls': 0, 'errors': 0, 'samples': deque(maxlen=self.window)}
+            stats['calls'] += 1
+            stats['errors'] += not ok
+            stats['samples'].append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {name: (stats['calls'], stats['errors'], sorted(stats['samples']))
+                         for name, stats in self._endpoints.items()}
+        report = {}
+        for name, (calls, errors, samples) in endpoints.items():
+            def percentile(p):
+                return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1)
+            report[name] = {
+                'calls': calls,
+                'errors': errors,
+                'p50_ms': percentile(0.50),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': round(samples[-1] * 1000, 1),
+            }
+        return report
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+class GatewayHTTPClient(stripe.RequestsClient):
+    name = 'gateway'
+
+    def __init__(self, connect_timeout, read_timeout, deadline, max_retries, backoff,
+                 pool_size, breaker, metrics):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        super().__init__(timeout=(connect_timeout, read_timeout), session=session)
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.metrics = metrics
+
+    # RequestsClient reads self._timeout for each attempt; this makes it per thread
+    # so every attempt gets what is left of its own call's deadline
+    @property
+    def _timeout(self):
+        return getattr(self._thread_local, 'timeout', None) or self._default_timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._default_timeout = value
+
+    def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *, _usage=None):
+        return self._call(self.request, method, url, headers, post_data, max_network_retries)
+
+    def request_stream_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, *,
+                                    _usage=None):
+        return self._call(self.request_stream, method, url, headers, post_data, max_network_retries)
+
+    def _should_retry(self, response, api_connection_error, num_retries, max_network_retries):
+        if response is not None and response[1] == 429 and num_retries < (max_network_retries or 0):
+            return True
+        return super()._should_retry(response, api_connection_error, num_retries, max_network_retries)
+
+    def _call(self, send, method, url, headers, post_data, max_retries):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        endpoint = self.metrics.endpoint(method, url)
+        deadline = time.monotonic() + self.deadline
+        connect_timeout, read_timeout = self._default_timeout
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            remaining = deadline - time.monotonic()
+            remaining = max(remaining, 0.001)
+            self._thread_local.timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+            started = time.monotonic()
+            try:
+                response, error = send(method, url, headers, post_data), None
+            except stripe.APIConnectionError as e:
+                response, error = None, e
+            except BaseException:
+                self.breaker.record(False)
+                raise
+            finally:
+                self._thread_local.timeout = None
+            # 4xx answers are the caller's problem, not a sign that Stripe is unwell
+            ok = response is not None and response[1] < 500 and response[1] != 429
+            self.metrics.observe(endpoint, time.monotonic() - started, ok)
+            self.breaker.record(ok or (response is not None and response[1] == 429))
+
+            if not self._should_retry(response, error, attempt, max_retries):
+                break
+            attempt += 1
+            delay = self._retry_delay(attempt, response)
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    def _retry_delay(self, attempt, response):
+        """Full jitter: anywhere up to backoff * 2^attempt, but at least what Retry-After asks for."""
+        delay = random.uniform(0, min(self.MAX_DELAY, self.backoff * 2 ** attempt))
+        retry_after = self._retry_after_header(response) or 0
+        return max(delay, retry_after) if retry_after <= self.MAX_RETRY_AFTER else delay
+
+
+breaker = None
+metrics = LatencyMetrics()
+_client = _http_client = None
+_client_lock = threading.Lock()
+
+
+def client():
+    """The shared Stripe client, created on first use in each process."""
+    global _client, _http_client, breaker
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                breaker = CircuitBreaker(
+                    threshold=_setting('STRIPE_BREAKER_THRESHOLD', 5),
+                    reset_after=_setting('STRIPE_BREAKER_RESET', 30.0),
+                )
+                max_retries = _setting('STRIPE_MAX_RETRIES', 2)
+                _http_client = GatewayHTTPClient(
+                    connect_timeout=_setting('STRIPE_CONNECT_TIMEOUT', 3.05),
+                    read_timeout=_setting('STRIPE_READ_TIMEOUT', 10.0),
+                    deadline=_setting('STRIPE_DEADLINE', 15.0),
+                    max_retries=max_retries,
+                    backoff=_setting('STRIPE_RETRY_BACKOFF', 0.25),
+                    pool_size=_setting('STRIPE_POOL_SIZE', 10),
+                    breaker=breaker,
+                    metrics=metrics,
+                )
+                base = _setting('STRIPE_API_BASE', None)
+                _client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    base_addresses={'api': base} if base else {},
+                    max_network_retries=max_retries,
+                    http_client=_http_client,
+                )
+    return _client
+
+
+def reset():
+    """Drop the shared client, so the next call picks up changed settings."""
+    global _client, _http_client, breaker
+    with _client_lock:
+        if _http_client is not None:
+            _http_client.close()
+        _client = _http_client = breaker = None
+        metrics.reset()
+
+
+def status():
+    return {'circuit': breaker.state if breaker else CircuitBreaker.CLOSED, 'endpoints': metrics.snapshot()}
@@ -0,0 +1,43 @@
+"""
+Incremental ProductRating maintenance.
+
+Each review write adjusts the product's running ``total_reviews`` and
+``rating_sum`` with a single UPDATE and derives ``average_rating`` from them
+in the same statement, so no write re-aggregates a product's reviews.
+``manage.py rebuild_ratings`` repairs rows that drifted.
+"""
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Cast
+
+from .models import ProductRating
+
+
+def _apply(product_id, count_delta, sum_delta):
+    count = F('total_reviews') + count_delta
+    total = F('rating_sum') + sum_delta
+    return ProductRating.objects.filter(product_id=product_id).update(
+        total_reviews=count,
+        rating_sum=total,
+        # The right hand sides all read the row as it was before the update
+        average_rating=Case(
+            When(total_reviews__lte=-count_delta, then=Value(0.0)),
+            default=Cast(total, FloatField()) / count,
+            output_field=FloatField(),
+        ),
+    )
+
+
+def review_added(product_id, rating):
+    if not _apply(product_id, 1, rating):
+        ProductRating.objects.bulk_create([ProductRating(product_id=product_id)], ignore_conflicts=True)
+        _apply(product_id, 1, rating)
+
+
+def review_changed(product_id, old_rating, new_rating):
+    if old_rating != new_rating:
+        _apply(product_id, 0, new_rating - old_rating)
+
+
+def review_removed(product_id, rating):
+    # No row means nothing was counted, and during a product delete the row may already be gone
+    _apply(product_id, -1, -rating)
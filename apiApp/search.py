@@ -0,0 +1,129 @@
+"""
+Product search.
+
+On PostgreSQL products are matched against the ``Product.search_vector``
+column (GIN indexed, kept up to date by signals) and ordered by ``ts_rank``.
+Other databases fall back to an in-memory inverted index built from the same
+fields with the same weights, so search can be exercised on SQLite.
+"""
+import re
+import threading
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, FloatField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+from .models import Product, ProductCategory
+
+SEARCH_CONFIG = 'english'
+
+# Same weights ts_rank uses for the A, B and C labels
+FIELD_WEIGHTS = {'name': 1.0, 'category': 0.4, 'description': 0.2}
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def uses_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def search_vector_expression():
+    """tsvector of name (A), category name (B) and description (C)."""
+    category_name = Subquery(
+        ProductCategory.objects.filter(pk=OuterRef('category_id')).values('name')[:1]
+    )
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(Coalesce(category_name, Value('')), weight='B', config=SEARCH_CONFIG)
+        + SearchVector('description', weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def refresh_search_vectors(queryset=None):
+    """Recompute ``search_vector`` for the given products (all by default)."""
+    if uses_postgres():
+        if queryset is None:
+            queryset = Product.objects.all()
+        queryset.update(search_vector=search_vector_expression())
+    search_index.invalidate()
+
+
+def tokenize(text):
+    """Lowercase words with a naive plural strip, close enough to the english stemmer for fallback use."""
+    tokens = []
+    for token in TOKEN_RE.findall((text or '').lower()):
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class InMemorySearchIndex:
+    """
+    Inverted index of term -> {product id: weighted score}.
+    Built lazily on first use and rebuilt after invalidate().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = None
+
+    def invalidate(self):
+        self._postings = None
+
+    def _build(self):
+        postings = defaultdict(lambda: defaultdict(float))
+        rows = Product.objects.values_list('id', 'name', 'category__name', 'description')
+        for product_id, name, category, description in rows.iterator(chunk_size=2000):
+            for field, text in (('name', name), ('category', category), ('description', description)):
+                for token in tokenize(text):
+                    postings[token][product_id] += FIELD_WEIGHTS[field]
+        return postings
+
+    def search(self, query):
+        """Scores of the products containing every term of ``query``."""
+        terms = tokenize(query)
+        if not terms:
+            return {}
+        postings = self._postings
+        if postings is None:
+            with self._lock:
+                if self._postings is None:
+                    self._postings = self._build()
+                postings = self._postings
+
+        matches = [postings.get(term) for term in terms]
+        if not all(matches):
+            return {}
+        matches.sort(key=len)
+        scores = dict(matches[0])
+        for match in matches[1:]:
+            scores = {pid: score + match[pid] for pid, score in scores.items() if pid in match}
+        return scores
+
+
+search_index = InMemorySearchIndex()
+
+
+def search_products(query):
+    """Products matching ``query``, annotated with ``rank`` and ordered best first."""
+    if uses_postgres():
+        search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+        return (
+            Product.objects.filter(search_vector=search_query)
+            # ts_rank is a real; as double precision it round-trips through pagination cursors exactly
+            .annotate(rank=Cast(SearchRank(F('search_vector'), search_query), FloatField()))
+            .order_by('-rank', 'id')
+        )
+
+    scores = search_index.search(query)
+    if not scores:
+        # Still annotated, the paginator orders by rank
+        return Product.objects.none().annotate(rank=Value(0.0, output_field=FloatField()))
+    rank = Case(
+        *[When(pk=pk, then=Value(score)) for pk, score in scores.items()],
+        output_field=FloatField(),
+    )
+    return Product.objects.filter(pk__in=scores).annotate(rank=rank).order_by('-rank', 'id')
@@ -0,0 +1,363 @@
+"""
+Synthetic catalog, customers and orders at production scale, for load tests.
+
+Every table is generated from its own random stream derived from the seed,
+so the same seed and volumes give the same rows, and changing one volume
+leaves the other tables alone. Popularity is skewed the way real traffic is:
+a few products collect most reviews, cart lines and order lines (Zipf),
+and a few customers write most of the reviews and place most of the orders.
+
+Rows are written with COPY on PostgreSQL and multi-row INSERTs elsewhere,
+skipping the ORM: no save(), no signals, no slug lookups. Primary keys are
+assigned here, after the highest existing one, so related rows can refer to
+them without reading anything back. Derived data (ratings, cart counters,
+order summaries) is computed while generating, as the signals would have.
+"""
+import io
+import json
+import random
+import time
+from bisect import bisect
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.text import slugify
+
+from .checkout import VAT_FEE
+from .models import (
+    Cart, CartItem, CustomUser, Order, OrderItem, Product, ProductCategory, ProductRating, Review,
+)
+
+CATEGORY_NAMES = [
+    'Electronics', 'Clothing', 'Books', 'Home & Kitchen', 'Toys', 'Sports', 'Beauty', 'Garden',
+    'Automotive', 'Music', 'Office', 'Pet Supplies', 'Grocery', 'Health', 'Jewelry', 'Shoes',
+]
+ADJECTIVES = [
+    'Classic', 'Smart', 'Wireless', 'Organic', 'Compact', 'Deluxe', 'Vintage', 'Portable',
+    'Premium', 'Eco', 'Ultra', 'Cotton', 'Leather', 'Steel', 'Bamboo', 'Mini',
+]
+NOUNS = [
+    'Phone', 'Shirt', 'Guide', 'Coffee Maker', 'Lamp', 'Backpack', 'Headphones', 'Kettle',
+    'Sneakers', 'Watch', 'Blender', 'Jacket', 'Notebook', 'Speaker', 'Mug', 'Chair',
+]
+COMMENTS = [
+    'Great value.', 'Works as described.', 'Not what I expected.', 'Would buy again.',
+    'Arrived late but fine.', 'Excellent quality.', 'Broke after a week.', 'Decent for the price.',
+]
+# J-shaped, like most review sites: mostly fives, more ones than twos
+RATING_WEIGHTS = {1: 7, 2: 5, 3: 10, 4: 25, 5: 53}
+
+# Popularity exponent; around 1 is typical for e-commerce catalogs
+ZIPF_EXPONENT = 1.1
+
+EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+DAY = 86400
+
+
+class Zipf:
+    """Draws from `values`, the first one most often, the n-th about 1/n^s as often."""
+
+    def __init__(self, values, exponent=ZIPF_EXPONENT):
+        self.values = values
+        self.cum_weights = list(accumulate(1 / rank ** exponent for rank in range(1, len(values) + 1)))
+
+    def draw(self, rng):
+        return self.values[bisect(self.cum_weights, rng.random() * self.cum_weights[-1])]
+
+    def sample(self, rng, k):
+        """k distinct values, topped up uniformly once the popular ones keep repeating."""
+        k = min(k, len(self.values))
+        picked = set()
+        for _ in range(k * 2):
+            picked.add(self.draw(rng))
+            if len(picked) == k:
+                return list(picked)
+        while len(picked) < k:
+            picked.add(rng.choice(self.values))
+        return list(picked)
+
+
+def heavy_tailed_counts(rng, slots, total, cap):
+    """Split `total` over `slots` with a long tail (Pareto), no slot above `cap`."""
+    if not slots or not total:
+        return [0] * slots
+    weights = [rng.paretovariate(1.2) for _ in range(slots)]
+    scale = total / sum(weights)
+    counts = [min(cap, int(w * scale)) for w in weights]
+    missing = total - sum(counts)
+    while missing > 0:
+        open_slots = [slot for slot, count in enumerate(counts) if count < cap][:missing]
+        if not open_slots:
+            break
+        for slot in open_slots:
+            counts[slot] += 1
+        missing -= len(open_slots)
+    return counts
+
+
+def timestamp(seconds):
+    """UTC timestamp as text, read the same by every backend and by COPY."""
+    return (EPOCH + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class TableWriter:
+    """Buffers rows for one table and writes them batch_size at a time."""
+
+    def __init__(self, model, fields, batch_size):
+        self.model = model
+        self.table = connection.ops.quote_name(model._meta.db_table)
+        self.columns = [connection.ops.quote_name(model._meta.get_field(name).column) for name in fields]
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # The driver's cursor: DEBUG query logging would format every batch
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                self._copy(cursor.cursor)
+            else:
+                self._insert(cursor.cursor)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def _copy(self, cursor):
+        sql = f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN"
+        data = ''.join('\t'.join(_copy_text(value) for value in row) + '\n' for row in self.rows)
+        if hasattr(cursor, 'copy_expert'):  # psycopg2
+            cursor.copy_expert(sql, io.StringIO(data))
+        else:  # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(data)
+
+    def _insert(self, cursor):
+        # SQLite caps the number of bound parameters per statement
+        max_params = connection.features.max_query_params or 999
+        per_statement = max(1, max_params // len(self.columns))
+        placeholders = f"({', '.join(['%s'] * len(self.columns))})"
+        for start in range(0, len(self.rows), per_statement):
+            chunk = self.rows[start:start + per_statement]
+            cursor.execute(
+                f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES {', '.join([placeholders] * len(chunk))}",
+                [value for row in chunk for value in row],
+            )
+
+
+def _next_id(model):
+    return (model.objects.aggregate(top=Max('pk'))['top'] or 0) + 1
+
+
+class Seeder:
+    def __init__(self, seed=42, batch_size=5000, log=None):
+        self.seed = seed
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+        self.counts = {}
+
+    def rng(self, name):
+        return random.Random(f'{self.seed}:{name}')
+
+    def write(self, model, fields, rows, lines=None):
+        """
+        Write a generated table in one transaction. With `lines`, the (model,
+        fields) of a child table, `rows` yields (row, child rows) pairs.
+        """
+        started = time.monotonic()
+        writers = [TableWriter(model, fields, self.batch_size)]
+        if lines:
+            writers.append(TableWriter(*lines, self.batch_size))
+        with transaction.atomic():
+            for row in rows:
+                if lines:
+                    row, children = row
+                    for child in children:
+                        writers[1].add(child)
+                # Children may reach the table first; foreign keys are checked at commit
+                writers[0].add(row)
+            for writer in writers:
+                writer.flush()
+        for writer in writers:
+            label = writer.model._meta.label
+            self.counts[label] = self.counts.get(label, 0) + writer.written
+            self.log(f"{writer.model.__name__}: {writer.written} rows "
+                     f"in {time.monotonic() - started:.1f}s")
+
+    def run(self, categories, products, users, reviews, carts, orders, password='password'):
+        started = time.monotonic()
+        category_ids = self.seed_categories(categories)
+        product_ids, prices, names = self.seed_products(products, category_ids)
+        popular = Zipf(self.rng('popularity').sample(product_ids, len(product_ids)))
+        user_ids = self.seed_users(users, password)
+        self.seed_reviews(reviews, user_ids, popular)
+        self.seed_carts(carts, popular, prices)
+        self.seed_orders(orders, user_ids, popular, prices, names)
+        self.finish()
+        return self.counts, time.monotonic() - started
+
+    def seed_categories(self, count):
+        first = _next_id(ProductCategory)
+        ids = list(range(first, first + count))
+
+        def rows():
+            for pk in ids:
+                name = CATEGORY_NAMES[(pk - 1) % len(CATEGORY_NAMES)]
+                if pk > len(CATEGORY_NAMES):
+                    name = f'{name} {(pk - 1) // len(CATEGORY_NAMES) + 1}'
+                yield pk, name, f'{slugify(name)}-{pk}', ''
+
+        self.write(ProductCategory, ['id', 'name', 'slug', 'image'], rows())
+        return ids
+
+    def seed_products(self, count, category_ids):
+        """Returns the new ids with each product's price in cents and name, by id."""
+        rng = self.rng('products')
+        first = _next_id(Product)
+        ids = list(range(first, first + count))
+        categories = Zipf(category_ids, exponent=0.8) if category_ids else None
+        prices, names = {}, {}
+
+        def rows():
+            for pk in ids:
+                name = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}'
+                # Log-normal prices: mostly cheap, a long tail of expensive items
+                cents = max(99, int(rng.lognormvariate(7.5, 1.0)) // 100 * 100 + 99)
+                prices[pk], names[pk] = cents, name
+                category_id = categories.draw(rng) if categories else None
+                yield (pk, name, f'Seeded product {pk}: {name.lower()}.', category_id,
+                       Decimal(cents) / 100, rng.random() < 0.02, f'{slugify(name)}-{pk}', '',
+                       timestamp(rng.randrange(365 * DAY)))
+
+        self.write(Product, ['id', 'name', 'description', 'category', 'price', 'featured', 'slug', 'image',
+                             'updated_at'], rows())
+        return ids, prices, names
+
+    def seed_users(self, count, password):
+        rng = self.rng('users')
+        first = _next_id(CustomUser)
+        ids = list(range(first, first + count))
+        # Hashing is deliberately slow; every seeded user shares one hash
+        hashed = make_password(password)
+
+        def rows():
+            for pk in ids:
+                yield (pk, hashed, False, f'user{pk}', 'User', str(pk), f'user{pk}@example.com',
+                       False, True, timestamp(rng.randrange(365 * DAY)))
+
+        self.write(CustomUser, ['id', 'password', 'is_superuser', 'username', 'first_name', 'last_name',
+                                'email', 'is_staff', 'is_active', 'date_joined'], rows())
+        return ids
+
+    def seed_reviews(self, count, user_ids, popular):
+        rng = self.rng('reviews')
+        # Prolific reviewers write hundreds, not the whole catalog
+        cap = min(len(popular.values), max(500, 2 * count // max(len(user_ids), 1)))
+        per_user = heavy_tailed_counts(rng, len(user_ids), count, cap)
+        ratings, weights = list(RATING_WEIGHTS), list(RATING_WEIGHTS.values())
+        totals = {}
+        first = _next_id(Review)
+
+        def rows():
+            pk = first
+            for user_id, reviews in zip(user_ids, per_user):
+                for product_id in popular.sample(rng, reviews):
+                    rating = rng.choices(ratings, weights)[0]
+                    written = timestamp(rng.randrange(365 * DAY))
+                    reviewed, total = totals.get(product_id, (0, 0))
+                    totals[product_id] = (reviewed + 1, total + rating)
+                    yield pk, product_id, user_id, rating, rng.choice(COMMENTS), written, written
+                    pk += 1
+
+        self.write(Review, ['id', 'product', 'user', 'rating', 'comment', 'created', 'updated'], rows())
+        # The ratings the review signals would have kept, for the reviewed products
+        self.write(ProductRating, ['product', 'average_rating', 'total_reviews', 'rating_sum'], (
+            (product_id, total / reviewed, reviewed, total)
+            for product_id, (reviewed, total) in sorted(totals.items())
+        ))
+
+    def _lines(self, rng, popular):
+        """Distinct (product id, quantity) lines of one cart or order, usually few."""
+        products = popular.sample(rng, min(1 + int(rng.expovariate(0.6)), 20))
+        return [(product_id, 1 if rng.random() < 0.8 else rng.randint(2, 4)) for product_id in products]
+
+    def seed_carts(self, count, popular, prices):
+        rng = self.rng('carts')
+        first = _next_id(Cart)
+
+        def rows():
+            for pk in range(first, first + count):
+                lines = self._lines(rng, popular)
+                # A quarter are older than the 30 day retention, as abandoned carts are
+                created = rng.randrange(90 * DAY)
+                updated = min(created + rng.randrange(2 * DAY), 90 * DAY)
+                cart = (pk, f'S{pk:010}', timestamp(275 * DAY + created), timestamp(275 * DAY + updated),
+                        sum(quantity for _, quantity in lines),
+                        Decimal(sum(prices[product_id] * quantity for product_id, quantity in lines)) / 100)
+                yield cart, [(pk, product_id, quantity) for product_id, quantity in lines]
+
+        self.write(Cart, ['id', 'cart_code', 'created_at', 'updated_at', 'num_of_items', 'cart_total'], rows(),
+                   lines=(CartItem, ['cart', 'product', 'quantity']))
+
+    def seed_orders(self, count, user_ids, popular, prices, names):
+        rng = self.rng('orders')
+        customers = Zipf(user_ids, exponent=0.7) if user_ids else None
+        first = _next_id(Order)
+
+        def rows():
+            for pk in range(first, first + count):
+                lines = self._lines(rng, popular)
+                summary = [
+                    {'product_id': product_id, 'name': names[product_id],
+                     'slug': f'{slugify(names[product_id])}-{product_id}', 'image': '',
+                     'price': str(Decimal(prices[product_id]) / 100), 'quantity': quantity}
+                    for product_id, quantity in lines
+                ]
+                email = f'user{customers.draw(rng)}@example.com' if customers else f'guest{pk}@example.com'
+                # Stored in cents with the VAT fee, like fulfilled Stripe sessions
+                amount = sum(prices[product_id] * quantity for product_id, quantity in lines) + VAT_FEE
+                order = (pk, f'cs_seed_{self.seed}_{pk}', amount, 'usd', email,
+                         'Paid' if rng.random() < 0.95 else 'Pending', timestamp(rng.randrange(365 * DAY)),
+                         sum(quantity for _, quantity in lines), json.dumps(summary))
+                yield order, [(pk, product_id, quantity) for product_id, quantity in lines]
+
+        self.write(Order, ['id', 'stripe_checkout_id', 'amount', 'currency', 'customer_email', 'status',
+                           'created_at', 'item_count', 'summary'], rows(),
+                   lines=(OrderItem, ['order', 'product', 'quantity']))
+
+    def finish(self):
+        """What the skipped save() and signals would have done, once for the whole load."""
+        from .autocomplete import record_rebuild
+        from .cache import invalidate_catalog
+        from .search import refresh_search_vectors
+
+        models = [CustomUser, ProductCategory, Product, Review, ProductRating, Cart, CartItem, Order, OrderItem]
+        with connection.cursor() as cursor:
+            # Explicit ids leave PostgreSQL sequences behind
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+            if connection.vendor == 'postgresql':
+                cursor.execute('ANALYZE')
+        started = time.monotonic()
+        refresh_search_vectors()
+        self.log(f"search vectors refreshed in {time.monotonic() - started:.1f}s")
+        invalidate_catalog()
+        record_rebuild()
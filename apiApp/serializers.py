@@ -1,3 +1,4 @@
+from django.core.files.storage import default_storage
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
 from .models import  CustomUser, Product, ProductCategory, Cart, CartItem, Review, Wishlist, Order, OrderItem, CustomerAddress
@@ -13,7 +14,6 @@ class ProductDetailedSerializer(serializers.ModelSerializer):
         fields=['id','name','description','slug','image','price']
 
 class ProductCategoryListSerializer(serializers.ModelSerializer):
-    products = ProductListSerializer(many=True, read_only=True)
     class Meta:
         model = ProductCategory
         fields=['id','name','slug','image']
@@ -35,6 +35,9 @@ class CartItemSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'product', 'cart']
 
     def get_sub_total(self, cart_item):
+        # Annotated by Cart.objects.with_items()
+        if hasattr(cart_item, 'sub_total'):
+            return cart_item.sub_total
         return cart_item.product.price * cart_item.quantity
 
 class CartSerializer(serializers.ModelSerializer):
@@ -46,6 +49,9 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ['id', 'cart_code', 'cartitems', 'cart_total']
 
     def get_cart_total(self, cart):
+        # Annotated by Cart.objects.with_items(), at current product prices
+        if hasattr(cart, 'items_total'):
+            return cart.items_total
         items = cart.cartitems.all()
         total = sum(item.product.price * item.quantity for item in items)
         return total
@@ -97,6 +103,24 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ["id", "stripe_checkout_id", "amount", "items", "status", "created_at"]
 
 
+class OrderSummarySerializer(serializers.ModelSerializer):
+    """Order from its fulfilment-time summary, no order items or products are loaded"""
+    items = serializers.SerializerMethodField()
+    class Meta:
+        model = Order
+        fields = ["id", "stripe_checkout_id", "amount", "item_count", "items", "status", "created_at"]
+
+    def get_items(self, order):
+        request = self.context.get("request")
+        items = []
+        for line in order.summary:
+            image = default_storage.url(line["image"]) if line["image"] else None
+            if image and request is not None:
+                image = request.build_absolute_uri(image)
+            items.append({**line, "image": image})
+        return items
+
+
 
 class CustomerAddressSerializer(serializers.ModelSerializer):
     customer = UserSerializer(read_only=True)
@@ -106,11 +130,10 @@ class CustomerAddressSerializer(serializers.ModelSerializer):
 
 
 class SimpleCartSerializer(serializers.ModelSerializer):
-    num_of_items = serializers.SerializerMethodField()
+    # Counter columns on the cart, no items are loaded
+    # A number, like CartSerializer's cart_total
+    cart_total = serializers.DecimalField(max_digits=12, decimal_places=2, coerce_to_string=False, read_only=True)
+
     class Meta:
         model = Cart 
-        fields = ["id", "cart_code", "num_of_items"]
-
-    def get_num_of_items(self, cart):
-        num_of_items = sum([item.quantity for item in cart.cartitems.all()])
-        return num_of_items
\ No newline at end of file
+        fields = ["id", "cart_code", "num_of_items", "cart_total"]
\ No newline at end of file
@@ -1,19 +1,127 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import ProductRating, Review, Product
-from django.db.models import Avg
+from .models import Review, Product, ProductCategory, StripePrice, Wishlist
+from .search import refresh_search_vectors, search_index
+from .autocomplete import autocomplete_index, record_changes
+from . import cache
+from . import ratings
+from .membership import forget_wishlist
+from .jobs import enqueue_on_commit
+from .tasks import warm_cache_soon
 
 @receiver(post_save, sender=Review)
-def update_product_rating_on_save(render, instance, **kwargs):
+def update_product_rating_on_save(sender, instance, created, **kwargs):
     """
-    Signal to update product rating when a review is creates or updated"""
-    product = instance.product
-    reviews = product.reviews.all()
-    total_reviews = reviews.count()
+    Signal to update product rating when a review is created or updated"""
+    loaded = instance.__dict__.setdefault('_loaded_values', {})
+    if created:
+        ratings.review_added(instance.product_id, int(instance.rating))
+    elif 'rating' in loaded:
+        ratings.review_changed(instance.product_id, int(loaded['rating']), int(instance.rating))
+    # What is counted now, for the next save or delete of this instance
+    loaded['rating'] = instance.rating
 
-    review_average = reviews.aggregate(Avg("rating"))["rating__avg"] or 0.0 
 
-    product_rating, created = ProductRating.objects.get_or_create(product=product)
-    product_rating.average_rating = review_average
-    product_rating.total_reviews = total_reviews
-    
\ No newline at end of file
+@receiver(post_delete, sender=Review)
+def update_product_rating_on_delete(sender, instance, **kwargs):
+    """
+    Signal to update product rating when a review is deleted"""
+    loaded = getattr(instance, '_loaded_values', {})
+    ratings.review_removed(instance.product_id, int(loaded.get('rating', instance.rating)))
+
+
+@receiver(post_save, sender=Product)
+def update_search_vector_on_product_save(sender, instance, **kwargs):
+    """Keep the product's search vector in sync with its name, description and category"""
+    refresh_search_vectors(Product.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=ProductCategory)
+def update_search_vector_on_category_save(sender, instance, created, **kwargs):
+    """The category name is part of every product's search vector"""
+    if not created:
+        refresh_search_vectors(Product.objects.filter(category=instance))
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductCategory)
+def invalidate_search_index_on_delete(sender, instance, **kwargs):
+    search_index.invalidate()
+
+
+@receiver(post_save, sender=Product)
+def update_autocomplete_on_product_save(sender, instance, **kwargs):
+    autocomplete_index.upsert('product', instance.pk, instance.name, instance.slug, instance.featured)
+    record_changes('product', [instance.pk])
+
+
+@receiver(post_save, sender=ProductCategory)
+def update_autocomplete_on_category_save(sender, instance, **kwargs):
+    autocomplete_index.upsert('category', instance.pk, instance.name, instance.slug)
+    record_changes('category', [instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_autocomplete(sender, instance, **kwargs):
+    autocomplete_index.remove('product', instance.pk)
+    record_changes('product', [instance.pk])
+
+
+@receiver(post_delete, sender=ProductCategory)
+def remove_category_from_autocomplete(sender, instance, **kwargs):
+    autocomplete_index.remove('category', instance.pk)
+    record_changes('category', [instance.pk])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_cached_product(sender, instance, **kwargs):
+    """Bump the cache namespaces of everything showing this product, before and after the change"""
+    loaded = getattr(instance, '_loaded_values', {})
+    slugs = {instance.slug, loaded.get('slug')}
+    category_ids = {instance.category_id, loaded.get('category_id')} - {None}
+    namespaces = ['search'] + [f'product:{slug}' for slug in slugs if slug]
+    if instance.featured or loaded.get('featured'):
+        namespaces.append('featured')
+    if category_ids:
+        category_slugs = ProductCategory.objects.filter(pk__in=category_ids).values_list('slug', flat=True)
+        namespaces += [f'category:{slug}' for slug in category_slugs]
+    cache.bump_on_commit(*namespaces)
+    warm_cache_soon()
+
+
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+def invalidate_cached_category(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_values', {})
+    slugs = {instance.slug, loaded.get('slug')}
+    cache.bump_on_commit('categories', 'search', *[f'category:{slug}' for slug in slugs if slug])
+    warm_cache_soon()
+
+
+@receiver(post_save, sender=Product)
+def optimize_new_product_image(sender, instance, **kwargs):
+    """Resizing uploads is slow, leave it to a background worker"""
+    loaded = getattr(instance, '_loaded_values', {})
+    if instance.image and instance.image.name != loaded.get('image'):
+        enqueue_on_commit('images.optimize', {'product_id': instance.pk},
+                          unique_key=f'images.optimize:{instance.pk}')
+
+
+@receiver(post_save, sender=Product)
+def refresh_prices_on_price_change(sender, instance, **kwargs):
+    """Cart totals and Stripe prices built on the old price are refreshed in the background"""
+    loaded = getattr(instance, '_loaded_values', {})
+    if 'price' not in loaded or loaded['price'] == instance.price:
+        return
+    enqueue_on_commit('carts.reprice', {'product_id': instance.pk},
+                      unique_key=f'carts.reprice:{instance.pk}')
+    if StripePrice.objects.filter(product=instance).exists():
+        enqueue_on_commit('stripe.sync_price', {'product_id': instance.pk},
+                          unique_key=f'stripe.sync_price:{instance.pk}')
+
+
+@receiver(post_save, sender=Wishlist)
+@receiver(post_delete, sender=Wishlist)
+def forget_wishlist_membership(sender, instance, **kwargs):
+    forget_wishlist(instance.user.email)
@@ -0,0 +1,101 @@
+"""
+Unique slugs for products and categories.
+
+A name whose slug is taken gets the lowest free "-N" suffix, as before, but
+the taken slugs are read with one prefix query instead of one exists() per
+candidate; saving 1,000 products named "T-Shirt" is 1,000 lookups, not
+500,000. allocate_many() assigns the slugs of a whole batch in memory, for
+bulk_create paths that skip save().
+
+Two saves can still pick the same free slug at the same time. The unique
+index turns that into an IntegrityError, and save_with_slug() allocates
+again and retries.
+"""
+from itertools import count
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.text import slugify
+
+# Characters kept free at the end of a long slug for the "-N" suffix
+SUFFIX_ROOM = 8
+
+SAVE_ATTEMPTS = 3
+
+CHUNK_SIZE = 100
+
+
+def _base(model, name):
+    return slugify(name or '') or model._meta.model_name
+
+
+def _max_length(model):
+    return model._meta.get_field('slug').max_length
+
+
+def _candidates(base, max_length):
+    yield base[:max_length]
+    for n in count(1):
+        suffix = f'-{n}'
+        yield base[:max_length - len(suffix)] + suffix
+
+
+def _prefix(base, max_length):
+    # Every candidate starts with this, whatever its suffix
+    return base[:max_length - SUFFIX_ROOM]
+
+
+def _first_free(base, max_length, taken):
+    for candidate in _candidates(base, max_length):
+        if candidate not in taken:
+            return candidate
+
+
+def _taken(model, prefixes):
+    query = Q()
+    for prefix in prefixes:
+        query |= Q(slug__startswith=prefix)
+    return set(model._default_manager.filter(query).values_list('slug', flat=True))
+
+
+def allocate(model, name):
+    """A slug for `name` that no `model` row has yet, in one query."""
+    base, max_length = _base(model, name), _max_length(model)
+    return _first_free(base, max_length, _taken(model, [_prefix(base, max_length)]))
+
+
+def allocate_many(model, names):
+    """
+    Slugs for a batch of new rows, unique among themselves and against the
+    table; one query per CHUNK_SIZE distinct base slugs.
+    """
+    max_length = _max_length(model)
+    bases = [_base(model, name) for name in names]
+    prefixes = sorted({_prefix(base, max_length) for base in bases})
+    taken = set()
+    for start in range(0, len(prefixes), CHUNK_SIZE):
+        taken |= _taken(model, prefixes[start:start + CHUNK_SIZE])
+    slugs = []
+    for base in bases:
+        slug = _first_free(base, max_length, taken)
+        taken.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+def save_with_slug(instance, save, *args, **kwargs):
+    """Run `save` (the model's own save), allocating a slug first if it has none."""
+    if instance.slug:
+        return save(*args, **kwargs)
+    model = type(instance)
+    for attempt in range(SAVE_ATTEMPTS):
+        instance.slug = allocate(model, instance.name)
+        try:
+            with transaction.atomic():
+                return save(*args, **kwargs)
+        except IntegrityError:
+            # Another save took the slug meanwhile: pick again. Anything else is not ours
+            lost_race = model._default_manager.filter(slug=instance.slug).exists()
+            instance.slug = ''
+            if not lost_race or attempt == SAVE_ATTEMPTS - 1:
+                raise
@@ -0,0 +1,73 @@
+"""
+A local stand-in for the Stripe API, for the tests and `manage.py benchmark`.
+
+Point STRIPE_API_BASE at `StripeStub().url` and call payments.reset() so the
+shared client is rebuilt against it.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class StripeStub:
+    """
+    A local stand-in for the Stripe API. Records every request as
+    (method, path, form fields, headers) and answers with a canned object.
+    Connections are kept alive; `connections` holds the client port of each request.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.connections = []
+        self.responses = {}  # (method, path) -> list of (status, body[, delay]), the last one repeats
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.answer()
+
+            def do_POST(self):
+                self.answer()
+
+            def answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = parse_qs(self.rfile.read(length).decode())
+                stub.requests.append((self.command, self.path, form, dict(self.headers)))
+                stub.connections.append(self.client_address[1])
+                status, body, delay = stub.respond(self.command, self.path, len(stub.requests))
+                time.sleep(delay)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        # Clients that hit their timeout hang up mid-response
+        self.server.handle_error = lambda request, client_address: None
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method, path, number):
+        queued = self.responses.get((method, path))
+        if queued:
+            status, body, *delay = queued.pop(0) if len(queued) > 1 else queued[0]
+            return status, body, delay[0] if delay else 0
+        kind = path.rstrip('/').rsplit('/', 1)[-1]
+        prefix = {'products': 'prod', 'prices': 'price', 'sessions': 'cs_test'}.get(kind, 'obj')
+        return 200, {'id': f'{prefix}_{number}', 'object': kind.rstrip('s'), 'url': f'https://stripe.test/{number}'}, 0
+
+    def calls(self, path):
+        return [form for method, request_path, form, headers in self.requests if request_path == path]
@@ -0,0 +1,144 @@
+"""
+Background tasks run by `manage.py runworkers` (see apiApp/jobs.py).
+
+ratings.rebuild runs daily, carts.cleanup and autocomplete.prune hourly on
+their own; the other tasks are queued by the code that needs them.
+"""
+import logging
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import RequestFactory
+from django.urls import reverse
+
+from . import autocomplete, payments, webhooks
+from .carts import purge_abandoned, reconcile_counters
+from .checkout import sync_price
+from .jobs import enqueue_on_commit, task
+from .models import Cart, Product
+
+logger = logging.getLogger(__name__)
+
+
+@task('webhooks.drain', max_attempts=3)
+def drain_webhooks(batch_size=50):
+    """Process every due Stripe event; each event keeps its own retry schedule."""
+    while webhooks.drain(batch_size):
+        pass
+
+
+@task('ratings.rebuild', max_attempts=1, every=24 * 3600)
+def rebuild_ratings():
+    """Full recount of every product rating, to repair drift in the incremental counters."""
+    call_command('rebuild_ratings', stdout=_LogStream())
+
+
+@task('carts.cleanup', every=3600)
+def cleanup_carts(days=None, batch_size=500):
+    """Purge carts nobody has touched for CART_RETENTION_DAYS (see carts.purge_abandoned)."""
+    stats = purge_abandoned(days, batch_size=batch_size)
+    logger.info("Purged %(carts)s abandoned carts and %(items)s items in %(seconds)ss", stats)
+
+
+@task('autocomplete.prune', every=3600)
+def prune_autocomplete_changes():
+    """Drop the autocomplete changes every worker has had time to apply."""
+    autocomplete.prune_changes()
+
+
+@task('carts.reprice')
+def reprice_carts(product_id):
+    """Recompute the stored totals of the carts holding a product whose price changed."""
+    reconcile_counters(Cart.objects.filter(cartitems__product_id=product_id))
+
+
+@task('images.optimize')
+def optimize_product_image(product_id):
+    """
+    Shrink an uploaded product image to PRODUCT_IMAGE_MAX_SIZE pixels on its
+    longest side. The smaller copy is saved under a new name and the product
+    switched to it; the original is only deleted after that, so a failure
+    anywhere leaves the product with a working image.
+    """
+    from PIL import Image
+
+    product = Product.objects.filter(pk=product_id).only('image').first()
+    if product is None or not product.image:
+        return
+    max_size = getattr(settings, 'PRODUCT_IMAGE_MAX_SIZE', 1200)
+    with product.image.open('rb') as source, Image.open(source) as image:
+        if max(image.size) <= max_size:
+            return
+        image_format = image.format
+        image.thumbnail((max_size, max_size))
+        resized = BytesIO()
+        image.save(resized, format=image_format)
+    storage, original = product.image.storage, product.image.name
+    # The original exists, so the storage picks a free name next to it
+    name = storage.save(original, ContentFile(resized.getvalue()))
+
+    with transaction.atomic():
+        product = Product.objects.select_for_update().filter(pk=product_id).first()
+        # Unless the image was replaced meanwhile; that upload gets its own job
+        swapped = product is not None and product.image.name == original
+        if swapped:
+            product.image.name = name
+            # Already optimized, don't let the post_save signal queue it again
+            product._loaded_values['image'] = name
+            product.save(update_fields=['image', 'updated_at'])
+    storage.delete(original if swapped else name)
+
+
+@task('stripe.sync_price')
+def sync_stripe_price(product_id):
+    """Create the Stripe Price for a product's new price ahead of its next checkout."""
+    product = Product.objects.select_related('stripe_price').filter(pk=product_id).first()
+    if product is not None:
+        sync_price(product, payments.client())
+
+
+def cache_warm_enabled():
+    return bool(getattr(settings, 'CACHE_WARM_URL', None))
+
+
+def warm_cache_soon():
+    """Queue a cache warm a few seconds out; a burst of catalog edits warms once."""
+    if cache_warm_enabled():
+        enqueue_on_commit('cache.warm', delay=5, unique_key='cache.warm')
+
+
+@task('cache.warm', max_attempts=2)
+def warm_cache():
+    """
+    Render the most requested catalog pages so the first visitor after an
+    edit is served from the cache. CACHE_WARM_URL is the public site root,
+    image links in the cached responses are built from it.
+    """
+    from .views import CategoryList, ProductList
+
+    if not cache_warm_enabled():
+        return
+    site = urlsplit(settings.CACHE_WARM_URL)
+    secure = site.scheme == 'https'
+    factory = RequestFactory(SERVER_NAME=site.hostname, SERVER_PORT=str(site.port or (443 if secure else 80)))
+    for view, name in ((ProductList, 'product-list'), (CategoryList, 'category_list')):
+        # secure= sets the scheme; the factory's own wsgi.url_scheme is overridden per request
+        response = view.as_view()(factory.get(reverse(name), secure=secure))
+        if response.status_code != 200:
+            logger.warning("Cache warm of %s answered %s", name, response.status_code)
+
+
+class _LogStream:
+    """Management command output, sent to the log instead of a terminal."""
+
+    def write(self, message):
+        message = message.rstrip()
+        if message:
+            logger.info(message)
+
+    def flush(self):
+        pass
@@ -1,3 +1,1739 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import importlib
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import skipIf
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from PIL import Image
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, modify_settings, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+
+from . import cache as response_cache
+from . import autocomplete, carts, checkout, instrumentation, jobs, orders, payments, slugs, tasks, views, webhooks
+from .models import (
+    AutocompleteChange, Cart, CartItem, CustomUser, Job, Order, OrderItem, Product, ProductCategory, ProductRating,
+    Review, StripePrice, WebhookEvent, Wishlist,
+)
+from .benchmark import ENDPOINTS, Benchmark, compare
+from .seeding import Seeder
+from .stripe_stub import StripeStub
+
+TESTDATA = Path(__file__).resolve().parent / 'testdata'
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
+# Without a collected static manifest, and with a media storage for image URLs
+FILE_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def run_concurrently(target, count):
+    """Start ``count`` threads on ``target`` at the same moment and collect what they return."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def worker(index):
+        barrier.wait()
+        results[index] = target()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SlowComputation:
+    def __init__(self, value='fresh', delay=0.2):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return self.value
+
+
+class CartLoadingTests(TestCase):
+    def cart(self, code, size):
+        cart = Cart.objects.create(cart_code=code)
+        products = [
+            Product.objects.create(name=f'{code} item {n}', description=f'{code} item {n}', price='2.50')
+            for n in range(size)
+        ]
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=product, quantity=2) for product in products])
+        return cart
+
+    def test_items_and_products_load_in_two_queries(self):
+        for size in (1, 30):
+            cart = self.cart(f'CART{size:07}', size)
+            with self.assertNumQueries(2):
+                data = self.client.get(f'/api/cart/{cart.pk}/').json()
+            self.assertEqual(len(data['cartitems']), size)
+            self.assertEqual(data['cartitems'][0]['sub_total'], 5.0)
+            self.assertEqual(data['cart_total'], 5.0 * size)
+            # Plus the validator lookup of the conditional GET
+            with self.assertNumQueries(3):
+                self.assertEqual(self.client.get(f'/api/get_cart/{cart.cart_code}').json(), data)
+
+
+class CartMutationTests(TestCase):
+    def setUp(self):
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50')
+
+    def add(self, product_id=None):
+        return self.client.post('/api/cart/add/', json.dumps({'cart_code': 'CART0000001',
+                                                              'product_id': product_id or self.mug.pk}),
+                                content_type='application/json')
+
+    def update(self, item_id, quantity):
+        return self.client.patch(f'/api/cart/updateItem/{item_id}/', json.dumps({'quantity': quantity}),
+                                 content_type='application/json')
+
+    def counters(self):
+        return Cart.objects.values_list('num_of_items', 'cart_total').get()
+
+    def test_add_creates_then_increments(self):
+        self.assertEqual(self.add().status_code, 201)
+        response = self.add()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+        self.assertEqual(self.add(product_id=999999).status_code, 404)
+
+    def test_existing_row_is_not_reported_as_created(self):
+        self.add()
+        # A row left at 0 by an older client is updated, not created
+        CartItem.objects.update(quantity=0)
+        self.assertEqual(self.add().status_code, 200)
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_add_after_removal_creates_again(self):
+        self.add()
+        self.client.delete(f'/api/cart/delete/{CartItem.objects.get().pk}/')
+        self.assertEqual(self.add().status_code, 201)
+
+    def test_decrement_to_zero_or_below_removes_the_item(self):
+        self.add()
+        self.add()
+        item = CartItem.objects.get()
+        self.assertEqual(self.update(item.pk, -1).json()['quantity'], 1)
+        self.assertEqual(self.update(item.pk, -5).status_code, 204)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.counters(), (0, Decimal('0.00')))
+        self.assertEqual(self.update(item.pk, 1).status_code, 404)
+        self.assertEqual(self.update(item.pk, 'x').status_code, 400)
+
+
+@skipIf(connection.vendor == 'sqlite', "SQLite serializes writers by failing them, not by waiting")
+class ConcurrentCartTests(TransactionTestCase):
+    def test_concurrent_adds_all_count(self):
+        mug = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        Cart.objects.create(cart_code='CART0000001')
+
+        def add():
+            try:
+                return Client().post('/api/cart/add/', json.dumps({'cart_code': 'CART0000001', 'product_id': mug.pk}),
+                                     content_type='application/json').status_code
+            finally:
+                connection.close()
+
+        statuses = run_concurrently(add, 8)
+        self.assertEqual(sorted(statuses), [200] * 7 + [201])
+        self.assertEqual(CartItem.objects.get().quantity, 8)
+        self.assertEqual(Cart.objects.values_list('num_of_items', 'cart_total').get(), (8, Decimal('100.00')))
+
+
+class BulkCartTests(TestCase):
+    def setUp(self):
+        self.products = [
+            Product.objects.create(name=f'Product {n}', description=f'Product {n}', price='2.00') for n in range(20)
+        ]
+
+    def bulk(self, operations, cart_code='CART0000001'):
+        return self.client.post('/api/cart/bulk/', json.dumps({'cart_code': cart_code, 'operations': operations}),
+                                content_type='application/json')
+
+    def quantities(self):
+        return dict(CartItem.objects.values_list('product_id', 'quantity'))
+
+    def test_operations_create_update_and_delete_items(self):
+        first, second, third = (product.pk for product in self.products[:3])
+        self.bulk([{'product_id': first, 'quantity': 2}, {'product_id': second}])
+        response = self.bulk([
+            {'product_id': first, 'quantity': 3}, {'product_id': first, 'quantity': -1},
+            {'product_id': second, 'quantity': -1}, {'product_id': third, 'quantity': -2},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {first: 4})
+        self.assertEqual(response.json()['cart_total'], 8.0)
+
+    def test_query_count_does_not_grow_with_the_operations(self):
+        self.bulk([{'product_id': self.products[0].pk}], cart_code='WARM0000001')
+        for count, cart_code in ((2, 'CART0000001'), (20, 'CART0000002')):
+            operations = [{'product_id': product.pk, 'quantity': 2} for product in self.products[:count]]
+            self.bulk(operations[:count // 2], cart_code)
+            with self.assertNumQueries(11):
+                self.assertEqual(self.bulk(operations, cart_code).status_code, 200)
+
+    def test_bad_requests_change_nothing(self):
+        response = self.bulk([{'product_id': self.products[0].pk}, {'product_id': 999999}])
+        self.assertEqual((response.status_code, response.json()['product_ids']), (404, [999999]))
+        self.assertEqual(self.bulk([{'quantity': 1}]).status_code, 400)
+        self.assertEqual(self.bulk([]).status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_oversized_requests_are_rejected(self):
+        operation = {'product_id': self.products[0].pk}
+        self.assertEqual(self.bulk([operation], cart_code='C' * (Cart.cart_code_length_limit + 1)).status_code, 400)
+        self.assertEqual(self.bulk([operation] * (carts.MAX_OPERATIONS + 1)).status_code, 400)
+        self.assertEqual(self.bulk([operation] * carts.MAX_OPERATIONS).status_code, 200)
+        self.assertEqual(self.quantities(), {self.products[0].pk: carts.MAX_OPERATIONS})
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name='Cotton Shirt', description='A shirt', price='20.00')
+        Product.objects.create(name='Linen Trousers', description='Go with a cotton shirt', price='40.00')
+        Product.objects.create(name='Red Hat', description='A hat', price='15.00')
+
+    def test_name_matches_rank_first(self):
+        response = self.client.get('/api/search/', {'query': 'cotton shirts'})
+        self.assertEqual([product['name'] for product in response.json()['results']],
+                         ['Cotton Shirt', 'Linen Trousers'])
+
+    def test_no_matches_is_an_empty_page(self):
+        response = self.client.get('/api/search/', {'query': 'umbrella'})
+        self.assertEqual((response.status_code, response.json()['results']), (200, []))
+        response = self.client.get('/api/search/', {'query': 'umbrella', 'stream': 1})
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [])
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(name=f'Shirt {n}', description=f'Shirt {n}', price='5.00', featured=True)
+            for n in range(7)
+        ]
+
+    def walk(self, path, params):
+        """Every row of a cursor-paginated list, following the next links, and the page count."""
+        rows, pages = [], 0
+        response = self.client.get(path, params)
+        while True:
+            data = response.json()
+            rows += data['results']
+            pages += 1
+            if not data['next']:
+                return rows, pages
+            response = self.client.get(data['next'])
+
+    def test_pages_follow_the_ordering(self):
+        rows, pages = self.walk('/api/allproducts/', {'page_size': 3})
+        self.assertEqual(([row['id'] for row in rows], pages), ([p.pk for p in self.products], 3))
+        streamed = self.client.get('/api/allproducts/', {'stream': 1})
+        self.assertEqual([row['id'] for row in json.loads(b''.join(streamed.streaming_content))],
+                         [p.pk for p in self.products])
+
+    def test_ties_are_broken_by_id(self):
+        Order.objects.bulk_create([
+            Order(stripe_checkout_id=f'cs_{n}', amount=5, currency='usd', customer_email='ada@example.com',
+                  status='Paid')
+            for n in range(5)
+        ])
+        Order.objects.update(created_at=timezone.now())
+        rows, pages = self.walk('/api/get_orders', {'email': 'ada@example.com', 'page_size': 2})
+        ids = list(Order.objects.order_by('-id').values_list('id', flat=True))
+        self.assertEqual(([row['id'] for row in rows], pages), (ids, 3))
+
+        # Every product ranks the same for this search
+        rows, pages = self.walk('/api/search/', {'query': 'shirt', 'page_size': 2})
+        self.assertEqual(([row['id'] for row in rows], pages), ([p.pk for p in self.products], 4))
+
+    def test_previous_link_returns_the_page_before(self):
+        first = self.client.get('/api/allproducts/', {'page_size': 3}).json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(self.client.get(second['previous']).json()['results'], first['results'])
+
+    def test_wishlist_pages_take_the_same_queries_at_any_size(self):
+        user = CustomUser.objects.create(username='ada', email='ada@example.com')
+        Wishlist.objects.bulk_create([Wishlist(user=user, product=product) for product in self.products])
+        Wishlist.objects.update(created=timezone.now())
+        for page_size in (1, 7):
+            with self.assertNumQueries(1):
+                data = self.client.get('/api/my_wishlists', {'email': user.email, 'page_size': page_size}).json()
+            self.assertEqual(len(data['results']), page_size)
+        rows, pages = self.walk('/api/my_wishlists', {'email': user.email, 'page_size': 3})
+        self.assertEqual(([row['product']['id'] for row in rows], pages), ([p.pk for p in self.products][::-1], 3))
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        ProductCategory.objects.create(name='Shirts')
+        Product.objects.create(name='Blue Cotton Shirt', description='A shirt', price='20.00')
+        Product.objects.create(name='Cotton Socks', description='Socks', price='5.00', featured=True)
+        Product.objects.create(name='Red Hat', description='A hat', price='15.00')
+        autocomplete.autocomplete_index.rebuild()
+
+    def suggest(self, query):
+        response = self.client.get('/api/search/suggest', {'query': query})
+        return [suggestion['name'] for suggestion in response.json()['suggestions']]
+
+    def test_prefix_and_mid_word_matches(self):
+        # Featured products rank before the others
+        self.assertEqual(self.suggest('cot'), ['Cotton Socks', 'Blue Cotton Shirt'])
+        # The exact match, then "cotton so" one typo away
+        self.assertEqual(self.suggest('Cotton sh'), ['Blue Cotton Shirt', 'Cotton Socks'])
+        self.assertEqual(self.suggest('hat'), ['Red Hat'])
+
+    def test_typos(self):
+        # Categories first at the same distance
+        self.assertEqual(self.suggest('shrit'), ['Shirts', 'Blue Cotton Shirt'])
+        self.assertEqual(self.suggest('cottno'), ['Cotton Socks', 'Blue Cotton Shirt'])
+        # Too short to guess
+        self.assertEqual(self.suggest('ht'), [])
+
+    def test_signals_keep_the_index_current(self):
+        scarf = Product.objects.create(name='Wool Scarf', description='A scarf', price='12.00')
+        self.assertEqual(self.suggest('wool'), ['Wool Scarf'])
+        scarf.name = 'Silk Scarf'
+        scarf.save()
+        self.assertEqual((self.suggest('wool'), self.suggest('silk')), ([], ['Silk Scarf']))
+        scarf.delete()
+        ProductCategory.objects.get().delete()
+        self.assertEqual((self.suggest('scarf'), self.suggest('shirts')), ([], ['Blue Cotton Shirt']))
+
+    def test_rebuild_keeps_serving_and_replays_updates(self):
+        load = autocomplete._Index.load
+        during = []
+
+        def slow_load():
+            index = load()
+            # A lookup from another request, and a save the new index was loaded without
+            lookup = threading.Thread(target=lambda: during.append(self.suggest('red')))
+            lookup.start()
+            lookup.join(timeout=5)
+            Product.objects.create(name='Red Scarf', description='A red scarf', price='9.00')
+            return index
+
+        with mock.patch.object(autocomplete._Index, 'load', side_effect=slow_load):
+            autocomplete.autocomplete_index.rebuild()
+        self.assertEqual(during, [['Red Hat']])
+        self.assertEqual(self.suggest('red'), ['Red Hat', 'Red Scarf'])
+
+    def test_database_serves_until_the_background_build_is_done(self):
+        index = autocomplete.AutocompleteIndex()
+        with mock.patch.object(autocomplete.threading, 'Thread') as thread:
+            # Whole name prefixes only
+            self.assertEqual([s['name'] for s in index.suggest('cot')], ['Cotton Socks'])
+            self.assertEqual([s['name'] for s in index.suggest('shirt')], ['Shirts'])
+        thread.assert_called_once_with(target=index._update, name='autocomplete-update', daemon=True)
+        index.rebuild()
+        self.assertEqual([s['name'] for s in index.suggest('cot')], ['Cotton Socks', 'Blue Cotton Shirt'])
+
+    def test_sync_applies_the_writes_of_other_workers(self):
+        index = autocomplete.autocomplete_index
+        hat = Product.objects.get(name='Red Hat')
+        # Written by another process: no signal reached this one's index
+        Product.objects.filter(pk=hat.pk).update(name='Green Hat')
+        Product.objects.filter(name='Cotton Socks').update(featured=False)
+        Product.objects.filter(name='Blue Cotton Shirt').update(featured=True)
+        cotton = Product.objects.filter(name__contains='Cotton').values_list('pk', flat=True)
+        autocomplete.record_changes('product', [hat.pk, *cotton, 999999])
+        self.assertEqual(self.suggest('green'), [])
+
+        with mock.patch.object(autocomplete._Index, 'load') as load, self.assertNumQueries(3):
+            index.sync()
+        load.assert_not_called()
+        self.assertEqual((self.suggest('green'), self.suggest('red')), (['Green Hat'], []))
+        self.assertEqual(self.suggest('cot'), ['Blue Cotton Shirt', 'Cotton Socks'])
+        # Each change is applied once, a later sync only reads the log
+        with self.assertNumQueries(1):
+            index.sync()
+
+    def test_recorded_rebuild_and_old_indexes_rebuild(self):
+        index = autocomplete.autocomplete_index
+        autocomplete.record_rebuild()
+        with mock.patch.object(autocomplete._Index, 'load', wraps=autocomplete._Index.load) as load:
+            index.sync()
+            self.assertEqual(load.call_count, 1)
+            index._synced_at -= autocomplete.CHANGE_RETENTION
+            index.sync()
+            self.assertEqual(load.call_count, 2)
+
+    @override_settings(AUTOCOMPLETE_SYNC_SECONDS=0)
+    def test_sync_runs_in_the_background(self):
+        index = autocomplete.autocomplete_index
+        self.addCleanup(setattr, index, '_updating', False)
+        with mock.patch.object(autocomplete.threading, 'Thread') as thread:
+            self.assertEqual(self.suggest('hat'), ['Red Hat'])
+            self.assertEqual(self.suggest('hat'), ['Red Hat'])
+        thread.assert_called_once_with(target=index._update, name='autocomplete-update', daemon=True)
+
+    def test_old_changes_are_pruned(self):
+        AutocompleteChange.objects.update(created_at=timezone.now() - timedelta(days=2))
+        recent = AutocompleteChange.objects.create(kind='product', object_id=1)
+        self.assertGreater(autocomplete.prune_changes(), 0)
+        self.assertEqual(list(AutocompleteChange.objects.all()), [recent])
+
+    def test_index_matches_a_scan_of_the_names(self):
+        index = autocomplete._Index()
+        names = ['Shirt', 'Short', 'Shoe', 'Sheep', 'Shirt Dress', 'Blue Shirt', 'Ship', 'Sh', 'S']
+        for pk, name in enumerate(names * 5, 1):
+            index.add(pk, 'product', f'{name} {pk % 7}', f'p-{pk}', featured=pk % 3 == 0)
+        # Cached matches stay right through removals and additions
+        for pk in range(1, 46, 4):
+            index.best_keys('sh')
+            index.remove(pk)
+        index.add(100, 'product', 'Shawl', 'shawl', featured=True)
+        for prefix in ('s', 'sh', 'shi', 'shirt', 'shirt d', 'blue s', 'q'):
+            expected = sorted(
+                (key for key, entry in index.entries.items()
+                 if any(s.startswith(prefix) for s in autocomplete._suffixes(autocomplete.normalize(entry[1])))),
+                key=index.order,
+            )[:autocomplete.MAX_SUGGESTIONS]
+            self.assertEqual(index.best_keys(prefix), expected, prefix)
+        fresh = autocomplete._Index()
+        fresh.suffixes = sorted(index.suffixes)
+        fresh.entries = index.entries
+        fresh.precompute()
+        self.assertEqual({prefix: fresh.top[prefix] for prefix in ('s', 'sh', 'shi')},
+                         {prefix: index.best_keys(prefix) for prefix in ('s', 'sh', 'shi')})
+
+
+@override_settings(CACHES=LOCMEM_CACHE, STORAGES=FILE_STORAGES, ALLOWED_HOSTS=['testserver', 'shop.example.com'])
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = ProductCategory.objects.create(name='Mugs')
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50', category=self.category,
+                                          image='products/mug.jpg')
+
+    def price(self):
+        return self.client.get('/api/product/mug/').json()['price']
+
+    def test_product_changes_are_served_once_committed(self):
+        self.assertEqual(self.price(), '12.50')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mug.price = '15.00'
+            self.mug.save()
+            # Read before the commit: still the old version, nothing new gets cached
+            self.assertEqual(self.price(), '12.50')
+        self.assertEqual(self.price(), '15.00')
+
+    def test_category_changes_are_served_once_committed(self):
+        self.assertEqual(self.client.get('/api/categories/').json()[0]['name'], 'Mugs')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Cups'
+            self.category.save()
+            self.assertEqual(self.client.get('/api/categories/').json()[0]['name'], 'Mugs')
+        self.assertEqual(self.client.get('/api/categories/').json()[0]['name'], 'Cups')
+
+    def test_image_urls_are_cached_per_host(self):
+        first = self.client.get('/api/product/mug/').json()['image']
+        second = self.client.get('/api/product/mug/', HTTP_HOST='shop.example.com', secure=True).json()['image']
+        self.assertTrue(first.startswith('http://testserver/'))
+        self.assertTrue(second.startswith('https://shop.example.com/'))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class GetOrComputeTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_misses_compute_once(self):
+        compute = SlowComputation()
+        results = run_concurrently(lambda: response_cache.get_or_compute('hot', compute, timeout=60), 20)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(results, ['fresh'] * 20)
+
+    def test_expired_entry_is_served_stale_while_one_caller_refreshes(self):
+        cache.set('hot', ('stale', 0.0, time.time() - 1), 60)
+        compute = SlowComputation()
+        started = time.monotonic()
+        results = run_concurrently(lambda: response_cache.get_or_compute('hot', compute, timeout=60), 10)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(results.count('fresh'), 1)
+        self.assertEqual(results.count('stale'), 9)
+        self.assertEqual(response_cache.get_or_compute('hot', compute, timeout=60), 'fresh')
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_waits_for_a_refresh_running_in_another_worker(self):
+        # The lock is held elsewhere and there is nothing stale to serve
+        cache.add('hot:lock', 1)
+
+        def finish_elsewhere():
+            time.sleep(0.2)
+            cache.set('hot', ('from other worker', 0.0, time.time() + 60), 60)
+
+        threading.Thread(target=finish_elsewhere).start()
+        compute = SlowComputation()
+        self.assertEqual(response_cache.get_or_compute('hot', compute, timeout=60), 'from other worker')
+        self.assertEqual(compute.calls, 0)
+
+    def test_stops_waiting_when_the_other_worker_stores_nothing(self):
+        cache.add('hot:lock', 1)
+
+        def fail_elsewhere():
+            time.sleep(0.2)
+            cache.delete('hot:lock')
+
+        threading.Thread(target=fail_elsewhere).start()
+        compute = SlowComputation(delay=0)
+        started = time.monotonic()
+        self.assertEqual(response_cache.get_or_compute('hot', compute, timeout=60), 'fresh')
+        self.assertEqual(compute.calls, 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_entry_close_to_expiry_is_refreshed_early(self):
+        # Slow to compute and one second from expiry: XFetch refreshes it
+        cache.set('hot', ('old', 1000.0, time.time() + 1), 60)
+        compute = SlowComputation(delay=0)
+        self.assertEqual(response_cache.get_or_compute('hot', compute, timeout=60), 'fresh')
+        self.assertEqual(compute.calls, 1)
+
+    def test_fresh_entry_is_not_recomputed(self):
+        cache.set('hot', ('cached', 0.001, time.time() + 60), 60)
+        compute = SlowComputation(delay=0)
+        self.assertEqual(response_cache.get_or_compute('hot', compute, timeout=60), 'cached')
+        self.assertEqual(compute.calls, 0)
+
+    def test_errors_reach_every_waiting_caller_and_are_not_cached(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            time.sleep(0.2)
+            raise ValueError('database down')
+
+        def call():
+            try:
+                response_cache.get_or_compute('hot', failing, timeout=60)
+            except ValueError as error:
+                return str(error)
+
+        self.assertEqual(run_concurrently(call, 5), ['database down'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(cache.get('hot'))
+        self.assertIsNone(cache.get('hot:lock'))
+
+    def test_entries_are_kept_briefly_unless_the_cache_is_shared(self):
+        self.assertFalse(response_cache.is_shared())
+        self.assertEqual((response_cache.cache_timeout(), response_cache.stale_timeout()), (15, 5))
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache:6379'}}
+        with override_settings(CACHES=redis):
+            self.assertTrue(response_cache.is_shared())
+            self.assertEqual((response_cache.cache_timeout(), response_cache.stale_timeout()), (300, 60))
+            with override_settings(CATALOG_CACHE_TIMEOUT=30):
+                self.assertEqual(response_cache.cache_timeout(), 30)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        self.client.post('/api/cart/add/', json.dumps({'cart_code': 'CART0000001', 'product_id': self.mug.pk}),
+                         content_type='application/json')
+
+    def settle(self):
+        """Move every write out of the current second, as if made a while ago."""
+        earlier = timezone.now() - timedelta(seconds=10)
+        Product.objects.update(updated_at=earlier)
+        Cart.objects.update(updated_at=earlier)
+
+    def test_matching_etag_is_not_modified(self):
+        for path in ('/api/product/mug/', '/api/get_cart/CART0000001', '/api/get_cart_stat?cart_code=CART0000001'):
+            etag = self.client.get(path)['ETag']
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_modified_since(self):
+        self.settle()
+        for path in ('/api/product/mug/', '/api/get_cart/CART0000001'):
+            last_modified = self.client.get(path)['Last-Modified']
+            self.assertEqual(self.client.get(path, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        self.client.post('/api/cart/add/', json.dumps({'cart_code': 'CART0000001', 'product_id': self.mug.pk}),
+                         content_type='application/json')
+        response = self.client.get('/api/get_cart/CART0000001', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_no_last_modified_within_the_second_of_a_write(self):
+        response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'})
+        self.assertNotIn('Last-Modified', response)
+        # A date covering the write is not trusted for a 304 either
+        response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'},
+                                   HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 1))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cart_totals_are_numbers_in_both_views(self):
+        stat = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'}).json()
+        cart = self.client.get('/api/get_cart/CART0000001').json()
+        self.assertEqual((stat['cart_total'], cart['cart_total']), (12.5, 12.5))
+
+
+class RatingCounterTests(TestCase):
+    def setUp(self):
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        self.users = [
+            CustomUser.objects.create(username=f'user{n}', email=f'user{n}@example.com') for n in range(3)
+        ]
+
+    def review(self, user, rating):
+        return Review.objects.create(product=self.mug, user=user, rating=rating, comment='Fine')
+
+    def rating(self):
+        return ProductRating.objects.values_list('total_reviews', 'rating_sum', 'average_rating').get()
+
+    def test_review_writes_adjust_the_counters(self):
+        reviews = [self.review(user, rating) for user, rating in zip(self.users, (5, 4, 3))]
+        self.assertEqual(self.rating(), (3, 12, 4.0))
+
+        review = Review.objects.get(pk=reviews[2].pk)
+        review.rating = 1
+        review.save()
+        self.assertEqual(self.rating(), (3, 10, 10 / 3))
+
+        reviews[0].delete()
+        self.assertEqual(self.rating(), (2, 5, 2.5))
+        Review.objects.filter(pk__in=[reviews[1].pk, reviews[2].pk]).delete()
+        self.assertEqual(self.rating(), (0, 0, 0.0))
+
+    def test_migration_fills_the_counters_of_existing_ratings(self):
+        for user, rating in zip(self.users, (5, 4, 2)):
+            self.review(user, rating)
+        # As left by adding rating_sum with its default
+        ProductRating.objects.update(rating_sum=0)
+        other = Product.objects.create(name='Cap', description='A cap', price='5.00')
+        Review.objects.create(product=other, user=self.users[0], rating=3, comment='Ok')
+        ProductRating.objects.filter(product=other).delete()
+
+        migration = importlib.import_module('apiApp.migrations.0014_productrating_rating_sum')
+        migration.fill_rating_counters(apps, None)
+        ratings = ProductRating.objects.order_by('product_id').values_list(
+            'total_reviews', 'rating_sum', 'average_rating')
+        self.assertEqual(list(ratings), [(3, 11, 11 / 3), (1, 3, 3.0)])
+        # Deleting a review counted before the migration stays consistent
+        Review.objects.filter(product=self.mug, rating=5).delete()
+        self.assertEqual(ProductRating.objects.get(product=self.mug).rating_sum, 6)
+
+
+class FulfilmentTests(TestCase):
+    session = {'id': 'cs_1', 'amount_total': 2498, 'currency': 'usd', 'customer_email': 'ada@example.com'}
+
+    def setUp(self):
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.49')
+        self.cup = Product.objects.create(name='Cup', description='A cup', price='3.00')
+        cart = Cart.objects.create(cart_code='CART0000001')
+        CartItem.objects.create(cart=cart, product=self.mug, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.cup)
+
+    def test_paid_cart_becomes_an_order(self):
+        order = orders.fulfill_checkout(self.session, 'CART0000001')
+        self.assertEqual((order.amount, order.customer_email, order.status), (2498, 'ada@example.com', 'Paid'))
+        self.assertEqual(
+            list(order.items.order_by('id').values_list('product__name', 'quantity')), [('Mug', 2), ('Cup', 1)]
+        )
+        self.assertEqual(order.item_count, 3)
+        self.assertEqual([(line['name'], line['price']) for line in order.summary], [('Mug', '12.49'), ('Cup', '3.00')])
+        self.assertFalse(Cart.objects.filter(cart_code='CART0000001').exists())
+
+    def test_replayed_session_changes_nothing(self):
+        order = orders.fulfill_checkout(self.session, 'CART0000001')
+        # A cart with the same code again, as if the shopper kept shopping
+        CartItem.objects.create(cart=Cart.objects.create(cart_code='CART0000001'), product=self.mug)
+        self.assertEqual(orders.fulfill_checkout(self.session, 'CART0000001'), order)
+        self.assertEqual((Order.objects.count(), OrderItem.objects.count()), (1, 2))
+        self.assertTrue(Cart.objects.filter(cart_code='CART0000001').exists())
+
+    def test_failure_rolls_back_the_whole_fulfilment(self):
+        with mock.patch.object(OrderItem.objects, 'bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                orders.fulfill_checkout(self.session, 'CART0000001')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Cart.objects.get(cart_code='CART0000001').cartitems.count(), 2)
+        # The retry fulfils it
+        self.assertEqual(orders.fulfill_checkout(self.session, 'CART0000001').items.count(), 2)
+
+    def test_missing_cart_still_records_the_payment(self):
+        order = orders.fulfill_checkout(self.session, 'CART9999999')
+        self.assertEqual((order.amount, order.items.count(), order.summary), (2498, 0, []))
+        self.assertTrue(Cart.objects.filter(cart_code='CART0000001').exists())
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.49')
+        for n, quantity in enumerate((2, 1)):
+            CartItem.objects.create(cart=Cart.objects.create(cart_code=f'CART000000{n}'), product=self.mug,
+                                    quantity=quantity)
+            orders.fulfill_checkout({'id': f'cs_{n}', 'amount_total': 1249 * quantity, 'currency': 'usd',
+                                     'customer_email': 'ada@example.com'}, f'CART000000{n}')
+
+    def history(self, **params):
+        response = self.client.get('/api/get_orders', {'email': 'ada@example.com', **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_summary_lists_the_same_orders_and_items(self):
+        full, summary = self.history(), self.history(summary=1)
+        self.assertEqual([order['stripe_checkout_id'] for order in summary], ['cs_1', 'cs_0'])
+        self.assertEqual([order['id'] for order in summary], [order['id'] for order in full])
+        self.assertEqual(
+            [[(line['product_id'], line['quantity']) for line in order['items']] for order in summary],
+            [[(item['product']['id'], item['quantity']) for item in order['items']] for order in full],
+        )
+        self.assertEqual([order['item_count'] for order in summary], [1, 2])
+
+    def test_summary_keeps_what_was_paid(self):
+        Product.objects.filter(pk=self.mug.pk).update(name='Big mug', price='15.00')
+        line = self.history(summary=1)[0]['items'][0]
+        self.assertEqual((line['name'], line['price']), ('Mug', '12.49'))
+        # The full history shows the product as it is now
+        self.assertEqual(self.history()[0]['items'][0]['product']['name'], 'Big mug')
+
+    def test_other_customers_orders_are_not_listed(self):
+        response = self.client.get('/api/get_orders', {'email': 'bob@example.com', 'summary': 1})
+        self.assertEqual(response.json()['results'], [])
+
+
+@mock.patch.object(views, 'endpoint_secret', 'whsec_test')
+class WebhookOutboxTests(TransactionTestCase):
+    # Transactional: process_webhooks runs its workers on their own connections
+
+    def setUp(self):
+        product = Product.objects.create(name='Mug', description='A mug', price='12.49')
+        cart = Cart.objects.create(cart_code='CART0000001')
+        CartItem.objects.create(cart=cart, product=product, quantity=2)
+
+    def deliver(self, name, secret='whsec_test'):
+        payload = (TESTDATA / name).read_bytes()
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+        return self.client.post(
+            '/api/webhook', payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}',
+        )
+
+    def test_webhook_only_records_the_event(self):
+        response = self.deliver('checkout_session_completed.json')
+        self.assertEqual(response.status_code, 200)
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.event_type, event.status), ('checkout.session.completed', 'Pending'))
+        self.assertFalse(Order.objects.exists())
+
+    def test_bad_signature_is_rejected(self):
+        self.assertEqual(self.deliver('checkout_session_completed.json', secret='whsec_other').status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_unhandled_event_types_are_not_stored(self):
+        self.assertEqual(self.deliver('customer_created.json').status_code, 200)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_worker_fulfils_each_event_once(self):
+        self.deliver('checkout_session_completed.json')
+        self.deliver('checkout_session_completed.json')
+        call_command('process_webhooks', '--once', '--workers', '1', stdout=mock.MagicMock())
+
+        order = Order.objects.get()
+        self.assertEqual(order.stripe_checkout_id, 'cs_test_a1b2c3d4e5')
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertEqual((order.item_count, order.summary[0]['name']), (2, 'Mug'))
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual(WebhookEvent.objects.get().status, 'Done')
+        self.assertEqual(webhooks.drain(), {})
+
+    def test_failures_are_retried_with_backoff_then_dead_lettered(self):
+        self.deliver('checkout_session_completed.json')
+        with mock.patch.object(webhooks, 'dispatch', side_effect=RuntimeError('db down')), \
+                override_settings(WEBHOOK_MAX_ATTEMPTS=2):
+            self.assertEqual(webhooks.drain(), {'Pending': 1})
+            event = WebhookEvent.objects.get()
+            self.assertEqual(event.attempts, 1)
+            self.assertGreater(event.next_attempt_at, timezone.now())
+            self.assertIn('db down', event.last_error)
+
+            # Not due yet
+            self.assertEqual(webhooks.drain(), {})
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(webhooks.drain(), {'Dead': 1})
+        self.assertFalse(Order.objects.exists())
+
+    def test_webhook_queues_one_drain_job(self):
+        self.deliver('checkout_session_completed.json')
+        self.deliver('checkout_session_completed.json')
+        self.assertEqual(Job.objects.get().task, 'webhooks.drain')
+
+        call_command('runworkers', '--processes', '0', '--burst', stdout=StringIO())
+        self.assertEqual(Order.objects.get().items.get().quantity, 2)
+        self.assertFalse(Job.objects.filter(task='webhooks.drain').exists())
+
+    def test_expired_lease_is_reclaimed(self):
+        self.deliver('checkout_session_completed.json')
+        WebhookEvent.objects.update(status='Processing', attempts=1, locked_until=timezone.now())
+        self.assertEqual(webhooks.drain(), {'Done': 1})
+        self.assertEqual(WebhookEvent.objects.get().attempts, 2)
+
+
+ran_jobs = []
+
+
+@jobs.task('tests.record', max_attempts=2)
+def record_job(label, fail=False):
+    if fail:
+        raise RuntimeError(f'{label} failed')
+    ran_jobs.append(label)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        ran_jobs.clear()
+
+    def run_due(self):
+        return [result.status for result in jobs.work(limit=100)]
+
+    def test_higher_priority_runs_first_then_oldest(self):
+        now = timezone.now()
+        jobs.enqueue('tests.record', {'label': 'old'}, run_at=now - timedelta(minutes=2))
+        jobs.enqueue('tests.record', {'label': 'new'}, run_at=now - timedelta(minutes=1))
+        jobs.enqueue('tests.record', {'label': 'urgent'}, priority=10)
+        self.assertEqual(self.run_due(), ['Done'] * 3)
+        self.assertEqual(ran_jobs, ['urgent', 'old', 'new'])
+        self.assertFalse(Job.objects.exists())
+
+    def test_delayed_job_waits_until_due(self):
+        jobs.enqueue('tests.record', {'label': 'later'}, delay=60)
+        self.assertEqual(self.run_due(), [])
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(self.run_due(), ['Done'])
+        self.assertEqual(ran_jobs, ['later'])
+
+    def test_unique_key_allows_one_pending_job(self):
+        self.assertTrue(jobs.enqueue('tests.record', {'label': 'a'}, unique_key='once'))
+        self.assertFalse(jobs.enqueue('tests.record', {'label': 'b'}, unique_key='once'))
+        jobs.claim()
+        # The running job no longer blocks the key
+        self.assertTrue(jobs.enqueue('tests.record', {'label': 'c'}, unique_key='once'))
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_unknown_task_is_rejected(self):
+        with self.assertRaises(KeyError):
+            jobs.enqueue('tests.missing')
+
+    def test_failures_are_retried_then_dead_lettered(self):
+        jobs.enqueue('tests.record', {'label': 'x', 'fail': True})
+        with self.assertLogs('apiApp.jobs', 'ERROR'):
+            self.assertEqual(self.run_due(), ['Pending'])
+        job = Job.objects.get()
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn('x failed', job.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        with self.assertLogs('apiApp.jobs', 'ERROR'):
+            self.assertEqual(self.run_due(), ['Dead'])
+        self.assertEqual(Job.objects.get().attempts, 2)
+        self.assertEqual(self.run_due(), [])
+
+    def test_retry_gives_way_to_a_pending_job_with_the_same_key(self):
+        jobs.enqueue('tests.record', {'label': 'first', 'fail': True}, unique_key='once')
+        job, = jobs.claim()
+        self.assertTrue(jobs.enqueue('tests.record', {'label': 'second'}, unique_key='once'))
+        with self.assertLogs('apiApp.jobs', 'ERROR'):
+            self.assertEqual(jobs.execute(job).status, 'Pending')
+        self.assertEqual(list(Job.objects.values_list('status', 'kwargs__label')), [('Pending', 'second')])
+
+    def test_expired_lease_is_reclaimed(self):
+        jobs.enqueue('tests.record', {'label': 'orphan'})
+        jobs.claim(worker='gone')
+        self.assertEqual(self.run_due(), [])
+        Job.objects.update(locked_until=timezone.now())
+        self.assertEqual(self.run_due(), ['Done'])
+
+    def test_runworkers_reports_throughput(self):
+        for label in 'abc':
+            jobs.enqueue('tests.record', {'label': label})
+        out = StringIO()
+        call_command('runworkers', '--processes', '0', '--burst', stdout=out)
+        self.assertEqual(sorted(ran_jobs), ['a', 'b', 'c'])
+        self.assertIn('Ran 3 jobs', out.getvalue())
+        self.assertIn('tests.record: 3 done', out.getvalue())
+
+
+@skipIf(connection.vendor == 'sqlite', "forked workers cannot share an in-memory test database")
+class ForkedWorkerTests(TransactionTestCase):
+    def test_jobs_are_split_across_processes(self):
+        for label in range(40):
+            jobs.enqueue('tests.record', {'label': str(label)})
+        out = StringIO()
+        call_command('runworkers', '--processes', '4', '--burst', '--batch-size', '2', stdout=out)
+        self.assertFalse(Job.objects.filter(task='tests.record').exists())
+        self.assertIn('Ran 40 jobs', out.getvalue())
+
+
+class RecurringJobTests(TestCase):
+    def due(self, task):
+        Job.objects.filter(task=task).update(run_at=timezone.now())
+
+    def test_schedule_queues_each_recurring_task_once(self):
+        self.assertEqual(sorted(jobs.schedule()), ['autocomplete.prune', 'carts.cleanup', 'ratings.rebuild'])
+        self.assertEqual(jobs.schedule(), [])
+        cleanup = Job.objects.get(task='carts.cleanup')
+        self.assertAlmostEqual((cleanup.run_at - timezone.now()).total_seconds(), 3600, delta=5)
+        with override_settings(JOB_INTERVALS={'ratings.rebuild': 0}):
+            Job.objects.all().delete()
+            self.assertNotIn('ratings.rebuild', jobs.schedule())
+
+    def test_runworkers_schedules_the_recurring_tasks(self):
+        out = StringIO()
+        call_command('runworkers', '--processes', '0', '--burst', stdout=out)
+        self.assertIn('Scheduled ', out.getvalue())
+        self.assertIn('carts.cleanup', out.getvalue())
+        self.assertEqual(Job.objects.filter(status='Pending').count(), 3)
+
+    def test_cart_cleanup_purges_abandoned_carts_then_queues_its_next_run(self):
+        product = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        for cart_code in ('OLD00000001', 'NEW00000001'):
+            CartItem.objects.create(cart=Cart.objects.create(cart_code=cart_code), product=product)
+        Cart.objects.filter(cart_code='OLD00000001').update(updated_at=timezone.now() - timedelta(days=40))
+        jobs.schedule()
+        self.due('carts.cleanup')
+        with self.assertLogs('apiApp.tasks', 'INFO'):
+            self.assertEqual([result.status for result in jobs.work()], ['Done'])
+        self.assertEqual(list(Cart.objects.values_list('cart_code', flat=True)), ['NEW00000001'])
+        self.assertGreater(Job.objects.get(task='carts.cleanup').run_at, timezone.now() + timedelta(minutes=59))
+
+    def test_dead_runs_are_rescheduled_too(self):
+        jobs.schedule()
+        self.due('ratings.rebuild')
+        with mock.patch('apiApp.tasks.call_command', side_effect=RuntimeError('boom')):
+            with self.assertLogs('apiApp.jobs', 'ERROR'):
+                self.assertEqual([result.status for result in jobs.work()], ['Dead'])
+        self.assertEqual(
+            sorted(Job.objects.filter(task='ratings.rebuild').values_list('status', flat=True)), ['Dead', 'Pending']
+        )
+
+    def test_rating_rebuild_repairs_drifted_counters(self):
+        product = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        for n, rating in enumerate((5, 3)):
+            user = CustomUser.objects.create(username=f'user{n}', email=f'user{n}@example.com')
+            Review.objects.create(product=product, user=user, rating=rating, comment='Fine')
+        ProductRating.objects.update(total_reviews=7, rating_sum=1, average_rating=0.5)
+        jobs.enqueue('ratings.rebuild')
+        with self.assertLogs('apiApp.tasks', 'INFO'):
+            self.assertEqual([result.status for result in jobs.work()], ['Done'])
+        self.assertEqual(ProductRating.objects.values_list('total_reviews', 'rating_sum', 'average_rating').get(),
+                         (2, 8, 4.0))
+
+
+@override_settings(STORAGES=FILE_STORAGES, PRODUCT_IMAGE_MAX_SIZE=100)
+class ImageOptimizeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, size):
+        content = BytesIO()
+        Image.new('RGB', size, 'red').save(content, format='PNG')
+        with self.captureOnCommitCallbacks(execute=True):
+            return Product.objects.create(name='Mug', description='A mug', price='12.50',
+                                          image=SimpleUploadedFile('mug.png', content.getvalue()))
+
+    def image_size(self, product):
+        product.refresh_from_db()
+        with product.image.open('rb') as source, Image.open(source) as image:
+            return image.size
+
+    def test_large_image_is_shrunk_under_a_new_name(self):
+        product = self.upload((400, 200))
+        original = product.image.name
+        self.assertEqual([result.status for result in jobs.work()], ['Done'])
+        self.assertEqual(self.image_size(product), (100, 50))
+        self.assertNotEqual(product.image.name, original)
+        self.assertFalse(product.image.storage.exists(original))
+        # Swapping the image in does not queue another optimization
+        self.assertFalse(Job.objects.exists())
+
+    def test_original_survives_a_failed_save(self):
+        product = self.upload((400, 200))
+        original = product.image.name
+        with mock.patch.object(FileSystemStorage, '_save', side_effect=OSError('disk full')):
+            with self.assertLogs('apiApp.jobs', 'ERROR'):
+                self.assertEqual([result.status for result in jobs.work()], ['Pending'])
+        self.assertEqual(self.image_size(product), (400, 200))
+        self.assertEqual(product.image.name, original)
+
+    def test_image_replaced_meanwhile_is_kept(self):
+        product = self.upload((400, 200))
+        original = product.image.name
+        save = FileSystemStorage.save
+
+        def save_then_replace(storage, *args, **kwargs):
+            # A new upload lands while the job resizes the old one
+            Product.objects.filter(pk=product.pk).update(image='products_img/new.png')
+            return save(storage, *args, **kwargs)
+
+        with mock.patch.object(FileSystemStorage, 'save', autospec=True, side_effect=save_then_replace):
+            self.assertEqual([result.status for result in jobs.work()], ['Done'])
+        product.refresh_from_db()
+        self.assertEqual(product.image.name, 'products_img/new.png')
+        # The resized copy is dropped, the replaced original is not the job's to delete
+        self.assertEqual(product.image.storage.listdir('products_img')[1], [original.split('/')[-1]])
+
+    def test_small_image_is_left_alone(self):
+        product = self.upload((80, 40))
+        original = product.image.name
+        jobs.work()
+        self.assertEqual((self.image_size(product), product.image.name), ((80, 40), original))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, STORAGES=FILE_STORAGES, ALLOWED_HOSTS=['shop.example.com'],
+                   CACHE_WARM_URL='https://shop.example.com')
+class CacheWarmTests(TestCase):
+    def test_warm_fills_the_catalog_cache(self):
+        cache.clear()
+        Product.objects.create(name='Mug', description='A mug', price='12.50', featured=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.warm_cache_soon()
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual([result.status for result in jobs.work()], ['Done'])
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/allproducts/', HTTP_HOST='shop.example.com', secure=True)
+        self.assertEqual(response.json()['results'][0]['name'], 'Mug')
+
+
+class StripeStubTestCase(TestCase):
+    stripe_settings = {}
+
+    def setUp(self):
+        self.stripe = StripeStub()
+        self.addCleanup(self.stripe.close)
+        settings_override = override_settings(
+            STRIPE_API_BASE=self.stripe.url, STRIPE_SECRET_KEY='sk_test_stub', **self.stripe_settings
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # The shared client is rebuilt from these settings, and dropped again afterwards
+        payments.reset()
+        self.addCleanup(payments.reset)
+
+
+class CheckoutPricingTests(StripeStubTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.49')
+        self.cap = Product.objects.create(name='Cap', description='A cap', price='20.00')
+        cart = Cart.objects.create(cart_code='CART0000001')
+        CartItem.objects.create(cart=cart, product=self.mug, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.cap, quantity=1)
+
+    def checkout(self, cart_code='CART0000001'):
+        return self.client.post('/api/create_checkout_session/', {'cart_code': cart_code, 'email': 'a@example.com'})
+
+    def session_lines(self):
+        form = self.stripe.calls('/v1/checkout/sessions')[-1]
+        return {key: value[0] for key, value in form.items() if key.startswith('line_items')}
+
+    def test_lines_reference_stripe_prices_with_cart_quantities(self):
+        response = self.checkout()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['id'][:7], 'cs_test')
+
+        mug, cap = StripePrice.objects.get(product=self.mug), StripePrice.objects.get(product=self.cap)
+        self.assertEqual((mug.unit_amount, cap.unit_amount), (1249, 2000))
+        lines = self.session_lines()
+        self.assertEqual(lines['line_items[0][price]'], mug.stripe_price_id)
+        self.assertEqual(lines['line_items[0][quantity]'], '2')
+        self.assertEqual(lines['line_items[1][price]'], cap.stripe_price_id)
+        self.assertEqual(lines['line_items[1][quantity]'], '1')
+        self.assertEqual(lines['line_items[2][price_data][unit_amount]'], '500')
+        self.assertNotIn('line_items[0][price_data][unit_amount]', lines)
+
+    def test_known_prices_are_reused(self):
+        self.checkout()
+        self.stripe.requests.clear()
+        with self.assertNumQueries(1):
+            checkout.create_session('CART0000001', 'a@example.com')
+        self.assertEqual([path for method, path, form, headers in self.stripe.requests], ['/v1/checkout/sessions'])
+
+    def test_price_change_creates_a_new_price_for_the_same_stripe_product(self):
+        self.checkout()
+        old = StripePrice.objects.get(product=self.mug)
+        self.mug.price = '10.00'
+        self.mug.save()
+        self.stripe.requests.clear()
+
+        self.checkout()
+        new = StripePrice.objects.get(product=self.mug)
+        self.assertEqual(new.stripe_product_id, old.stripe_product_id)
+        self.assertNotEqual(new.stripe_price_id, old.stripe_price_id)
+        self.assertEqual(new.unit_amount, 1000)
+        self.assertEqual(self.stripe.calls('/v1/products'), [])
+        self.assertEqual(self.stripe.calls('/v1/prices')[0]['unit_amount'], ['1000'])
+
+    def test_price_change_queues_a_price_sync(self):
+        self.checkout()
+        mug = Product.objects.get(pk=self.mug.pk)
+        mug.price = '10.00'
+        with self.captureOnCommitCallbacks(execute=True):
+            mug.save()
+        self.assertEqual(set(Job.objects.values_list('task', flat=True)), {'carts.reprice', 'stripe.sync_price'})
+        jobs.work()
+        self.assertEqual(StripePrice.objects.get(product=self.mug).unit_amount, 1000)
+
+    def test_empty_and_missing_carts(self):
+        Cart.objects.create(cart_code='EMPTY')
+        self.assertEqual(self.checkout('EMPTY').status_code, 400)
+        self.assertEqual(self.checkout('MISSING').status_code, 404)
+        self.assertEqual(self.stripe.requests, [])
+
+
+class PaymentGatewayTests(StripeStubTestCase):
+    stripe_settings = {
+        'STRIPE_MAX_RETRIES': 2,
+        'STRIPE_RETRY_BACKOFF': 0.01,
+        'STRIPE_READ_TIMEOUT': 0.3,
+        'STRIPE_DEADLINE': 1.0,
+        'STRIPE_BREAKER_THRESHOLD': 3,
+        'STRIPE_BREAKER_RESET': 0.3,
+    }
+    server_error = (500, {'error': {'type': 'api_error', 'message': 'boom'}})
+
+    def create_price(self):
+        return payments.client().prices.create(params={'product': 'prod_1', 'unit_amount': 100, 'currency': 'usd'})
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.create_price()
+        self.assertEqual(len(set(self.stripe.connections)), 1)
+
+    def test_server_errors_are_retried_with_the_same_idempotency_key(self):
+        self.stripe.responses[('POST', '/v1/prices')] = [self.server_error, (200, {'id': 'price_ok', 'object': 'price'})]
+        self.assertEqual(self.create_price().id, 'price_ok')
+        keys = {headers['Idempotency-Key'] for method, path, form, headers in self.stripe.requests}
+        self.assertEqual((len(self.stripe.requests), len(keys)), (2, 1))
+
+    def test_retries_are_bounded(self):
+        self.stripe.responses[('POST', '/v1/prices')] = [self.server_error]
+        with self.assertRaises(stripe.APIError):
+            self.create_price()
+        self.assertEqual(len(self.stripe.requests), 3)
+
+    def test_slow_calls_give_up_at_the_deadline(self):
+        self.stripe.responses[('POST', '/v1/prices')] = [(200, {'id': 'price_slow', 'object': 'price'}, 2)]
+        started = time.monotonic()
+        with self.assertRaises(stripe.APIConnectionError):
+            self.create_price()
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_circuit_opens_fails_fast_and_recovers(self):
+        self.stripe.responses[('POST', '/v1/prices')] = [self.server_error]
+        with self.assertRaises(stripe.APIError):
+            self.create_price()
+        with self.assertRaises(payments.PaymentsUnavailable):
+            self.create_price()
+        self.assertEqual(len(self.stripe.requests), 3)
+        self.assertEqual(payments.status()['circuit'], 'open')
+
+        time.sleep(0.35)
+        self.stripe.responses.clear()
+        self.assertTrue(self.create_price().id)
+        self.assertEqual(payments.status()['circuit'], 'closed')
+
+    def test_checkout_answers_503_while_the_circuit_is_open(self):
+        product = Product.objects.create(name='Mug', description='A mug', price='12.49')
+        CartItem.objects.create(cart=Cart.objects.create(cart_code='CART0000001'), product=product)
+        payments.client()
+        for _ in range(3):
+            payments.breaker.record(False)
+        response = self.client.post(
+            '/api/create_checkout_session/', {'cart_code': 'CART0000001', 'email': 'a@example.com'}
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    def test_latency_metrics_per_endpoint(self):
+        self.stripe.responses[('POST', '/v1/prices')] = [self.server_error, (200, {'id': 'price_ok', 'object': 'price'})]
+        self.create_price()
+        payments.client().prices.retrieve('price_1abc')
+        endpoints = payments.status()['endpoints']
+        self.assertEqual((endpoints['POST /v1/prices']['calls'], endpoints['POST /v1/prices']['errors']), (2, 1))
+        self.assertEqual(endpoints['GET /v1/prices/:id']['calls'], 1)
+        self.assertGreaterEqual(endpoints['POST /v1/prices']['max_ms'], endpoints['POST /v1/prices']['p50_ms'])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(payments.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = payments.CircuitBreaker(threshold=2, reset_after=30)
+        for _ in range(2):
+            self.breaker.before_call()
+            self.breaker.record(False)
+
+    def test_opens_at_the_threshold_and_fails_fast(self):
+        self.assertEqual(self.breaker.state, 'open')
+        self.now += 10
+        with self.assertRaises(payments.PaymentsUnavailable) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.retry_in, 20)
+
+    def test_half_open_lets_one_trial_call_through(self):
+        self.now += 30
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.breaker.before_call()
+        # Everyone else fails fast while the trial is out
+        with self.assertRaises(payments.PaymentsUnavailable):
+            self.breaker.before_call()
+
+    def test_failed_trial_reopens_for_another_period(self):
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'open')
+        self.now += 29
+        with self.assertRaises(payments.PaymentsUnavailable):
+            self.breaker.before_call()
+        self.now += 1
+        self.assertEqual(self.breaker.state, 'half-open')
+
+    def test_successful_trial_closes(self):
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, 'closed')
+        # The failure count starts over
+        self.breaker.before_call()
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.before_call()
+
+
+class CartCounterTests(TestCase):
+    def setUp(self):
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        self.cap = Product.objects.create(name='Cap', description='A cap', price='20.00')
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def counters(self):
+        return Cart.objects.values_list('num_of_items', 'cart_total').get()
+
+    def test_every_mutation_keeps_the_counters(self):
+        self.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': self.mug.pk})
+        self.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': self.mug.pk})
+        self.assertEqual(self.counters(), (2, Decimal('25.00')))
+
+        item = CartItem.objects.get()
+        self.client.patch(f'/api/cart/updateItem/{item.pk}/', json.dumps({'quantity': 1}),
+                          content_type='application/json')
+        self.assertEqual(self.counters(), (3, Decimal('37.50')))
+
+        self.post('/api/cart/bulk/', {'cart_code': 'CART0000001', 'operations': [
+            {'product_id': self.mug.pk, 'quantity': -3}, {'product_id': self.cap.pk, 'quantity': 2},
+        ]})
+        self.assertEqual(self.counters(), (2, Decimal('40.00')))
+
+        self.client.delete(f'/api/cart/delete/{CartItem.objects.get().pk}/')
+        self.assertEqual(self.counters(), (0, Decimal('0.00')))
+
+    def test_badge_is_one_query(self):
+        self.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': self.cap.pk})
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'})
+        self.assertEqual(response.json()['num_of_items'], 1)
+
+    def test_reconcile_repairs_drift(self):
+        cart = Cart.objects.create(cart_code='CART0000001')
+        CartItem.objects.create(cart=cart, product=self.mug, quantity=4)
+        out = StringIO()
+        call_command('reconcile_carts', stdout=out)
+        self.assertIn('Fixed 1', out.getvalue())
+        self.assertEqual(self.counters(), (4, Decimal('50.00')))
+
+    def test_price_change_reprices_carts(self):
+        self.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': self.mug.pk})
+        mug = Product.objects.get(pk=self.mug.pk)
+        mug.price = '10.00'
+        with self.captureOnCommitCallbacks(execute=True):
+            mug.save()
+        jobs.work()
+        self.assertEqual(self.counters(), (1, Decimal('10.00')))
+
+    def test_reprice_changes_the_badge_etag(self):
+        self.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': self.mug.pk})
+        etag = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'})['ETag']
+        response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        mug = Product.objects.get(pk=self.mug.pk)
+        mug.price = '20.00'
+        with self.captureOnCommitCallbacks(execute=True):
+            mug.save()
+        jobs.work()
+        response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['cart_total'], 20.0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, MEMBERSHIP_CACHE_TIMEOUT=60)
+class ProductMembershipTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(name=f'Product {i}', description=f'Description {i}', price='5.00')
+            for i in range(4)
+        ]
+        self.user = CustomUser.objects.create_user(username='ada', email='ada@example.com', password='x')
+        Wishlist.objects.create(user=self.user, product=self.products[1])
+
+    def ask(self, **params):
+        ids = ','.join(str(product.pk) for product in self.products)
+        return self.client.get('/api/product_membership', {'product_ids': ids, **params})
+
+    def add_to_cart(self, product):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/cart/add/', {'cart_code': 'CART0000001', 'product_id': product.pk})
+
+    def test_one_query_per_source_then_cached(self):
+        self.add_to_cart(self.products[0])
+        with self.assertNumQueries(2):
+            response = self.ask(cart_code='CART0000001', email='ada@example.com')
+        first, second = str(self.products[0].pk), str(self.products[1].pk)
+        self.assertEqual(response.json()['product_in_cart'][first], True)
+        self.assertEqual(response.json()['product_in_cart'][second], False)
+        self.assertEqual(response.json()['product_in_wishlist'][second], True)
+        with self.assertNumQueries(0):
+            self.ask(cart_code='CART0000001', email='ada@example.com')
+
+    def test_mutations_drop_the_cached_ids(self):
+        self.ask(cart_code='CART0000001', email='ada@example.com')
+        self.add_to_cart(self.products[2])
+        with self.captureOnCommitCallbacks(execute=True):
+            Wishlist.objects.get().delete()
+
+        data = self.ask(cart_code='CART0000001', email='ada@example.com').json()
+        self.assertTrue(data['product_in_cart'][str(self.products[2].pk)])
+        self.assertFalse(any(data['product_in_wishlist'].values()))
+
+    def test_not_cached_by_default_without_a_shared_cache(self):
+        with override_settings():
+            del settings.MEMBERSHIP_CACHE_TIMEOUT
+            self.add_to_cart(self.products[0])
+            self.ask(cart_code='CART0000001')
+            # Added in another worker, whose forget_carts() never reaches this one's cache
+            CartItem.objects.create(cart=Cart.objects.get(), product=self.products[2])
+            with self.assertNumQueries(1):
+                data = self.ask(cart_code='CART0000001').json()
+        self.assertTrue(data['product_in_cart'][str(self.products[2].pk)])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/api/product_membership', {'product_ids': '1,x', 'cart_code': 'C'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/product_membership', {'product_ids': '1'}).status_code, 400)
+
+
+class CartPurgeTests(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='Mug', description='A mug', price='12.50')
+        old = timezone.now() - timedelta(days=40)
+        for n in range(7):
+            cart = Cart.objects.create(cart_code=f'OLD{n:08}')
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+        Cart.objects.update(updated_at=old)
+        fresh = Cart.objects.create(cart_code='FRESH000001')
+        CartItem.objects.create(cart=fresh, product=product)
+
+    def test_purges_only_abandoned_carts_in_batches(self):
+        out = StringIO()
+        call_command('purge_carts', '--days', '30', '--batch-size', '3', '--sleep', '0', stdout=out)
+        self.assertIn('Purged 7 carts and 7 items', out.getvalue())
+        self.assertIn('in 3 batches', out.getvalue())
+        self.assertEqual(list(Cart.objects.values_list('cart_code', flat=True)), ['FRESH000001'])
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_dry_run_and_batch_limit(self):
+        out = StringIO()
+        call_command('purge_carts', '--dry-run', stdout=out)
+        self.assertIn('Would purge 7 carts and 7 items', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 8)
+
+        stats = carts.purge_abandoned(30, batch_size=2, pause=0, max_batches=1)
+        self.assertEqual((stats['carts'], stats['batches']), (2, 1))
+        self.assertEqual(Cart.objects.count(), 6)
+
+    def test_carts_touched_after_being_picked_are_kept(self):
+        select_for_update = Cart.objects.select_for_update
+
+        def touch_then_lock(*args, **kwargs):
+            # An add-to-cart landing between the scan and the delete
+            Cart.objects.filter(cart_code='OLD00000000').update(updated_at=timezone.now())
+            return select_for_update(*args, **kwargs)
+
+        with mock.patch.object(Cart.objects, 'select_for_update', side_effect=touch_then_lock):
+            stats = carts.purge_abandoned(30, pause=0)
+        self.assertEqual(stats['carts'], 6)
+        self.assertTrue(Cart.objects.filter(cart_code='OLD00000000').exists())
+
+
+@modify_settings(MIDDLEWARE={'prepend': 'apiApp.instrumentation.QueryInstrumentationMiddleware'})
+@override_settings(QUERY_BUDGETS={'get_cart_stat': 1, 'get_cart': 1}, QUERY_BUDGET_DEFAULT=None)
+class QueryInstrumentationTests(TestCase):
+    def setUp(self):
+        cart = Cart.objects.create(cart_code='CART0000001')
+        for n in range(3):
+            product = Product.objects.create(name=f'Product {n}', description=f'Description {n}', price='5.00')
+            CartItem.objects.create(cart=cart, product=product)
+
+    def stats(self, logs):
+        return json.loads(logs.records[-1].getMessage())
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('apiApp.instrumentation', 'INFO') as logs:
+            response = self.client.get('/api/get_cart_stat', {'cart_code': 'CART0000001'})
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="1 queries, 0 repeated", serializer;dur=[\d.]+, total;dur=[\d.]+$')
+        stats = self.stats(logs)
+        self.assertEqual((stats['url_name'], stats['queries'], stats['over_budget']), ('get_cart_stat', 1, False))
+        self.assertEqual(logs.records[-1].levelname, 'INFO')
+
+    def test_over_budget_requests_are_warnings(self):
+        with self.assertLogs('apiApp.instrumentation', 'INFO') as logs:
+            self.client.get('/api/get_cart/CART0000001')
+        stats = self.stats(logs)
+        self.assertEqual(logs.records[-1].levelname, 'WARNING')
+        self.assertTrue(stats['over_budget'])
+        self.assertGreater(stats['queries'], 1)
+        self.assertGreater(stats['serializer_ms'], 0)
+
+    def test_repeated_queries_are_grouped(self):
+        stats = instrumentation.QueryStats()
+        for pk in (1, 2, 3):
+            stats.record(f'SELECT "name" FROM "product" WHERE "id" = {pk} LIMIT 21', 0.001)
+        stats.record('SELECT "name" FROM "product" WHERE "id" IN (%s, %s)', 0.001)
+        stats.record('SELECT "name" FROM "product" WHERE "id" IN (%s)', 0.001)
+        self.assertEqual([count for _, count in stats.repeated()], [3, 2])
+        self.assertIn('desc="5 queries, 3 repeated"', stats.server_timing(0.01))
+
+
+class SeedCommandTests(TestCase):
+    volumes = ['--categories', '4', '--products', '60', '--users', '12', '--reviews', '90',
+               '--carts', '15', '--orders', '10', '--batch-size', '25']
+
+    def seed(self, *extra):
+        call_command('seed', *self.volumes, *extra, stdout=StringIO())
+        return (
+            list(Product.objects.order_by('id').values_list('id', 'name', 'slug', 'price', 'category_id')),
+            list(Review.objects.order_by('id').values_list('product_id', 'user_id', 'rating')),
+            list(CartItem.objects.order_by('id').values_list('cart_id', 'product_id', 'quantity')),
+            list(Order.objects.order_by('id').values_list('customer_email', 'amount', 'item_count', 'summary')),
+        )
+
+    def clear(self):
+        for model in (OrderItem, Order, CartItem, Cart, Review, ProductRating, Product, ProductCategory, CustomUser):
+            model.objects.all().delete()
+
+    def test_volumes_and_derived_data(self):
+        self.seed()
+        self.assertEqual(
+            [Product.objects.count(), Review.objects.count(), Cart.objects.count(), Order.objects.count()],
+            [60, 90, 15, 10],
+        )
+        out = StringIO()
+        call_command('rebuild_ratings', '--dry-run', stdout=out)
+        self.assertIn('Would fix 0 ratings', out.getvalue())
+        self.assertTrue(AutocompleteChange.objects.filter(kind='all').exists())
+
+        cart = Cart.objects.with_items().first()
+        self.assertEqual(cart.num_of_items, sum(item.quantity for item in cart.cartitems.all()))
+        self.assertEqual(cart.cart_total, cart.items_total)
+        order = Order.objects.prefetch_related('items__product').first()
+        self.assertEqual(order.summary, orders.order_summary(order.items.order_by('id'))[1])
+        self.assertEqual(self.client.get(f'/api/product/{order.summary[0]["slug"]}/').status_code, 200)
+
+    def test_same_seed_same_data(self):
+        first = self.seed()
+        self.clear()
+        self.assertEqual(self.seed(), first)
+        self.clear()
+        self.assertNotEqual(self.seed('--seed', '7'), first)
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        Seeder(seed=3).run(categories=2, products=30, users=5, reviews=20, carts=6, orders=6)
+
+    def test_reports_every_endpoint_without_errors(self):
+        results = Benchmark(requests=4, warmup=1, seed=3).run()
+        self.assertEqual(set(results['endpoints']), set(ENDPOINTS))
+        for name, row in results['endpoints'].items():
+            self.assertEqual(row['errors'], 0, (name, row['statuses']))
+            self.assertEqual(row['requests'], 4)
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'])
+        self.assertEqual(results['endpoints']['get_cart_stat']['queries'], 1)
+
+    def test_compare_flags_slower_endpoints(self):
+        row = {'rps': 100.0, 'p95_ms': 10.0, 'queries': 2.0, 'errors': 0}
+        baseline = {'endpoints': {'get_cart': row, 'get_orders': row}}
+        results = {'endpoints': {
+            'get_cart': {**row, 'p95_ms': 11.0, 'rps': 90.0},
+            'get_orders': {**row, 'p95_ms': 15.0, 'queries': 3.0},
+        }}
+        self.assertEqual(compare(results, baseline, threshold=0.2), [
+            ('get_orders', 'p95 10.0ms -> 15.0ms'),
+            ('get_orders', 'queries per request 2.0 -> 3.0'),
+        ])
+
+
+class QueryCountTests(TestCase):
+    """
+    Queries per request stay under a fixed bound whether a cart, order list
+    or wishlist holds 1 or 100 entries. A failure lists the repeated SQL.
+    """
+    sizes = (1, 100)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = ProductCategory.objects.create(name='Mugs')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Mug {n}', description=f'Mug number {n}', price='4.00', slug=f'mug-{n}',
+                    category=cls.category, featured=True)
+            for n in range(max(cls.sizes))
+        ])
+        for size in cls.sizes:
+            cart = Cart.objects.create(cart_code=f'CART{size:07}', num_of_items=size)
+            CartItem.objects.bulk_create([CartItem(cart=cart, product=product) for product in cls.products[:size]])
+            user = CustomUser.objects.create_user(username=f'user{size}', email=f'user{size}@example.com')
+            Wishlist.objects.bulk_create([Wishlist(user=user, product=product) for product in cls.products[:size]])
+            for n in range(size):
+                order = Order.objects.create(stripe_checkout_id=f'cs_{size}_{n}', amount=400, currency='usd',
+                                             customer_email=user.email, status='Paid')
+                OrderItem.objects.bulk_create([OrderItem(order=order, product=product)
+                                               for product in cls.products[n:n + 3]])
+
+    def setUp(self):
+        cache.clear()
+
+    def assertQueriesPerSize(self, bound, request):
+        """Run request(size) for every size; each must stay within `bound` queries, and all the same."""
+        counts = {}
+        for size in self.sizes:
+            cache.clear()
+            with instrumentation.measure() as stats:
+                response = request(size)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+            self.assertLess(response.status_code, 400)
+            counts[size] = stats.queries
+            repeated = '\n'.join(f'{count}x {sql}' for sql, count in stats.repeated())
+            self.assertLessEqual(stats.queries, bound, f'{stats.queries} queries with {size} entries:\n{repeated}')
+        self.assertEqual(len(set(counts.values())), 1, f'Queries grow with the number of entries: {counts}')
+
+    def test_cart(self):
+        self.assertQueriesPerSize(3, lambda size: self.client.get(f'/api/get_cart/CART{size:07}'))
+        cart_ids = dict(Cart.objects.values_list('num_of_items', 'pk'))
+        self.assertQueriesPerSize(2, lambda size: self.client.get(f'/api/cart/{cart_ids[size]}/'))
+        self.assertQueriesPerSize(1, lambda size: self.client.get('/api/get_cart_stat', {'cart_code': f'CART{size:07}'}))
+
+    def test_cart_writes(self):
+        self.assertQueriesPerSize(8, lambda size: self.client.post(
+            '/api/cart/add/', {'cart_code': f'CART{size:07}', 'product_id': self.products[-1].pk}))
+        self.assertQueriesPerSize(10, lambda size: self.client.post(
+            '/api/cart/bulk/', json.dumps({'cart_code': f'CART{size:07}', 'operations': [
+                {'product_id': product.pk} for product in self.products[:size]
+            ]}), content_type='application/json'))
+
+    def test_orders(self):
+        self.assertQueriesPerSize(2, lambda size: self.client.get(
+            '/api/get_orders', {'email': f'user{size}@example.com', 'page_size': 100}))
+        self.assertQueriesPerSize(1, lambda size: self.client.get(
+            '/api/get_orders', {'email': f'user{size}@example.com', 'page_size': 100, 'summary': 1}))
+        self.assertQueriesPerSize(2, lambda size: self.client.get(
+            '/api/get_orders', {'email': f'user{size}@example.com', 'stream': 1}))
+
+    def test_wishlist(self):
+        self.assertQueriesPerSize(1, lambda size: self.client.get(
+            '/api/my_wishlists', {'email': f'user{size}@example.com', 'page_size': 100}))
+        self.assertQueriesPerSize(1, lambda size: self.client.get(
+            '/api/my_wishlists', {'email': f'user{size}@example.com', 'stream': 1}))
+        self.assertQueriesPerSize(2, lambda size: self.client.get('/api/product_membership', {
+            'product_ids': ','.join(str(product.pk) for product in self.products[:size]),
+            'cart_code': f'CART{size:07}', 'email': f'user{size}@example.com',
+        }))
+
+    def test_catalog(self):
+        self.assertQueriesPerSize(1, lambda size: self.client.get('/api/allproducts/', {'page_size': size}))
+        self.assertQueriesPerSize(2, lambda size: self.client.get('/api/category/mugs', {'page_size': size}))
+        self.assertQueriesPerSize(2, lambda size: self.client.get('/api/category/mugs', {'stream': 1}))
+        self.assertQueriesPerSize(1, lambda size: self.client.get('/api/categories/'))
+        self.assertQueriesPerSize(2, lambda size: self.client.get('/api/product/mug-0/'))
+
+    @override_settings(STORAGES=FILE_STORAGES)
+    def test_admin_cart_list(self):
+        admin = CustomUser.objects.create_superuser(username='admin', email='admin@example.com', password='x')
+        self.client.force_login(admin)
+        # One page with both carts, 1 and 100 items
+        self.assertQueriesPerSize(8, lambda size: self.client.get('/admin/apiApp/cart/'))
+
+
+class SlugAllocationTests(TestCase):
+    def test_duplicate_names_take_one_lookup_each(self):
+        Product.objects.create(name='T-Shirt Blue', description='Not a duplicate', price='5.00')
+        for n in range(30):
+            # Slug lookup, then the insert in its savepoint, and the change for the autocomplete indexes
+            with self.assertNumQueries(5):
+                product = Product.objects.create(name='T-Shirt', description=f'Shirt {n}', price='5.00')
+        self.assertEqual(product.slug, 't-shirt-29')
+        self.assertEqual(Product.objects.filter(slug__startswith='t-shirt').count(), 31)
+
+    def test_lowest_free_suffix_and_long_names(self):
+        for slug in ('mugs', 'mugs-1', 'mugs-3'):
+            ProductCategory.objects.create(name='Mugs', slug=slug)
+        self.assertEqual(ProductCategory.objects.create(name='Mugs').slug, 'mugs-2')
+        long_name = 'A very long category name that does not fit in a slug field at all'
+        first, second = (ProductCategory.objects.create(name=long_name) for _ in range(2))
+        self.assertEqual(len(first.slug), 50)
+        self.assertEqual((len(second.slug), second.slug[-2:]), (50, '-1'))
+        self.assertEqual(ProductCategory.objects.create(name='!!!').slug, 'productcategory')
+
+    def test_bulk_allocation(self):
+        Product.objects.create(name='Mug', description='The first mug', price='5.00')
+        with self.assertNumQueries(1):
+            names = ['Mug', 'Cap', 'Mug', 'mug!', 'Cap']
+            allocated = slugs.allocate_many(Product, names)
+        self.assertEqual(allocated, ['mug-1', 'cap', 'mug-2', 'mug-3', 'cap-1'])
+
+    def test_lost_race_is_retried(self):
+        Product.objects.create(name='Mug', description='The first mug', price='5.00')
+        # A concurrent save took 'mug' between our lookup and our insert
+        with mock.patch.object(slugs, 'allocate', side_effect=['mug', 'mug-1']) as allocate:
+            product = Product.objects.create(name='Mug', description='Another mug', price='5.00')
+        self.assertEqual((product.slug, allocate.call_count), ('mug-1', 2))
+
+        # Other constraint violations are not retried
+        with self.assertRaises(IntegrityError):
+            Product.objects.create(name='Cup', description='Another mug', price='5.00')
+
+
+class CatalogImportExportTests(TestCase):
+    def setUp(self):
+        self.mugs = ProductCategory.objects.create(name='Mugs')
+        self.mug = Product.objects.create(name='Mug', description='A mug', price='12.50', category=self.mugs)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def import_catalog(self, path, *extra):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_catalog', str(path), *extra, stdout=out, stderr=out)
+        return out.getvalue()
+
+    def write(self, name, text):
+        path = Path(self.tmp) / name
+        path.write_text(text)
+        return path
+
+    def test_csv_import_upserts_on_slug(self):
+        path = self.write('catalog.csv', (
+            'slug,name,description,category,price,featured,image\n'
+            'mug,Mug,A mug,mugs,14.00,true,\n'
+            ',Teapot,A teapot,Kitchen,30,false,\n'
+            ',Cup,A cup,kitchen,8.5,,\n'
+            ',,No name,mugs,1,,\n'
+            'bad-price,Plate,A plate,,abc,,\n'
+        ))
+        output = self.import_catalog(path, '--batch-size', '2')
+        self.assertIn('Imported 5 rows (2 created, 1 updated, 0 unchanged, 2 rejected, 1 new categories)', output)
+        self.assertIn('Row 4: name is required', output)
+        self.assertIn('rows/s', output)
+
+        kitchen = ProductCategory.objects.get(name='Kitchen')
+        self.assertEqual(
+            list(Product.objects.order_by('id').values_list('slug', 'price', 'featured', 'category_id')),
+            [('mug', Decimal('14.00'), True, self.mugs.id),
+             ('teapot', Decimal('30.00'), False, kitchen.id),
+             ('cup', Decimal('8.50'), False, kitchen.id)],
+        )
+        self.assertEqual(self.client.get('/api/product/teapot/').json()['name'], 'Teapot')
+        # bulk_create sends no signals, the importer records the changes for the autocomplete indexes
+        recorded = set(AutocompleteChange.objects.values_list('kind', 'object_id'))
+        products = {('product', pk) for pk in Product.objects.values_list('pk', flat=True)}
+        self.assertLessEqual({('category', kitchen.id), *products}, recorded)
+        self.assertEqual(self.client.get('/api/search/', {'query': 'teapot'}).json()['results'][0]['slug'], 'teapot')
+
+    def test_reimport_of_an_export_changes_nothing(self):
+        Product.objects.create(name='Cup', description='A cup', price='8.50', featured=True)
+        path = Path(self.tmp) / 'catalog.jsonl'
+        out = StringIO()
+        call_command('export_catalog', str(path), '--batch-size', '1', stdout=out)
+        self.assertIn('Exported 2 products', out.getvalue())
+        rows = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual([(row['slug'], row['category'], row['price']) for row in rows],
+                         [('mug', 'mugs', '12.50'), ('cup', '', '8.50')])
+
+        # The category map, then per chunk the description check and the lookup in its savepoint
+        with self.assertNumQueries(5):
+            output = self.import_catalog(path)
+        self.assertIn('0 created, 0 updated, 2 unchanged', output)
+
+    def test_duplicate_descriptions_are_rejected_row_by_row(self):
+        path = self.write('catalog.csv', (
+            'slug,name,description,category,price\n'
+            'plate,Plate,,,4\n'
+            'bowl,Bowl,,,5\n'
+            'cup,Cup,A mug,,6\n'
+            'saucer,Saucer,A saucer,,2\n'
+            'mug,Mug,A new mug,mugs,12.50\n'
+        ))
+        output = self.import_catalog(path)
+        self.assertIn('Imported 5 rows (2 created, 1 updated, 0 unchanged, 2 rejected', output)
+        self.assertIn('Row 2: description is the same as row 1', output)
+        self.assertIn("Row 3: description is already used by product 'mug'", output)
+        self.assertEqual(sorted(Product.objects.values_list('slug', 'description')),
+                         [('mug', 'A new mug'), ('plate', ''), ('saucer', 'A saucer')])
+
+    def test_price_change_queues_the_signal_jobs(self):
+        cart = Cart.objects.create(cart_code='CATALOG0001')
+        CartItem.objects.create(cart=cart, product=self.mug)
+        StripePrice.objects.create(product=self.mug, stripe_product_id='prod_1', stripe_price_id='price_1',
+                                   unit_amount=1250)
+        Job.objects.all().delete()
+        path = self.write('catalog.csv', 'slug,name,description,category,price\nmug,Mug,A mug,Mugs,15\n')
+
+        self.import_catalog(path, '--dry-run')
+        self.assertEqual(Product.objects.get().price, Decimal('12.50'))
+        self.assertFalse(Job.objects.exists())
+
+        self.import_catalog(path)
+        self.assertEqual(Product.objects.get().price, Decimal('15.00'))
+        self.assertEqual(sorted(Job.objects.values_list('task', flat=True)), ['carts.reprice', 'stripe.sync_price'])
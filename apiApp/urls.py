@@ -8,6 +8,7 @@ urlpatterns = [
     path('categories/', views.CategoryList.as_view(), name='category_list'),
     path('category/<slug:slug>', views.CategoryDetailed.as_view(), name='category_details'),
     path('cart/add/', views.AddToCartView.as_view(), name='cart-add'),
+    path('cart/bulk/', views.BulkCartOperationsView.as_view(), name='cart-bulk'),
     # path('cart/items/<int:pk>/', views.CartItemDetailView.as_view(), name='cart-item-detail'),
     path('cart/delete/<int:pk>/', views.DeleteCartItemView.as_view(), name='cart-item-delete'),
     path('cart/updateItem/<int:pk>/', views.UpdateCartItemAlternativeView.as_view(), name='cart-item-update'),
@@ -17,6 +18,7 @@ urlpatterns = [
     path('review/update/', views.UpdateReview.as_view(), name='update-review'),
     path('review/delete/<int:pk>', views.DeleteReview.as_view(), name='add-review'),
     path('search/', views.SearchProductView.as_view(), name='search-product'),
+    path('search/suggest', views.search_suggestions, name='search-suggest'),
     path('create_checkout_session/', views.create_checkout_session, name='create_checkout_session'),
     # path("create_checkout_session/", views.create_checkout_session, name="create_checkout_session"),
     path("webhook", views.my_webhook_view, name="webhook"),
@@ -32,6 +34,8 @@ urlpatterns = [
     path("product_in_wishlist", views.product_in_wishlist, name="product_in_wishlist"),
     path("get_cart/<str:cart_code>", views.get_cart, name="get_cart"),
     path("get_cart_stat", views.get_cart_stat, name="get_cart_stat"),
-    path("product_in_cart", views.product_in_cart, name="product_in_cart")
+    path("product_in_cart", views.product_in_cart, name="product_in_cart"),
+    path("product_membership", views.product_membership, name="product_membership"),
+    path("payments/metrics", views.payment_metrics, name="payment_metrics"),
 
 ]
\ No newline at end of file
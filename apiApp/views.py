@@ -1,14 +1,44 @@
+import json
+
 import stripe
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from django.shortcuts import render, get_object_or_404,HttpResponse
-from rest_framework.decorators import api_view 
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework import generics, status, mixins
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch
 from rest_framework.response import Response
 from .models import CustomUser, Product, ProductCategory, Cart, CartItem, Review, Wishlist,Order, OrderItem, CustomerAddress
+from .carts import MAX_OPERATIONS, add_item, apply_operations, increment_item, remove_item, upsert_cart
+from .webhooks import record_event
+from .jobs import enqueue_on_commit
+from .checkout import CheckoutError, create_session
+from .payments import PaymentsUnavailable
+from . import membership, payments
+from .conditional import (
+    cart_etag,
+    cart_last_modified,
+    cart_stat,
+    cart_stat_etag,
+    cart_stat_last_modified,
+    product_etag,
+    product_last_modified,
+)
+from .pagination import (
+    OrderCursorPagination,
+    ProductCursorPagination,
+    SearchCursorPagination,
+    StreamingListMixin,
+    WishlistCursorPagination,
+    stream_json,
+    wants_stream,
+)
+from .search import search_products
+from .autocomplete import autocomplete_index
+from .cache import CachedResponseMixin
 from .serializers import (
     ProductListSerializer,
     ProductDetailedSerializer, 
@@ -20,33 +50,68 @@ from .serializers import (
     WishlistSerializer,
     CustomerAddressSerializer,
     OrderSerializer, 
+    OrderSummarySerializer,
     ProductListSerializer, 
     ReviewSerializer, SimpleCartSerializer, UserSerializer, WishlistSerializer
 )
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 # Create your views here.
-stripe.api_key = settings.STRIPE_SECRET_KEY
 endpoint_secret = settings.WEBHOOK_SECRET
 
 User = get_user_model()
-class ProductList(generics.ListAPIView):
+class ProductList(CachedResponseMixin, StreamingListMixin, generics.ListAPIView):
     queryset = Product.objects.filter(featured=True)
     serializer_class = ProductListSerializer
+    pagination_class = ProductCursorPagination
+
+    def get_cache_namespaces(self):
+        return ('featured',)
 
-class ProductDetail(generics.RetrieveAPIView):
+@method_decorator(condition(etag_func=product_etag, last_modified_func=product_last_modified), name='get')
+class ProductDetail(CachedResponseMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductDetailedSerializer
     lookup_field = 'slug'
 
-class CategoryList(generics.ListAPIView):
+    def get_cache_namespaces(self):
+        return (f"product:{self.kwargs['slug']}",)
+
+class CategoryList(CachedResponseMixin, generics.ListAPIView):
     queryset = ProductCategory.objects.all()
     serializer_class = ProductCategoryListSerializer
 
-class CategoryDetailed(generics.RetrieveAPIView):
+    def get_cache_namespaces(self):
+        return ('categories',)
+
+class CategoryDetailed(CachedResponseMixin, generics.RetrieveAPIView):
+    """
+    Category with one page of its products (next / previous hold the cursors).
+    ?stream=1 streams all of the category's products instead.
+    """
     queryset = ProductCategory.objects.all()
     serializer_class = ProductCategoryDetailedSerializer
     lookup_field = 'slug'
 
+    def get_cache_namespaces(self):
+        return (f"category:{self.kwargs['slug']}",)
+
+    def retrieve(self, request, *args, **kwargs):
+        category = self.get_object()
+        products = Product.objects.filter(category=category)
+        context = self.get_serializer_context()
+        if wants_stream(request):
+            return stream_json(products.order_by(*ProductCursorPagination.ordering), ProductListSerializer, context)
+
+        paginator = ProductCursorPagination()
+        page = paginator.paginate_queryset(products, request, view=self)
+        data = ProductCategoryListSerializer(category, context=context).data
+        data['products'] = ProductListSerializer(page, many=True, context=context).data
+        data['next'] = paginator.get_next_link()
+        data['previous'] = paginator.get_previous_link()
+        return Response(data)
+
 
 class AddToCartView(generics.CreateAPIView):
     """
@@ -70,25 +135,17 @@ class AddToCartView(generics.CreateAPIView):
             )
 
         try:
-            # Get or create cart
-            cart, _ = Cart.objects.get_or_create(cart_code=cart_code)
-            
-            # Get product or return 404
-            product = get_object_or_404(Product, id=product_id)
-
-            # Get or create cart item with default quantity of 1
-            cart_item, created = CartItem.objects.get_or_create(
-                product=product,
-                cart=cart,
-                defaults={'quantity': 1}  # One is the default quantity
-            )
-
-            # If the item already exists, increment quantity by 1
-            if not created:
-                cart_item.quantity += 1
-                cart_item.save()
+            with transaction.atomic():
+                # Create the cart or touch it, then upsert the item; the quantity
+                # is incremented by the database so concurrent adds are not lost
+                cart_id = upsert_cart(cart_code)
+                added = add_item(cart_id, int(product_id))
+                if added is None:
+                    raise Product.DoesNotExist
+            _, _, created = added
 
             # Serialize the complete cart for response
+            cart = Cart.objects.with_items().get(pk=cart_id)
             cart_serializer = CartSerializer(cart)
             return Response(
                 cart_serializer.data,
@@ -106,70 +163,122 @@ class AddToCartView(generics.CreateAPIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
     
-class DeleteCartItemView(generics.RetrieveAPIView):
+class BulkCartOperationsView(generics.GenericAPIView):
+    """
+    API view for applying many cart changes in one request.
+    Expects a cart_code and a list of operations, each with a product_id and
+    a quantity delta (defaults to 1, negative values remove items).
+    Returns the complete cart once all operations have been applied.
+    """
+    queryset = CartItem.objects.all()
+    serializer_class = CartSerializer
+    permission_classes = [AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        cart_code = request.data.get('cart_code')
+        operations = request.data.get('operations')
+
+        if not cart_code or not isinstance(operations, list) or not operations:
+            return Response(
+                {'error': 'cart_code and a non-empty list of operations are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not isinstance(cart_code, str) or len(cart_code) > Cart.cart_code_length_limit:
+            return Response(
+                {'error': f'cart_code must be at most {Cart.cart_code_length_limit} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(operations) > MAX_OPERATIONS:
+            return Response(
+                {'error': f'At most {MAX_OPERATIONS} operations per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Merge repeated products so each one is written once
+        deltas = {}
+        try:
+            for operation in operations:
+                product_id = int(operation['product_id'])
+                deltas[product_id] = deltas.get(product_id, 0) + int(operation.get('quantity', 1))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return Response(
+                {'error': 'Each operation needs an integer product_id and quantity'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        found = set(Product.objects.filter(id__in=deltas).values_list('id', flat=True))
+        missing = sorted(set(deltas) - found)
+        if missing:
+            return Response(
+                {'error': 'Products not found', 'product_ids': missing},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        cart_id = apply_operations(cart_code, deltas)
+        cart = Cart.objects.with_items().get(pk=cart_id)
+        return Response(CartSerializer(cart).data, status=status.HTTP_200_OK)
+
+class DeleteCartItemView(generics.RetrieveDestroyAPIView):
     """
-    API view for retrieving cart item details
+    API view for retrieving (GET) or deleting (DELETE) a cart item
     """
     queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
     permission_classes = [AllowAny]
 
+    def perform_destroy(self, instance):
+        remove_item(instance)
+
 
 class UpdateCartItemView(generics.UpdateAPIView):
     """
     API view for updating cart item quantity
     """
-    queryset = CartItem.objects.all()
+    queryset = CartItem.objects.select_related('product')
     serializer_class = CartItemSerializer
     permission_classes = [AllowAny]
     def update(self, request, *args,**kwargs):
-        quantity = request.data.get('quantity')
-        cart_item = self.get_object()
-        if quantity is not None:
-            cart_item.quantity += quantity
-            cart_item.save()
-            return Response(self.get_serializer(cart_item).data)
+        return increment_cart_item(self, request, kwargs['pk'])
 class UpdateCartItemAlternativeView(generics.UpdateAPIView):
     """
     Alternative API view for updating cart item quantity using body params
     """
-    queryset = CartItem.objects.all()
+    queryset = CartItem.objects.select_related('product')
     serializer_class = CartItemSerializer
     permission_classes = [AllowAny]
 
     def update(self, request, *args, **kwargs):
-        cart_item = self.get_object()
-        quantity = request.data.get('quantity')
-        if quantity is not None:
-            cart_item.quantity += int(quantity)
-            cart_item.save()
-            return Response(self.get_serializer(cart_item).data)
-        quantity = request.data.get('quantity')
-        print(quantity, cart_item_id)
-        try:
-            cart_item = CartItem.objects.get(id=cart_item_id)
-            cart_item.quantity += int(quantity)
-            cart_item.save()
+        return increment_cart_item(self, request, kwargs['pk'])
+    lookup_field = 'pk'
 
-            cart_serializer = CartItemSerializer(cart_item)
-            return Response(cart_serializer.data,)
 
-        except CartItem.DoesNotExist:
-            return Response(
-                {'error': 'Cart item not found'},
-                status=status.HTTP_404_NOT_FOUND
-            )
-        except ValueError:
-            return Response(
-                {'error': 'Invalid quantity'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-    lookup_field = 'pk'
+def increment_cart_item(view, request, cart_item_id):
+    """
+    Shared body of the update views: add the posted quantity to the item with
+    a single UPDATE and return the refreshed item, or 204 when that removed it.
+    """
+    try:
+        quantity = int(request.data.get('quantity'))
+    except (TypeError, ValueError):
+        return Response(
+            {'error': 'Invalid quantity'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    remaining = increment_item(cart_item_id, quantity)
+    if remaining is None:
+        return Response(
+            {'error': 'Cart item not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    if remaining == 0:
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(view.get_serializer(view.get_object()).data)
+
 class CartDetailView(generics.RetrieveAPIView):
     """
     API view for deleting cartitems
     """
-    queryset = Cart.objects.all()
+    queryset = Cart.objects.with_items()
     serializer_class = CartSerializer
     permission_classes = [AllowAny]
     lookup_field = 'pk'
@@ -254,13 +363,18 @@ class RemoveFromWishListView(generics.DestroyAPIView):
     serializer_class = WishlistSerializer
     permission_classes = [AllowAny]
     lookup_field = 'pk'
-class SearchProductView(generics.GenericAPIView):
+class SearchProductView(CachedResponseMixin, generics.GenericAPIView):
     """
         API view for search a product by providing a search input
+        Results are ordered by relevance and cursor paginated, ?stream=1 returns all of them
     """
     queryset = Product.objects.all()
     serializer_class = ProductListSerializer
     permission_classes = [AllowAny]
+    pagination_class = SearchCursorPagination
+
+    def get_cache_namespaces(self):
+        return ('search',)
     
     def get(self, request, *args, **kwargs):
         query = request.query_params.get('query', '').strip()
@@ -268,55 +382,43 @@ class SearchProductView(generics.GenericAPIView):
             return Response({"error":"No query provided"}, 
                             status=status.HTTP_400_BAD_REQUEST
                             )
-        products = Product.objects.filter(Q(name__icontains=query)|
-                                          Q(description__icontains=query)|
-                                          Q(category__name__icontains=query))
-        print(products)
-        return Response(self.get_serializer(products, many=True).data, status=status.HTTP_200_OK)
+        products = search_products(query)
+        if wants_stream(request):
+            return stream_json(products, self.get_serializer_class(), self.get_serializer_context())
+        page = self.paginate_queryset(products)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+@api_view(['GET'])
+def search_suggestions(request):
+    """
+    Autocomplete for the search box: top product and category names for a
+    prefix, with typo tolerance. Served from an in-memory index.
+    """
+    query = request.query_params.get('query', '')
+    try:
+        limit = int(request.query_params.get('limit', 10))
+    except ValueError:
+        return Response({"error": "Invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({"suggestions": autocomplete_index.suggest(query, limit)})
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def payment_metrics(request):
+    """Stripe call latency and circuit breaker state for this process"""
+    return Response(payments.status())
 
 @api_view(['POST'])
 def create_checkout_session(request):
     cart_code = request.data.get("cart_code")
     email = request.data.get("email")
-    cart = Cart.objects.get(cart_code=cart_code)
     try:
-        checkout_session = stripe.checkout.Session.create(
-            customer_email= email,
-            payment_method_types=['card'],
-
-
-            line_items=[
-                {
-                    'price_data': {
-                        'currency': 'usd',
-                        'product_data': {'name': item.product.name},
-                        'unit_amount': int(item.product.price * 100),  # Amount in cents
-                    },
-                    'quantity': 5,
-                }
-                for item in cart.cartitems.all()
-            ] + [
-                {
-                    'price_data': {
-                        'currency': 'usd',
-                        'product_data': {'name': 'VAT Fee'},
-                        'unit_amount': 500,  # $5 in cents
-                    },
-                    'quantity': 1,
-                }
-            ],
-
-
-           
-            mode='payment',
-            # success_url="http://localhost:3000/success",
-            # cancel_url="http://localhost:3000/cancel",
-
-            success_url="http://localhost:3000/profile",
-            cancel_url="http://localhost:3000/",
-            metadata = {"cart_code": cart_code}
-        )
+        checkout_session = create_session(cart_code, email)
         return Response({'data': checkout_session})
+    except CheckoutError as e:
+        return Response({'error': str(e)}, status=e.status)
+    except PaymentsUnavailable as e:
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': str(max(int(e.retry_in), 1))})
     except Exception as e:
         return Response({'error': str(e)}, status=400)
 
@@ -354,8 +456,13 @@ def create_checkout_session(request):
 
 @csrf_exempt
 def my_webhook_view(request):
+  """
+  Verify the event and record it in the outbox; a `webhooks.drain` job (or
+  `manage.py process_webhooks`) fulfils it, so Stripe gets its 200 without
+  waiting on our database work.
+  """
   payload = request.body
-  sig_header = request.META['HTTP_STRIPE_SIGNATURE']
+  sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
   event = None
 
   try:
@@ -369,45 +476,13 @@ def my_webhook_view(request):
     # Invalid signature
     return HttpResponse(status=400)
 
-  if (
-    event['type'] == 'checkout.session.completed'
-    or event['type'] == 'checkout.session.async_payment_succeeded'
-  ):
-    session = event['data']['object']
-    cart_code = session.get("metadata", {}).get("cart_code")
-
-    fulfill_checkout(session, cart_code)
-
+  if record_event(json.loads(payload)):
+    enqueue_on_commit('webhooks.drain', priority=10, unique_key='webhooks.drain')
 
   return HttpResponse(status=200)
 
 
 
-def fulfill_checkout(session, cart_code):
-    
-    order = Order.objects.create(stripe_checkout_id=session["id"],
-        amount=session["amount_total"],
-        currency=session["currency"],
-        customer_email=session["customer_email"],
-        status="Paid")
-    
-
-    print(session)
-
-
-    cart = Cart.objects.get(cart_code=cart_code)
-    cartitems = cart.cartitems.all()
-
-    for item in cartitems:
-        orderitem = OrderItem.objects.create(order=order, product=item.product, 
-                                             quantity=item.quantity)
-    
-    cart.delete()
-
-
-
-
-
 # def fulfill_checkout(session, cart_code):
     
 #     order = Order.objects.create(stripe_checkout_id=session["id"],
@@ -472,10 +547,25 @@ def existing_user(request, email):
 
 @api_view(['GET'])
 def get_orders(request):
+    """
+    A customer's orders, newest first. Two queries per page whatever the
+    order sizes; with ?summary=1 one query, from the fulfilment-time summary.
+    """
     email = request.query_params.get("email")
     orders = Order.objects.filter(customer_email=email)
-    serializer = OrderSerializer(orders, many=True)
-    return Response(serializer.data)
+    if request.query_params.get("summary") in ("1", "true"):
+        serializer_class = OrderSummarySerializer
+    else:
+        serializer_class = OrderSerializer
+        orders = orders.prefetch_related(
+            Prefetch("items", queryset=OrderItem.objects.select_related("product").order_by("id"))
+        )
+    if wants_stream(request):
+        return stream_json(orders.order_by(*OrderCursorPagination.ordering), serializer_class)
+    paginator = OrderCursorPagination()
+    page = paginator.paginate_queryset(orders, request)
+    serializer = serializer_class(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
 
 
 @api_view(["POST"])
@@ -518,9 +608,13 @@ def get_address(request):
 @api_view(["GET"])
 def my_wishlists(request):
     email = request.query_params.get("email")
-    wishlists = Wishlist.objects.filter(user__email=email)
-    serializer = WishlistSerializer(wishlists, many=True)
-    return Response(serializer.data)
+    wishlists = Wishlist.objects.filter(user__email=email).select_related("user", "product")
+    if wants_stream(request):
+        return stream_json(wishlists.order_by(*WishlistCursorPagination.ordering), WishlistSerializer)
+    paginator = WishlistCursorPagination()
+    page = paginator.paginate_queryset(wishlists, request)
+    serializer = WishlistSerializer(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
 
 
 @api_view(["GET"])
@@ -535,8 +629,9 @@ def product_in_wishlist(request):
 
 
 @api_view(['GET'])
+@condition(etag_func=cart_etag, last_modified_func=cart_last_modified)
 def get_cart(request, cart_code):
-    cart = Cart.objects.filter(cart_code=cart_code).first()
+    cart = Cart.objects.with_items().filter(cart_code=cart_code).first()
     
     if cart:
         serializer = CartSerializer(cart)
@@ -548,9 +643,9 @@ def get_cart(request, cart_code):
 
 
 @api_view(['GET'])
+@condition(etag_func=cart_stat_etag, last_modified_func=cart_stat_last_modified)
 def get_cart_stat(request):
-    cart_code = request.query_params.get("cart_code")
-    cart = Cart.objects.filter(cart_code=cart_code).first()
+    cart = cart_stat(request)
 
     if cart:
         serializer = SimpleCartSerializer(cart)
@@ -558,6 +653,30 @@ def get_cart_stat(request):
     return Response({"error": "Cart not found."}, status=status.HTTP_404_NOT_FOUND)
 
 
+@api_view(['GET'])
+def product_membership(request):
+    """
+    Batch form of product_in_cart and product_in_wishlist for a whole product
+    grid: ?product_ids=1,2,3 with a cart_code and/or an email. One query per
+    source, or none when the cached product ids are still fresh.
+    """
+    raw_ids = request.query_params.getlist("product_id") or request.query_params.get("product_ids", "").split(",")
+    try:
+        product_ids = list(dict.fromkeys(int(pk) for pk in raw_ids if pk.strip()))
+    except ValueError:
+        return Response({"error": "product_ids must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+    if not product_ids or len(product_ids) > membership.MAX_PRODUCTS:
+        return Response(
+            {"error": f"Between 1 and {membership.MAX_PRODUCTS} product_ids are required"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    cart_code = request.query_params.get("cart_code")
+    email = request.query_params.get("email")
+    if not cart_code and not email:
+        return Response({"error": "A cart_code or an email is required"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(membership.membership(product_ids, cart_code=cart_code, email=email))
+
+
 @api_view(['GET'])
 def product_in_cart(request):
     cart_code = request.query_params.get("cart_code")
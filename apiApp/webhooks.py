@@ -0,0 +1,111 @@
+"""
+Stripe webhook outbox.
+
+The webhook view verifies the signature, records the event with
+record_event() and answers 200 straight away. `manage.py process_webhooks`
+drains the outbox: events are claimed in batches with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so any number of workers can run side by
+side, failures are retried with exponential backoff and jitter, and events
+that keep failing are parked as "Dead" for a human to look at.
+"""
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import WebhookEvent
+from .orders import fulfill_checkout
+
+logger = logging.getLogger(__name__)
+
+HANDLED_EVENTS = {
+    'checkout.session.completed',
+    'checkout.session.async_payment_succeeded',
+}
+
+# A claimed event is handed to another worker if it is not finished by then
+LEASE = timedelta(minutes=5)
+
+
+def max_attempts():
+    return getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 8)
+
+
+def retry_delay(attempts):
+    """Full-jitter exponential backoff: up to 10s, 20s, 40s ... capped at one hour."""
+    ceiling = min(3600, 10 * 2 ** (attempts - 1))
+    return timedelta(seconds=random.uniform(ceiling / 2, ceiling))
+
+
+def record_event(event):
+    """
+    Store a verified event for processing. Redelivered events are ignored.
+    Returns False for event types we don't handle.
+    """
+    if event['type'] not in HANDLED_EVENTS:
+        return False
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event['id'], event_type=event['type'], payload=event)],
+        ignore_conflicts=True,
+    )
+    return True
+
+
+def claim_batch(limit):
+    """Lease up to ``limit`` due events to this worker."""
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status="Pending", next_attempt_at__lte=now)
+                # Leases of workers that died mid-event
+                | Q(status="Processing", locked_until__lt=now)
+            )
+            .order_by('next_attempt_at')[:limit]
+        )
+        WebhookEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            status="Processing", locked_until=now + LEASE, attempts=F('attempts') + 1
+        )
+    for event in events:
+        event.attempts += 1
+    return events
+
+
+def dispatch(event):
+    session = event.payload['data']['object']
+    cart_code = (session.get('metadata') or {}).get('cart_code')
+    fulfill_checkout(session, cart_code)
+
+
+def process(event):
+    """Run one claimed event and record the outcome. Returns the new status."""
+    try:
+        dispatch(event)
+    except Exception as error:
+        logger.exception("Webhook event %s failed (attempt %s)", event.event_id, event.attempts)
+        if event.attempts >= max_attempts():
+            status, next_attempt_at = "Dead", event.next_attempt_at
+        else:
+            status, next_attempt_at = "Pending", timezone.now() + retry_delay(event.attempts)
+        WebhookEvent.objects.filter(pk=event.pk).update(
+            status=status, next_attempt_at=next_attempt_at, locked_until=None, last_error=repr(error)
+        )
+        return status
+    WebhookEvent.objects.filter(pk=event.pk).update(
+        status="Done", locked_until=None, processed_at=timezone.now(), last_error=''
+    )
+    return "Done"
+
+
+def drain(batch_size=50):
+    """Claim and process one batch. Returns {status: count}; empty when nothing was due."""
+    outcome = {}
+    for event in claim_batch(batch_size):
+        status = process(event)
+        outcome[status] = outcome.get(status, 0) + 1
+    return outcome